@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""analytics.py - Offline analytics over an export of the game history.
+
+Reads the gzip-compressed NDJSON chunks of an export (see export.py) without
+App Engine, loads each chunk's games into columnar NumPy arrays, and
+computes in vectorized passes:
+
+ - the distribution of the plays of human players and of the AI;
+ - the distribution of the first play of each game;
+ - the histogram of the lengths of players' win streaks;
+ - the rate at which the AI wins, overall, per strategy and per user.
+
+Packed move histories are decoded for a whole chunk at once, as one bit
+stream, rather than move by move. The aggregates are written as chunks of
+the same export format, holding the AnalyticsSummary entity and a
+UserAnalytics entity per user, to be posted to /tasks/import_chunk.
+
+Usage: python analytics.py --output DIR CHUNK [CHUNK ...]"""
+
+import argparse
+import base64
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from packing import bits_per_move
+from rules import get_rules, DEFAULT_VARIANT
+
+OUTPUT_CHUNK_SIZE = 5000
+
+
+def unpack_moves(blobs, counts, bits):
+    """Returns the Rules indexes of the moves of the given packed move
+    histories (see packing.PackedMoves) with the given number of moves each,
+    concatenated in order. All histories are unpacked as a single bit
+    stream."""
+    counts = np.asarray(counts, dtype=np.int64)
+    if not counts.sum():
+        return np.zeros(0, dtype=np.int64)
+    data = np.frombuffer(b''.join(blobs), dtype=np.uint8)
+    # The bits of each byte, least significant first.
+    stream = np.unpackbits(data[:, np.newaxis], axis=1)[:, ::-1].ravel()
+    lengths = np.array([len(blob) for blob in blobs], dtype=np.int64)
+    bit_starts = (np.cumsum(lengths) - lengths) * 8
+    history = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    numbers = np.arange(counts.sum()) - first[history]
+    positions = (bit_starts[history] + numbers * bits)[:, np.newaxis] + np.arange(bits)
+    return stream[positions].astype(np.int64).dot(1 << np.arange(bits, dtype=np.int64))
+
+
+class Analytics(object):
+    """Running aggregates of the games of the chunks added so far. Move
+    aggregates are kept as counts, and the per-game columns needed for
+    streaks and win rates are kept as one array per chunk."""
+
+    def __init__(self):
+        self.games = 0
+        self.moves = 0
+        self.play_counts = {}
+        self.ai_play_counts = {}
+        self.first_play_counts = {}
+        self.results = []
+        self.ai_results = []
+
+    @staticmethod
+    def _count(counts, names, codes=None):
+        """Adds the number of occurrences of each play to the given counts,
+        keyed by play name. Plays are given either as an array of codes of
+        the given tuple of names, or as an array of names."""
+        if codes is not None:
+            occurrences = np.bincount(codes, minlength=len(names))
+            pairs = zip(names, occurrences)
+        else:
+            pairs = zip(*np.unique(np.asarray(names), return_counts=True)) if len(names) else []
+        for name, count in pairs:
+            if count:
+                counts[name] = counts.get(name, 0) + int(count)
+
+    def add_chunk(self, lines):
+        """Adds the entities of a chunk, given as NDJSON lines. Only Games
+        and Moves are read."""
+        games = []
+        moves = []
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            kind = record['key'][-2]
+            if kind == 'Game':
+                games.append(record['properties'])
+            elif kind == 'Move':
+                moves.append(record)
+        self._add_games(games)
+        self._add_moves(moves)
+
+    def _add_games(self, games):
+        """Adds the moves and results of the given Game properties."""
+        packed = {}
+        inline = []
+        for game in games:
+            if game.get('move_data') is not None:
+                variant = game.get('variant') or DEFAULT_VARIANT
+                packed.setdefault(variant, []).append(game)
+            elif game.get('moves'):
+                inline.append(game)
+        for variant, variant_games in packed.items():
+            self._add_packed(get_rules(variant), variant_games)
+        for game in inline:
+            pvp = bool(game.get('opponent'))
+            self._add_named([move['play'] for move in game['moves']],
+                            [move['ai_play'] for move in game['moves']],
+                            [pvp] * len(game['moves']),
+                            [number == 0 for number in range(len(game['moves']))])
+        self._add_results(games)
+
+    def _add_packed(self, rules, games):
+        """Adds the packed moves of the given games of one variant."""
+        counts = np.array([game.get('move_count') or 0 for game in games], dtype=np.int64)
+        indexes = unpack_moves([base64.b64decode(game['move_data']) for game in games],
+                               counts, bits_per_move(rules.size))
+        plays, ai_plays = np.divmod(indexes, rules.size)
+        # The opponent of a player-vs-player game is a human, whose plays
+        # are stored as the AI's.
+        pvp = np.repeat(np.array([bool(game.get('opponent')) for game in games]), counts)
+        first = (np.cumsum(counts) - counts)[counts > 0]
+        self.moves += len(indexes)
+        self._count(self.play_counts, rules.plays, plays)
+        self._count(self.play_counts, rules.plays, ai_plays[pvp])
+        self._count(self.ai_play_counts, rules.plays, ai_plays[~pvp])
+        self._count(self.first_play_counts, rules.plays, plays[first])
+        self._count(self.first_play_counts, rules.plays, ai_plays[first][pvp[first]])
+
+    def _add_named(self, plays, ai_plays, pvp, first):
+        """Adds moves given by play name, as stored by legacy games."""
+        plays, ai_plays = np.asarray(plays, dtype=object), np.asarray(ai_plays, dtype=object)
+        pvp, first = np.asarray(pvp, dtype=bool), np.asarray(first, dtype=bool)
+        self.moves += len(plays)
+        self._count(self.play_counts, plays)
+        self._count(self.play_counts, ai_plays[pvp])
+        self._count(self.ai_play_counts, ai_plays[~pvp])
+        self._count(self.first_play_counts, plays[first])
+        self._count(self.first_play_counts, ai_plays[first & pvp])
+
+    def _add_moves(self, moves):
+        """Adds legacy child Move entities. Their games are not needed: a
+        Move is the first of its game if numbered 1, and is taken as made
+        against the AI, as player-vs-player games never stored Moves."""
+        if not moves:
+            return
+        self._add_named([move['properties']['play'] for move in moves],
+                        [move['properties']['ai_play'] for move in moves],
+                        [False] * len(moves),
+                        [move['key'][-1] == 1 for move in moves])
+
+    def _add_results(self, games):
+        """Adds the results of the given games that are over and were not
+        cancelled: one row per player for streaks, and one per game against
+        the AI for win rates."""
+        players, dates, won = [], [], []
+        ai_users, ai_strategies, ai_won = [], [], []
+        for game in games:
+            self.games += 1
+            if not game.get('game_over') or game.get('cancelled'):
+                continue
+            user = game['user'][-1]
+            players.append(user)
+            dates.append(game['date'])
+            won.append(bool(game.get('won')))
+            if game.get('opponent'):
+                players.append(game['opponent'][-1])
+                dates.append(game['date'])
+                won.append(not game.get('won'))
+            else:
+                ai_users.append(user)
+                ai_strategies.append(game.get('strategy') or '')
+                ai_won.append(not game.get('won'))
+        if players:
+            self.results.append((np.array(players, dtype=object),
+                                 np.array(dates, dtype='datetime64[us]'),
+                                 np.array(won, dtype=bool)))
+        if ai_users:
+            self.ai_results.append((np.array(ai_users, dtype=object),
+                                    np.array(ai_strategies, dtype=object),
+                                    np.array(ai_won, dtype=bool)))
+
+    def streak_lengths(self):
+        """Returns the histogram of win streak lengths, as the number of
+        streaks of each length from 1, over each player's games in date
+        order."""
+        if not self.results:
+            return []
+        players, dates, won = [np.concatenate(column) for column in zip(*self.results)]
+        _, player_ids = np.unique(players, return_inverse=True)
+        order = np.lexsort((dates, player_ids))
+        player_ids, won = player_ids[order], won[order]
+        same_player = player_ids[1:] == player_ids[:-1]
+        starts = np.ones(len(won), dtype=bool)
+        starts[1:] = ~won[:-1] | ~same_player
+        ends = np.ones(len(won), dtype=bool)
+        ends[:-1] = ~won[1:] | ~same_player
+        lengths = np.flatnonzero(won & ends) - np.flatnonzero(won & starts) + 1
+        return [int(count) for count in np.bincount(lengths)[1:]]
+
+    def ai_win_rates(self):
+        """Returns the number of games against the AI and of AI wins: in
+        total, per strategy and per user, the latter two as dictionaries of
+        (games, wins) pairs."""
+        if not self.ai_results:
+            return 0, 0, {}, {}
+        users, strategies, ai_won = [np.concatenate(column) for column in zip(*self.ai_results)]
+
+        def _per(keys):
+            """Count games and AI wins per distinct key."""
+            names, ids = np.unique(keys, return_inverse=True)
+            games = np.bincount(ids, minlength=len(names))
+            wins = np.bincount(ids, weights=ai_won, minlength=len(names))
+            return dict((name, (int(count), int(win)))
+                        for name, count, win in zip(names, games, wins))
+        return len(ai_won), int(ai_won.sum()), _per(strategies), _per(users)
+
+    def entities(self):
+        """Yields the aggregates as records of the export format: the
+        AnalyticsSummary entity, then the UserAnalytics of each user."""
+        ai_games, ai_wins, per_strategy, per_user = self.ai_win_rates()
+        yield {'key': ['AnalyticsSummary', 'global'],
+               'properties': {'computed': datetime.today().isoformat(),
+                              'games': self.games,
+                              'moves': self.moves,
+                              'play_counts': self.play_counts,
+                              'ai_play_counts': self.ai_play_counts,
+                              'first_play_counts': self.first_play_counts,
+                              'streak_lengths': self.streak_lengths(),
+                              'ai_games': ai_games,
+                              'ai_wins': ai_wins,
+                              'strategies': per_strategy}}
+        for username, (games, wins) in sorted(per_user.items()):
+            yield {'key': ['User', username, 'UserAnalytics', 'analytics'],
+                   'properties': {'ai_games': games, 'ai_wins': wins}}
+
+
+def write_chunks(records, directory, chunk_size=OUTPUT_CHUNK_SIZE):
+    """Writes the given records as gzip-compressed NDJSON chunks of the
+    given number of entities in the given directory. Returns the paths of
+    the chunks."""
+    paths = []
+    out = None
+    for number, record in enumerate(records):
+        if number % chunk_size == 0:
+            if out:
+                out.close()
+            paths.append(os.path.join(directory,
+                                      'analytics-{:05d}.ndjson.gz'.format(len(paths) + 1)))
+            out = gzip.open(paths[-1], 'wb')
+        out.write((json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n')
+                  .encode('utf-8'))
+    if out:
+        out.close()
+    return paths
+
+
+def analyze(paths):
+    """Returns the Analytics of the export chunks at the given paths."""
+    analytics = Analytics()
+    for path in paths:
+        with gzip.open(path, 'rb') as lines:
+            analytics.add_chunk(lines)
+    return analytics
+
+
+def main():
+    """Analyze the given chunks and write the aggregates."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('chunks', nargs='+', help='export chunk files, or glob patterns')
+    parser.add_argument('--output', required=True, help='directory to write the aggregates to')
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.chunks for path in glob.glob(pattern))
+    start = time.time()
+    analytics = analyze(paths)
+    elapsed = time.time() - start
+    written = write_chunks(analytics.entities(), args.output)
+    sys.stdout.write('Analyzed {} games and {} moves from {} chunks in {:.1f}s '
+                     '({:.0f} moves/sec); wrote {} chunks.\n'.format(
+                         analytics.games, analytics.moves, len(paths), elapsed,
+                         analytics.moves / elapsed if elapsed else 0, len(written)))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,29 +3,74 @@
 
 
 from __future__ import division
+from datetime import date
+
 import endpoints
-import random
 
 from protorpc import remote, messages
-
-from models import User, Game
-from models import StringMessage, MakePlayForm, Move, NewGameForm,\
-    GameForms, GameForm, UserForm, UserForms, UserRankingForms, UserScoreForms
-from utils import get_by_urlsafe
-
-
-VALID_PLAYS = ["rock", "paper", "scissors"]
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from models import User, Game, Stats, AIState, OpenGames, LeaderboardBucket, MatchRequest,\
+    AnalyticsSummary, UserAnalytics
+from models import StringMessage, MakePlayForm, MakePlaysForm, NewGameForm, GameHistoryForm,\
+    GameForms, GameForm, PerfStatsForm, PerfStatsForms, PlayResultForm, PlayResultForms,\
+    StatsForm, UserForm, UserForms, UserRankingForms, UserScoreForms, JoinQueueForm, MatchForm,\
+    AnalyticsForm
+from perf import instrument, get_summaries
+from rules import get_rules
+from strategies import get_strategy
+from utils import get_by_urlsafe, get_multi_by_urlsafe, fetch_page, slice_page, require_admin,\
+    get_cached_message
+
+
+CONCURRENT_PLAY_MSG = 'This game was changed by another play. Please try again!'
+WAITING_FOR_OPPONENT_MSG = 'Waiting for your opponent to play.'
+MAX_BATCH_PLAYS = 100
+# Leaderboard queries are eventually consistent, so a page cached for a
+# leaderboard version is only kept briefly.
+LEADERBOARD_CACHE_TIME = 10
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
-GET_GAME_REQUEST = endpoints.ResourceContainer(urlsafe_game_key=messages.StringField(1),)
+GET_GAME_REQUEST = endpoints.ResourceContainer(urlsafe_game_key=messages.StringField(1),
+                                               etag=messages.StringField(2))
 CANCEL_GAME_REQUEST = endpoints.ResourceContainer(urlsafe_game_key=messages.StringField(1),)
 MAKE_PLAY_REQUEST = endpoints.ResourceContainer(MakePlayForm,
                                                 urlsafe_game_key=messages.StringField(1),)
+GET_GAME_HISTORY_REQUEST = endpoints.ResourceContainer(urlsafe_game_key=messages.StringField(1),
+                                                      last=messages.IntegerField(2),
+                                                      etag=messages.StringField(3))
 GET_USER_REQUEST = endpoints.ResourceContainer(username=messages.StringField(1),)
+PAGE_REQUEST = endpoints.ResourceContainer(limit=messages.IntegerField(1),
+                                           page_token=messages.StringField(2))
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(limit=messages.IntegerField(1),
+                                                  page_token=messages.StringField(2),
+                                                  etag=messages.StringField(3),
+                                                  period=messages.StringField(4))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(username=messages.StringField(1),
+                                                 limit=messages.IntegerField(2),
+                                                 page_token=messages.StringField(3))
+ANALYTICS_REQUEST = endpoints.ResourceContainer(username=messages.StringField(1),)
+MATCH_REQUEST = endpoints.ResourceContainer(username=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(username=messages.StringField(1),
                                            display_name=messages.StringField(2),
                                            email=messages.StringField(3))
 
 
+def _leaderboard_query(period, property_name):
+    """Returns the scope of the leaderboard of the given period (all time,
+    the default, 'day' or 'week') and the query of its entries in descending
+    order of the named property: the Users for all time, or else the
+    LeaderboardBuckets of the current day or week."""
+    if not period or period == LeaderboardBucket.ALL_TIME:
+        return (LeaderboardBucket.ALL_TIME,
+                User.query().order(-getattr(User, property_name)))
+    if period not in LeaderboardBucket.PERIODS:
+        raise endpoints.BadRequestException('Unknown leaderboard period!')
+    scope = LeaderboardBucket.bucket_name(period, date.today())
+    return (scope, LeaderboardBucket.query(LeaderboardBucket.bucket == scope)
+            .order(-getattr(LeaderboardBucket, property_name)))
+
+
 @endpoints.api(name='rock_paper_scissors', version='v1')
 class RockPaperScissorsApi(remote.Service):
     """Main Game API"""
@@ -38,15 +83,20 @@ class RockPaperScissorsApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrument
     def create_user(self, request):
         """Create a User. Requires a unique username."""
-        if User.query(User.username == request.username).get():
+        if not request.username:
+            raise endpoints.BadRequestException('A username is required!')
+        # Check for users not yet migrated to username keys as well.
+        user = None
+        if not User.get_by_username(request.username):
+            user = User.create(request.username,
+                               request.display_name,
+                               request.email)
+        if not user:
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(username=request.username,
-                    display_name=request.display_name,
-                    email=request.email)
-        user.put()
         return user.to_form()
 
 
@@ -58,25 +108,31 @@ class RockPaperScissorsApi(remote.Service):
                       path='get_user',
                       name='get_user',
                       http_method='GET')
+    @instrument
     def get_user(self, request):
         """Return a User object for specified username. Requires a unique username."""
-        user = User.query(User.username == request.username).get()
+        user = User.get_by_username(request.username)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        return user.to_form()
+        return user.to_form(user.get_result_counts())
 
 
     #-------------------------------------------------------------------
     # get_users
     #-------------------------------------------------------------------
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='users',
                       name='get_users',
                       http_method='GET')
+    @instrument
     def get_users(self, request):
-        """Return all users, sorted by username."""
-        return UserForms(users=[user.to_form() for user in User.query().order(User.username)])
+        """Return a page of users, sorted by username."""
+        users, next_page_token = fetch_page(User.query().order(User.username),
+                                            request.limit, request.page_token)
+        return UserForms(users=[user.to_form() for user in users],
+                         next_page_token=next_page_token)
 
 
     #-------------------------------------------------------------------
@@ -87,14 +143,23 @@ class RockPaperScissorsApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrument
     def new_game(self, request):
         """Creates new game."""
-        user = User.query(User.username == request.username).get()
+        user = User.get_by_username(request.username)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        game = Game.new_game(user.key)
-        return game.to_form('Good luck playing Rock, Paper, Scissors!')
+        rules = get_rules(request.variant)
+        if not rules:
+            raise endpoints.BadRequestException('Unknown game variant!')
+        if not get_strategy(request.strategy, rules.size):
+            raise endpoints.BadRequestException('Unknown AI strategy for this game variant!')
+        game = Game.new_game(user.key, request.variant, request.strategy)
+        # The user is known and a new game has no moves, so the form needs
+        # no further gets.
+        return game.to_form('Good luck playing Rock, Paper, Scissors!',
+                            usernames={user.key: user.username}, move_forms=[])
 
 
     #-------------------------------------------------------------------
@@ -105,11 +170,17 @@ class RockPaperScissorsApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrument
     def get_game(self, request):
         """Return the current game state."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game:
-            return game.to_form('Time to make a play!')
+            form = get_cached_message('game:{}:{}'.format(request.urlsafe_game_key,
+                                                          game.version),
+                                      GameForm,
+                                      lambda: game.to_form('Time to make a play!'))
+            form.not_modified = request.etag == form.etag
+            return form
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -122,6 +193,7 @@ class RockPaperScissorsApi(remote.Service):
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='PUT')
+    @instrument
     def cancel_game(self, request):
         """Cancels the specified game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
@@ -133,7 +205,11 @@ class RockPaperScissorsApi(remote.Service):
                 raise endpoints.ConflictException("""This game is already over.\
                     You cannot cancel it!""")
             game.cancelled = True
-            game.end_game(True)
+            try:
+                if not game.end_game(True):
+                    raise endpoints.ConflictException(CONCURRENT_PLAY_MSG)
+            except datastore_errors.TransactionFailedError:
+                raise endpoints.ConflictException(CONCURRENT_PLAY_MSG)
             return game.to_form('Game cancelled!')
         else:
             raise endpoints.NotFoundException('Game not found!')
@@ -147,6 +223,7 @@ class RockPaperScissorsApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_play',
                       http_method='PUT')
+    @instrument
     def make_play(self, request):
         """Makes a play. Returns a game state with message."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
@@ -157,156 +234,421 @@ class RockPaperScissorsApi(remote.Service):
             return game.to_form('Game already over!')
 
         # Get plays of AI and user, making sure they're valid.
-        ai_play = random.choice(VALID_PLAYS)
-        user_play = request.play.lower()
-        if not user_play in VALID_PLAYS:
-            msg = 'Uh-oh. You need to specify either Rock, Paper, or Scissors.'
-            game.put()
-            return game.to_form(msg)
-
-        if user_play == ai_play:
-            msg = 'Looks like we both picked {}. Play again!'.format(user_play.title())
-            game.moves.append(Move(play=user_play, ai_play=ai_play, result=msg))
-            game.put()
-            return game.to_form(msg)
-
-        # Attach plays to game attributes
-        game.ai_play = ai_play
-        game.play = user_play
-
-        # Set other applicable game attributes, including outgoing message for form.
-        if user_play == 'scissors' and ai_play == 'paper' or\
-           user_play == 'rock' and ai_play == 'scissors' or\
-           user_play == 'paper' and ai_play == 'rock':
-            msg = """Congratulations, your {} beats my {}.\
-                You win!""".format(user_play.title(), ai_play.title())
-            game.message = msg
-            game.moves.append(Move(play=user_play, ai_play=ai_play, result=msg))
-            game.put()
-            game.end_game(True)
-            return game.to_form(msg)
-        else:
-            msg = """Sorry, my {} beats your {}. You lose!"""\
-                .format(ai_play.title(), user_play.title())
-            game.message = msg
-            game.moves.append(Move(play=user_play, ai_play=ai_play, result=msg))
-            game.put()
-            game.end_game(False)
-            return game.to_form(msg)
+        rules = game.get_rules()
+        user_play = rules.code(request.play)
+        if user_play is None:
+            return game.to_form(rules.invalid_play_msg)
+        if game.opponent:
+            return self._make_pvp_play(game, request.username, user_play)
+        ai = AIState.get_for(game)
+
+        # The move, and the game and user stats if the move ends the game,
+        # are all saved in a single write.
+        move = game.apply_play(user_play, ai.choose())
+        try:
+            saved = game.save_moves([move])
+        except datastore_errors.TransactionFailedError:
+            saved = False
+        if not saved:
+            raise endpoints.ConflictException(CONCURRENT_PLAY_MSG)
+        ai.record(user_play)
+        # The AI state is stored while the game's user and moves are fetched.
+        form_future = game.to_form_async(move.result)
+        ai.store_async().get_result()
+        return form_future.get_result()
+
+    def _make_pvp_play(self, game, username, play):
+        """Makes a play of the named player in a player-vs-player game. The
+        play is sealed until the opponent has played too, and the round is
+        then resolved and saved in the same transaction (see
+        Game.submit_play). Returns the game state with a message from the
+        player's point of view."""
+        player = User.get_by_username(username) if username else None
+        if not player or player.key not in game.players():
+            raise endpoints.ForbiddenException(
+                'Only the players of this game can make a play!')
+        try:
+            game, move, accepted = Game.submit_play(game.key, player.key, play)
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(CONCURRENT_PLAY_MSG)
+        if not accepted:
+            if game.game_over:
+                return game.to_form('Game already over!')
+            return game.to_form('You have already played this round. ' +
+                                WAITING_FOR_OPPONENT_MSG)
+        if not move:
+            return game.to_form(WAITING_FOR_OPPONENT_MSG)
+        if player.key == game.user:
+            return game.to_form(move.result)
+        rules = game.get_rules()
+        return game.to_form(rules.resolve(rules.code(move.ai_play), rules.code(move.play))[1])
+
+
+    #-------------------------------------------------------------------
+    # make_plays
+    #-------------------------------------------------------------------
+    @endpoints.method(request_message=MakePlaysForm,
+                      response_message=PlayResultForms,
+                      path='plays',
+                      name='make_plays',
+                      http_method='POST')
+    @instrument
+    def make_plays(self, request):
+        """Makes a batch of plays, in one or more games. Returns the result of
+        each play, in order."""
+        if len(request.plays) > MAX_BATCH_PLAYS:
+            raise endpoints.BadRequestException(
+                'At most {} plays can be made at once!'.format(MAX_BATCH_PLAYS))
+        game_keys = [play.urlsafe_game_key or request.urlsafe_game_key
+                     for play in request.plays]
+        if not all(game_keys):
+            raise endpoints.BadRequestException('A game key is required for every play!')
+        games = get_multi_by_urlsafe(game_keys, Game)
+
+        # Resolve all plays in memory, collecting the new moves of each game
+        # along with the results they belong to.
+        results = []
+        pending = {}
+        ais = {}
+        for game_key, play in zip(game_keys, request.plays):
+            game = games[game_key]
+            result = PlayResultForm(urlsafe_game_key=game_key,
+                                    play=play.play,
+                                    accepted=False)
+            results.append(result)
+            rules = game.get_rules() if game else None
+            user_play = rules.code(play.play) if rules else None
+            if not game:
+                result.message = 'Game not found!'
+            elif game.opponent:
+                result.message = 'Plays in player-vs-player games must be made one at a time!'
+            elif game.game_over:
+                result.message = 'Game already over!'
+            elif user_play is None:
+                result.message = rules.invalid_play_msg
+            else:
+                ai_key = AIState.key_for(game)
+                if ai_key not in ais:
+                    ais[ai_key] = AIState.get_for(game)
+                move = game.apply_play(user_play, ais[ai_key].choose())
+                pending.setdefault(game_key, ([], []))
+                pending[game_key][0].append(move)
+                pending[game_key][1].append(result)
+                result.ai_play = move.ai_play
+                result.message = move.result
+                result.accepted = True
+
+        # Store each game with all of its new moves in a single write. The
+        # games of one user all write to the user's entity group, so they are
+        # saved one after another; the games of different users are saved
+        # concurrently.
+        @ndb.tasklet
+        def _save_games(user_game_keys):
+            """Save the given games of one user in turn. Returns whether each
+            game was saved, by game key."""
+            saved = {}
+            for game_key in user_game_keys:
+                try:
+                    saved[game_key] = yield games[game_key].save_moves_async(
+                        pending[game_key][0])
+                except datastore_errors.TransactionFailedError:
+                    saved[game_key] = False
+            raise ndb.Return(saved)
+        games_by_user = {}
+        for game_key in pending:
+            games_by_user.setdefault(games[game_key].user, []).append(game_key)
+        saves = [_save_games(user_game_keys) for user_game_keys in games_by_user.values()]
+        saved = {}
+        for save in saves:
+            saved.update(save.get_result())
+        for game_key, (_, game_results) in pending.items():
+            game = games[game_key]
+            for result in game_results:
+                if saved[game_key]:
+                    result.game_over = game.game_over
+                    result.won = game.won
+                else:
+                    result.ai_play = None
+                    result.message = CONCURRENT_PLAY_MSG
+                    result.accepted = False
+
+        # The AI only learns from the plays that were saved, in the order
+        # they were made, and the AI states are then stored concurrently.
+        for game_key, result in zip(game_keys, results):
+            if result.accepted:
+                game = games[game_key]
+                ais[AIState.key_for(game)].record(game.get_rules().code(result.play))
+        stores = [ai.store_async() for ai in ais.values()]
+        for store in stores:
+            store.get_result()
+        return PlayResultForms(results=results)
+
+
+    #-------------------------------------------------------------------
+    # join_queue
+    #-------------------------------------------------------------------
+    @endpoints.method(request_message=JoinQueueForm,
+                      response_message=MatchForm,
+                      path='queue',
+                      name='join_queue',
+                      http_method='POST')
+    @instrument
+    def join_queue(self, request):
+        """Joins the matchmaking pool for a player-vs-player game. The user is
+        paired at once with the longest waiting player of a similar win
+        percentage if there is one, and is otherwise paired by a background
+        worker, widening the range of win percentages over time. Poll
+        get_match for the game."""
+        user = User.get_by_username(request.username)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        rules = get_rules(request.variant)
+        if not rules:
+            raise endpoints.BadRequestException('Unknown game variant!')
+        entry = MatchRequest.join(user, rules.variant, request.any_skill)
+        entry = entry.pair(1)
+        if entry.waiting:
+            entry.enqueue_pairing()
+        return self._match_form(entry)
+
+    def _match_form(self, entry):
+        """Returns the MatchForm of the given entry, with the username of its
+        opponent if it has been paired."""
+        opponent = None
+        if entry.game:
+            game = entry.game.get()
+            usernames = Game.get_usernames([game])
+            opponent = [usernames.get(player) for player in game.players()
+                        if player != entry.user][0]
+        return entry.to_form(opponent)
+
+
+    #-------------------------------------------------------------------
+    # get_match
+    #-------------------------------------------------------------------
+    @endpoints.method(request_message=MATCH_REQUEST,
+                      response_message=MatchForm,
+                      path='queue/{username}',
+                      name='get_match',
+                      http_method='GET')
+    @instrument
+    def get_match(self, request):
+        """Return the matchmaking status of a user: waiting, or matched with
+        the game to play."""
+        entry = MatchRequest.key_for(request.username).get()
+        if not entry:
+            raise endpoints.NotFoundException('This user is not in the queue!')
+        return self._match_form(entry)
+
+
+    #-------------------------------------------------------------------
+    # leave_queue
+    #-------------------------------------------------------------------
+    @endpoints.method(request_message=MATCH_REQUEST,
+                      response_message=StringMessage,
+                      path='queue/{username}',
+                      name='leave_queue',
+                      http_method='DELETE')
+    @instrument
+    def leave_queue(self, request):
+        """Leaves the matchmaking pool, unless already matched."""
+        if not MatchRequest.leave(request.username):
+            raise endpoints.ConflictException(
+                'This user is not waiting in the queue!')
+        return StringMessage(message='Left the queue.')
 
 
     #-------------------------------------------------------------------
     # get_games
     #-------------------------------------------------------------------
-    @endpoints.method(response_message=GameForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=GameForms,
                       path='games',
                       name='get_games',
                       http_method='GET')
+    @instrument
     def get_games(self, request):
-        """Return all games, ordered by most recent game date."""
-        return GameForms(games=[game.to_form() for game in Game.query().order(-Game.date)])
+        """Return a page of games, ordered by most recent game date."""
+        games, next_page_token = fetch_page(Game.query().order(-Game.date),
+                                            request.limit, request.page_token)
+        return GameForms(games=Game.to_forms(games),
+                         next_page_token=next_page_token)
 
 
     #-------------------------------------------------------------------
     # get_user_games
     #-------------------------------------------------------------------
-    @endpoints.method(request_message=GET_USER_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='user_games',
                       name='get_user_games',
                       http_method='GET')
+    @instrument
     def get_user_games(self, request):
-        """Return all active (unfinished) games for specified user."""
-        user = User.query(User.username == request.username).get()
+        """Return a page of active (unfinished) games for specified user."""
+        user = User.get_by_username(request.username)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        query = Game.query()\
-            .filter(Game.game_over == False)\
-            .filter(Game.user == user.key)
-        return GameForms(games=[game.to_form() for game in query])
+        open_games = OpenGames.key_for(user.key).get()
+        if open_games and open_games.migrated:
+            game_keys, next_page_token = slice_page(open_games.game_keys,
+                                                    request.limit, request.page_token)
+            games = [game for game in ndb.get_multi(game_keys) if game]
+        else:
+            # Users not yet migrated to OpenGames.
+            query = Game.query()\
+                .filter(Game.game_over == False)\
+                .filter(Game.user == user.key)
+            games, next_page_token = fetch_page(query, request.limit, request.page_token)
+        return GameForms(games=Game.to_forms(games),
+                         next_page_token=next_page_token)
 
 
     #-------------------------------------------------------------------
     # get_user_rankings
     #-------------------------------------------------------------------
-    @endpoints.method(response_message=UserScoreForms,
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=UserScoreForms,
                       path='high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrument
     def get_high_scores(self, request):
-        """Return player high scores in the format of longest win streak."""
-        # Iterate through users, getting all completed (and not cancelled)
-        # games, sorted by date. Iterate through the games and calculate
-        # number of consecutive wins to determine user's longest win streak.
-        all_users = User.query()
-        for user in all_users:
-            curr_streak = 0
-            longest_streak = 0
-            all_games = Game.query()\
-                .filter(Game.game_over == True)\
-                .filter(Game.cancelled == False)\
-                .filter(Game.user == user.key).order(-Game.date)
-            for game in all_games:
-                if game.won:
-                    curr_streak += 1
-                    if curr_streak >= longest_streak:
-                        longest_streak = curr_streak
-                else:
-                    curr_streak = 0
-            user.longest_win_streak = longest_streak
-            user.put()
-        all_users = User.query().order(-User.longest_win_streak)
-        return UserScoreForms(scores=[user.to_score_form() for user in all_users])
-
+        """Return player high scores in the format of longest win streak,
+        over all time or over the current day or week."""
+        # Win streaks are maintained on each User, and on their buckets of
+        # the current day and week, as games end (see Game.save_moves), so
+        # this is a single ordered query. Pages are cached for the current
+        # leaderboard version.
+        scope, query = _leaderboard_query(request.period, 'longest_win_streak')
+        etag = '{}:{}'.format(User.get_leaderboard_version(), scope)
+
+        def _build():
+            """Query a page of the high scores."""
+            entries, next_page_token = fetch_page(query, request.limit, request.page_token)
+            return UserScoreForms(scores=[entry.to_score_form() for entry in entries],
+                                  next_page_token=next_page_token,
+                                  etag=etag)
+        form = get_cached_message('high_scores:{}:{}:{}'.format(etag, request.limit,
+                                                                request.page_token),
+                                  UserScoreForms, _build, LEADERBOARD_CACHE_TIME)
+        form.not_modified = request.etag == form.etag
+        return form
 
 
     #-------------------------------------------------------------------
     # get_user_rankings
     #-------------------------------------------------------------------
-    @endpoints.method(response_message=UserRankingForms,
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=UserRankingForms,
                       path='user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrument
     def get_user_rankings(self, request):
-        """Return player rankings based on winning percentage."""
-        # Iterate through users, getting count of completed (not cancelled)
-        # games as well as count of games won. Use these to determine the
-        # user's win percentage.
-        all_users = User.query()
-        for user in all_users:
-            total_games = Game.query()\
-                .filter(Game.game_over == True)\
-                .filter(Game.cancelled == False)\
-                .filter(Game.user == user.key).count()
-            wins = Game.query()\
-                .filter(Game.game_over == True)\
-                .filter(Game.cancelled == False)\
-                .filter(Game.user == user.key)\
-                .filter(Game.won == True).count()
-            win_percentage = float(wins / total_games) if total_games > 0 else 0.00
-            user.total_games = total_games
-            user.wins = wins
-            user.win_percentage = win_percentage
-            user.put()
-        all_users = User.query().order(-User.win_percentage)
-        return UserRankingForms(rankings=[user.to_rank_form() for user in all_users])
+        """Return player rankings based on winning percentage, over all time
+        or over the current day or week."""
+        # Total games, wins and win percentage are maintained on each User,
+        # and on their buckets of the current day and week, as games end (see
+        # Game.save_moves), so this is a single ordered query. Pages are
+        # cached for the current leaderboard version.
+        scope, query = _leaderboard_query(request.period, 'win_percentage')
+        etag = '{}:{}'.format(User.get_leaderboard_version(), scope)
+
+        def _build():
+            """Query a page of the user rankings."""
+            entries, next_page_token = fetch_page(query, request.limit, request.page_token)
+            return UserRankingForms(rankings=[entry.to_rank_form() for entry in entries],
+                                    next_page_token=next_page_token,
+                                    etag=etag)
+        form = get_cached_message('user_rankings:{}:{}:{}'.format(etag, request.limit,
+                                                                  request.page_token),
+                                  UserRankingForms, _build, LEADERBOARD_CACHE_TIME)
+        form.not_modified = request.etag == form.etag
+        return form
 
 
     #-------------------------------------------------------------------
     # get_game_history
     #-------------------------------------------------------------------
-    @endpoints.method(request_message=GET_GAME_REQUEST,
-                      response_message=StringMessage,
+    @endpoints.method(request_message=GET_GAME_HISTORY_REQUEST,
+                      response_message=GameHistoryForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrument
     def get_game_history(self, request):
-        """Return a history of moves for game."""
+        """Return a history of moves for game, or of only the last moves if
+        specified."""
+        if request.last is not None and request.last < 1:
+            raise endpoints.BadRequestException('Invalid last')
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
-        return game.to_history_form()
+        form = get_cached_message('history:{}:{}:{}'.format(request.urlsafe_game_key,
+                                                            game.version, request.last),
+                                  GameHistoryForm,
+                                  lambda: game.to_history_form(request.last))
+        form.not_modified = request.etag == form.etag
+        return form
+
+
+    #-------------------------------------------------------------------
+    # get_stats
+    #-------------------------------------------------------------------
+    @endpoints.method(response_message=StatsForm,
+                      path='stats',
+                      name='get_stats',
+                      http_method='GET')
+    @instrument
+    def get_stats(self, request):
+        """Return global game stats."""
+        # Stats are precomputed by the stats task as games end (see
+        # Stats.schedule_update), so this is a single cached read. Win, loss
+        # and draw totals are read from cached sharded counters.
+        return Stats.get_current().to_form()
+
+
+    #-------------------------------------------------------------------
+    # get_analytics
+    #-------------------------------------------------------------------
+    @endpoints.method(request_message=ANALYTICS_REQUEST,
+                      response_message=AnalyticsForm,
+                      path='analytics',
+                      name='get_analytics',
+                      http_method='GET')
+    @instrument
+    def get_analytics(self, request):
+        """Return the game history analytics computed offline, with those of
+        a user if a username is given."""
+        # The analytics are computed from an export by analytics.py and
+        # imported as entities, so this only reads them.
+        summary_future = AnalyticsSummary.get_by_id_async(AnalyticsSummary.ID)
+        user_analytics = None
+        if request.username:
+            user_analytics = UserAnalytics.key_for(ndb.Key(User, request.username)).get()
+        summary = summary_future.get_result()
+        if not summary:
+            raise endpoints.NotFoundException('No analytics have been imported yet!')
+        return summary.to_form(user_analytics)
+
+
+    #-------------------------------------------------------------------
+    # get_perf_stats
+    #-------------------------------------------------------------------
+    @endpoints.method(response_message=PerfStatsForms,
+                      path='perf_stats',
+                      name='get_perf_stats',
+                      http_method='GET')
+    @instrument
+    def get_perf_stats(self, request):
+        """Return performance stats of each endpoint and handler over their
+        most recent requests. Admin only."""
+        require_admin()
+        return PerfStatsForms(stats=[PerfStatsForm(**summary)
+                                     for summary in get_summaries()])
 
 
 api = endpoints.api_server([RockPaperScissorsApi])
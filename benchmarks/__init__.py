@@ -0,0 +1,6 @@
+"""benchmarks - Load tests and benchmarks against the local App Engine stubs.
+
+Boots the API and the task and cron handlers on the testbed datastore,
+memcache, taskqueue and mail stubs, seeds a parametric dataset and drives a
+mixed workload through them, reporting throughput, latency percentiles and
+RPC counts per operation as JSON. See run.py for usage."""
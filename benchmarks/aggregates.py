@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+"""aggregates.py - Benchmark the offline analytics of analytics.py.
+
+Writes a synthetic export of the given number of games of packed moves, as
+gzip-compressed NDJSON chunks in a temporary directory, then analyzes it.
+Prints a JSON report of the time, throughput and peak memory of the
+analysis, and of whether its aggregates match those counted while the
+games were generated. Packed histories are generated with NumPy, so the
+first game of each chunk is also checked against packing.PackedMoves.
+Needs NumPy, but not App Engine. Run from the repository root (the
+defaults generate 100M moves):
+
+    python -m benchmarks.aggregates --games 5000000 --moves 20"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import analytics
+from packing import PackedMoves, bits_per_move
+from rules import get_rules
+from strategies import STRATEGIES
+
+CHUNK_SIZE = 500
+PVP_FRACTION = 0.05
+
+
+def max_rss_mb():
+    """Returns the peak resident memory of the process so far, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def pack(indexes, bits):
+    """Returns the packed move history of each row of the given matrix of
+    Rules indexes, as PackedMoves would store it."""
+    games, moves = indexes.shape
+    stream = (indexes[:, :, np.newaxis] >> np.arange(bits)) & 1
+    stream = stream.reshape(games, moves * bits).astype(np.uint8)
+    padding = -stream.shape[1] % 8
+    stream = np.hstack([stream, np.zeros((games, padding), dtype=np.uint8)])
+    # Least significant bit first within each byte.
+    return np.packbits(stream.reshape(games, -1, 8)[:, :, ::-1], axis=2).reshape(games, -1)
+
+
+class Generator(object):
+    """Writes chunks of synthetic games, counting the aggregates that the
+    analysis is expected to find."""
+
+    def __init__(self, users, moves, variant):
+        self.users = users
+        self.moves = moves
+        self.rules = get_rules(variant)
+        self.strategies = sorted(name for name in STRATEGIES)
+        self.expected = {'play_counts': {}, 'ai_play_counts': {}, 'first_play_counts': {},
+                         'ai_games': 0, 'ai_wins': 0}
+        self.games = 0
+        self.mismatches = 0
+
+    def _count(self, name, codes):
+        """Adds the occurrences of the given play codes to an expected
+        count."""
+        counts = self.expected[name]
+        for play, count in zip(self.rules.plays, np.bincount(codes, minlength=self.rules.size)):
+            if count:
+                counts[play] = counts.get(play, 0) + int(count)
+
+    def write_chunk(self, path, games):
+        """Writes a chunk of the given number of games."""
+        size = self.rules.size
+        plays = np.random.randint(size, size=(games, self.moves))
+        ai_plays = np.random.randint(size, size=(games, self.moves))
+        packed = pack(plays * size + ai_plays, bits_per_move(size))
+        pvp = np.random.random(games) < PVP_FRACTION
+        over = np.random.random(games) < 0.9
+        won = np.random.random(games) < 0.5
+        users = np.random.randint(self.users, size=games)
+        self._count('play_counts', plays.ravel())
+        self._count('play_counts', ai_plays[pvp].ravel())
+        self._count('ai_play_counts', ai_plays[~pvp].ravel())
+        self._count('first_play_counts', plays[:, 0])
+        self._count('first_play_counts', ai_plays[pvp, 0])
+        self.expected['ai_games'] += int((over & ~pvp).sum())
+        self.expected['ai_wins'] += int((over & ~pvp & ~won).sum())
+
+        reference = PackedMoves(size, self.moves, packed[0].tobytes())
+        if list(reference.indexes()) != list(plays[0] * size + ai_plays[0]):
+            self.mismatches += 1
+
+        with gzip.open(path, 'wb') as out:
+            for index in range(games):
+                self.games += 1
+                properties = {
+                    'user': ['User', 'user{}'.format(users[index])],
+                    'opponent': (['User', 'user{}'.format((users[index] + 1) % self.users)]
+                                 if pvp[index] else None),
+                    'date': '2016-05-02T10:{:02d}:{:02d}.{:06d}'.format(
+                        self.games // 60000000 % 60, self.games // 1000000 % 60,
+                        self.games % 1000000),
+                    'game_over': bool(over[index]),
+                    'won': bool(won[index]),
+                    'cancelled': False,
+                    'variant': self.rules.variant,
+                    'strategy': (None if pvp[index] else
+                                 self.strategies[index % len(self.strategies)]),
+                    'move_count': self.moves,
+                    'move_data': base64.b64encode(packed[index].tobytes()).decode('ascii'),
+                    'moves': [],
+                }
+                out.write((json.dumps({'key': ['Game', self.games], 'properties': properties},
+                                      separators=(',', ':'), sort_keys=True) + '\n')
+                          .encode('utf-8'))
+
+
+def main():
+    """Run the benchmark and print its report."""
+    parser = argparse.ArgumentParser(description='Benchmark the offline analytics.')
+    parser.add_argument('--games', type=int, default=5000000, help='games to generate')
+    parser.add_argument('--moves', type=int, default=20, help='moves per game')
+    parser.add_argument('--users', type=int, default=100000, help='users playing the games')
+    parser.add_argument('--variant', default=None, help='game variant of the games')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    directory = tempfile.mkdtemp()
+    try:
+        generator = Generator(args.users, args.moves, args.variant)
+        start = time.time()
+        paths = []
+        for number, offset in enumerate(range(0, args.games, CHUNK_SIZE), 1):
+            paths.append(os.path.join(directory, 'chunk-{:06d}.ndjson.gz'.format(number)))
+            generator.write_chunk(paths[-1], min(CHUNK_SIZE, args.games - offset))
+        generate_time = time.time() - start
+        export_bytes = sum(os.path.getsize(path) for path in paths)
+
+        rss_before = max_rss_mb()
+        start = time.time()
+        result = analytics.analyze(paths)
+        analyze_time = time.time() - start
+        ai_games, ai_wins, _, per_user = result.ai_win_rates()
+        streaks = result.streak_lengths()
+        total_time = time.time() - start
+        found = {'play_counts': result.play_counts,
+                 'ai_play_counts': result.ai_play_counts,
+                 'first_play_counts': result.first_play_counts,
+                 'ai_games': ai_games, 'ai_wins': ai_wins}
+        report = {
+            'games': result.games,
+            'moves': result.moves,
+            'chunks': len(paths),
+            'export_mb': export_bytes / 1048576.0,
+            'generate_sec': generate_time,
+            'load_and_count_sec': analyze_time,
+            'total_sec': total_time,
+            'moves_per_sec': result.moves / total_time if total_time else 0,
+            'max_rss_growth_mb': max_rss_mb() - rss_before,
+            'users': len(per_user),
+            'streaks': sum(streaks),
+            'longest_streak': len(streaks),
+            'packing_mismatches': generator.mismatches,
+            'matching': dict((name, found[name] == expected)
+                             for name, expected in generator.expected.items()),
+        }
+    finally:
+        shutil.rmtree(directory)
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
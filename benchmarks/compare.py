@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+"""compare.py - Compare two benchmark reports written by run.py.
+
+Prints, for each operation, the latency percentiles and datastore RPCs per
+operation of both reports and their relative change:
+
+    python -m benchmarks.compare before.json after.json"""
+
+import argparse
+import json
+
+
+def change(before, after):
+    """Returns the relative change from before to after as a string."""
+    if not before:
+        return 'n/a'
+    return '{:+.1%}'.format((after - before) / float(before))
+
+
+def main():
+    """Print the comparison of two reports."""
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+
+    print '{} -> {}'.format(before.get('revision'), after.get('revision'))
+    print '{:<20} {:<14} {:>10} {:>10} {:>8}'.format('operation', 'metric',
+                                                    'before', 'after', 'change')
+    for name in sorted(set(before['operations']) | set(after['operations'])):
+        old = before['operations'].get(name)
+        new = after['operations'].get(name)
+        if not old or not new:
+            print '{:<20} {}'.format(name, 'only in one report')
+            continue
+        rows = [(metric, old['latency_ms'][metric], new['latency_ms'][metric])
+                for metric in ('p50', 'p95', 'p99')]
+        rows.append(('datastore_rpcs', sum(old['datastore_rpcs'].values()),
+                     sum(new['datastore_rpcs'].values())))
+        for metric, old_value, new_value in rows:
+            print '{:<20} {:<14} {:>10.2f} {:>10.2f} {:>8}'.format(
+                name, metric, old_value, new_value, change(old_value, new_value))
+
+
+if __name__ == '__main__':
+    main()
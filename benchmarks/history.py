@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""history.py - Benchmark the allocations of serializing a game's move
+history.
+
+For each number of moves, builds a game in memory and prints a JSON report
+of the objects allocated and the latency of rendering its history: in full
+and for only its last moves with to_history_form, and with the serializer
+used before, which replaced each inline Move by its dictionary and joined
+their strings into a single StringMessage. Objects are counted as the
+growth of gc.get_objects() over a call, with the collector disabled, so
+only container objects (lists, dicts, messages, entities) are counted, not
+strings. Run from the repository root, with the App Engine SDK on the
+PYTHONPATH:
+
+    python -m benchmarks.history --moves 10 100 1000 --last 10"""
+
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+
+from benchmarks.stubs import Stubs
+
+
+def old_history_form(game):
+    """Returns the history of the game as the previous to_history_form did,
+    from its inline Moves. The previous version replaced the Moves in place;
+    this one works on a copy of the list, so that it can be called again."""
+    from models import StringMessage
+    moves = list(game.moves)
+    for index, move in enumerate(moves):
+        moves[index] = move.to_dict()
+    return StringMessage(message=', '.join(map(str, moves)))
+
+
+def build_game(count):
+    """Returns a game of the given number of random moves, held in its
+    inline history as the previous serializer read them."""
+    from google.appengine.ext import ndb
+    from models import User, Game, Move
+    game = Game(id=1, user=ndb.Key(User, 'user'))
+    game_rules = game.get_rules()
+    for _ in range(count):
+        play, ai_play = random.randrange(game_rules.size), random.randrange(game_rules.size)
+        game.moves.append(Move(play=game_rules.plays[play], ai_play=game_rules.plays[ai_play],
+                               result=game_rules.resolve(play, ai_play)[1]))
+    return game
+
+
+def allocations(render, game):
+    """Renders the game, and returns the number of objects allocated and
+    kept alive by the call, and its latency."""
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        start = time.time()
+        result = render(game)
+        elapsed = (time.time() - start) * 1000
+        allocated = len(gc.get_objects()) - before
+    finally:
+        gc.enable()
+    del result
+    return allocated, elapsed
+
+
+def measure(count, calls, last):
+    """Returns the report of each serializer for the number of moves given."""
+    import perf
+    game = build_game(count)
+    renders = {'full': lambda game: game.to_history_form(),
+               'last': lambda game: game.to_history_form(last),
+               'old_string': old_history_form}
+    report = {}
+    for name, render in sorted(renders.items()):
+        samples = [allocations(render, game) for _ in range(calls)]
+        latencies = sorted(sample[1] for sample in samples)
+        report[name] = {'objects': float(sum(sample[0] for sample in samples)) / calls,
+                        'latency_ms': {'mean': sum(latencies) / calls,
+                                       'p50': perf.percentile(latencies, 50),
+                                       'p95': perf.percentile(latencies, 95)}}
+    return report
+
+
+def main():
+    """Run the benchmark and print its report."""
+    parser = argparse.ArgumentParser(description='Benchmark move history allocations.')
+    parser.add_argument('--moves', type=int, nargs='+', default=[10, 100, 1000],
+                        help='numbers of moves in the game')
+    parser.add_argument('--last', type=int, default=10, help='moves of the last history')
+    parser.add_argument('--calls', type=int, default=50, help='calls per serializer')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stubs = Stubs()
+    stubs.activate()
+    try:
+        report = dict((str(count), measure(count, args.calls, args.last))
+                      for count in args.moves)
+    finally:
+        stubs.deactivate()
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""listing.py - Benchmark the paged list and leaderboard endpoints against
+the size of the tables.
+
+Seeds each of the given numbers of games, spread over users with a fixed
+number of games each, and prints a JSON report of the latency percentiles
+and RPCs of the first page of get_games, get_users, get_high_scores and
+get_user_rankings for each. Caches are flushed before every call, so cached
+leaderboards do not hide the cost of a page. Run from the repository root,
+with the App Engine SDK on the PYTHONPATH:
+
+    python -m benchmarks.listing --games 1000 10000 50000 --games-per-user 10"""
+
+import argparse
+import json
+import random
+import sys
+
+from benchmarks.stubs import Stubs
+
+ENDPOINTS = ('get_games', 'get_users', 'get_high_scores', 'get_user_rankings')
+
+
+def measure(games, games_per_user, calls):
+    """Seeds the given number of games, and returns the report of the given
+    number of uncached calls of each listing endpoint."""
+    stubs = Stubs()
+    stubs.activate()
+    try:
+        from google.appengine.api import memcache
+        from google.appengine.ext import ndb
+        from benchmarks import workload
+        users = max(1, games // games_per_user)
+        usernames, open_games = workload.seed(users, games_per_user, 1)
+        runner = workload.Workload(stubs, usernames, open_games)
+        for _ in range(calls):
+            for name in ENDPOINTS:
+                memcache.flush_all()
+                ndb.get_context().clear_cache()
+                runner.measure(name, getattr(runner, name))
+        report = runner.report()
+        return dict((name, {'latency_ms': report[name]['latency_ms'],
+                            'datastore_rpcs': report[name]['datastore_rpcs']})
+                    for name in ENDPOINTS)
+    finally:
+        stubs.deactivate()
+
+
+def main():
+    """Run the benchmark and print its report."""
+    parser = argparse.ArgumentParser(description='Benchmark the list endpoints.')
+    parser.add_argument('--games', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='numbers of games to seed')
+    parser.add_argument('--games-per-user', type=int, default=10,
+                        help='games of each seeded user')
+    parser.add_argument('--calls', type=int, default=50, help='calls per endpoint and size')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = dict((str(games), measure(games, args.games_per_user, args.calls))
+                  for games in args.games)
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
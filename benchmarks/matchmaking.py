@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""matchmaking.py - Concurrency run of matchmaking and player-vs-player play.
+
+Seeds the given number of players with random win percentages, has them all
+join the matchmaking pool in random order (running the pairing tasks every
+so many joins), then plays every matched game to its end with both players
+of each round submitting their plays at the same time from separate
+threads. Prints a JSON report of join latency and RPCs, of how players were
+paired, and of the play latency and conflicts, and checks that no player was
+paired twice and no play was lost: every round in which both players' plays
+were accepted must be saved as exactly one move. Rounds in which a player
+gave up after MAX_TRIES conflicts end their game, and are only counted.
+tests/test_matchmaking.py runs a smaller simulation and asserts these
+checks. Run from the repository root, with the App Engine SDK on the
+PYTHONPATH:
+
+    python -m benchmarks.matchmaking --players 2000 --threads 20"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from benchmarks.stubs import Stubs
+
+MAX_ROUNDS = 50
+MAX_TRIES = 5
+
+
+def percentiles(samples):
+    """Returns the mean and percentiles of the given latencies."""
+    import perf
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return {'mean': sum(samples) / len(samples),
+            'p50': perf.percentile(samples, 50),
+            'p95': perf.percentile(samples, 95),
+            'p99': perf.percentile(samples, 99)}
+
+
+def seed(players):
+    """Stores the given number of users, with random stats. Returns their
+    usernames."""
+    from google.appengine.ext import ndb
+    from models import User
+    usernames = ['player{}'.format(i) for i in range(players)]
+    users = []
+    for username in usernames:
+        total = random.randint(0, 50)
+        wins = random.randint(0, total)
+        users.append(User(id=username, username=username, display_name=username.title(),
+                          email='{}@example.com'.format(username), total_games=total,
+                          wins=wins, win_percentage=float(wins) / total if total else 0.0))
+    for index in range(0, len(users), 500):
+        ndb.put_multi(users[index:index + 500])
+    return usernames
+
+
+def join_all(stubs, service, usernames, tasks_every):
+    """Has every user join the pool, running the queued pairing tasks every
+    given number of joins and once all have joined. Returns the join
+    latencies, the datastore RPCs per join and the number of users paired
+    when they joined."""
+    import api
+    import main
+    import perf
+    latencies, rpcs = [], defaultdict(int)
+    paired_inline = 0
+    for number, username in enumerate(usernames, 1):
+        request = api.JoinQueueForm(username=username, any_skill=random.random() < 0.1)
+        start = time.time()
+        with perf.recording() as record:
+            form = service.join_queue(request)
+        latencies.append((time.time() - start) * 1000)
+        for call, calls in record.datastore.items():
+            rpcs[call] += calls
+        if form.status == 'matched':
+            paired_inline += 1
+        if number % tasks_every == 0:
+            stubs.run_tasks(main.app)
+    stubs.run_tasks(main.app)
+    return latencies, dict((call, float(calls) / len(usernames))
+                           for call, calls in sorted(rpcs.items())), paired_inline
+
+
+def play_round(service, game_key, usernames, results):
+    """Submits one play of each of the given players of a game at the same
+    time, each from its own thread, retrying a play on conflict. Appends
+    the latency and outcome of each play to the given results. Returns
+    whether every player's play was accepted."""
+    import api
+    import endpoints
+    accepted = []
+
+    def _play(username):
+        """Submit one play until it is accepted or MAX_TRIES conflicts."""
+        for _ in range(MAX_TRIES):
+            request = api.MAKE_PLAY_REQUEST.combined_message_class(
+                urlsafe_game_key=game_key, username=username,
+                play=random.choice(['rock', 'paper', 'scissors']))
+            start = time.time()
+            try:
+                service.make_play(request)
+                results.append(((time.time() - start) * 1000, 'ok'))
+                accepted.append(username)
+                return
+            except endpoints.ServiceException:
+                results.append(((time.time() - start) * 1000, 'conflict'))
+    threads = [threading.Thread(target=_play, args=(username,)) for username in usernames]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(accepted) == len(usernames)
+
+
+def play_game(service, game_key, results, lost, gave_up):
+    """Plays a matched game to its end, or for MAX_ROUNDS rounds, and
+    counts the rounds that were not saved as exactly one move. A round in
+    which a player gave up is not checked, and ends the game."""
+    from google.appengine.ext import ndb
+    from models import Game
+    key = ndb.Key(urlsafe=game_key)
+    game = key.get(use_cache=False)
+    usernames = Game.get_usernames([game])
+    players = [usernames[player] for player in game.players()]
+    for _ in range(MAX_ROUNDS):
+        before = game.get_move_count()
+        if not play_round(service, game_key, players, results):
+            gave_up.append(game_key)
+            return
+        game = key.get(use_cache=False)
+        if game.get_move_count() != before + 1 or game.sealed_play is not None\
+                or game.sealed_opponent_play is not None:
+            lost.append(game_key)
+        if game.game_over:
+            return
+
+
+def play_all(service, game_keys, threads):
+    """Plays all the given games, the given number of games at a time.
+    Returns the play results, the games with lost moves, the games a
+    player gave up and the elapsed time."""
+    results, lost, gave_up = [], [], []
+    pending = list(game_keys)
+    lock = threading.Lock()
+
+    def _worker():
+        """Play games until none are left."""
+        while True:
+            with lock:
+                if not pending:
+                    return
+                game_key = pending.pop()
+            play_game(service, game_key, results, lost, gave_up)
+    start = time.time()
+    workers = [threading.Thread(target=_worker) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results, lost, gave_up, time.time() - start
+
+
+def double_paired(entries):
+    """Returns the number of players paired into more than one game: as a
+    player of any of the player-vs-player games, or by the game of their
+    given MatchRequest."""
+    from models import Game
+    players = defaultdict(set)
+    for game in Game.query().fetch():
+        if not game.opponent:
+            continue
+        for player in game.players():
+            players[player].add(game.key)
+    for entry in entries:
+        if entry.game:
+            players[entry.user].add(entry.game)
+    return len([player for player, keys in players.items() if len(keys) > 1])
+
+
+def simulate(stubs, players, tasks_every, threads):
+    """Runs the simulation on the given active stubs. Returns its report."""
+    import api
+    from models import MatchRequest
+    service = api.RockPaperScissorsApi()
+    usernames = seed(players)
+    random.shuffle(usernames)
+    join_ms, join_rpcs, paired_inline = join_all(stubs, service, usernames, tasks_every)
+    entries = MatchRequest.query().fetch()
+    game_keys = sorted(set(entry.game.urlsafe() for entry in entries if entry.game))
+    results, lost, gave_up, elapsed = play_all(service, game_keys, threads)
+    return {
+        'players': players,
+        'join_latency_ms': percentiles(join_ms),
+        'join_datastore_rpcs': join_rpcs,
+        'paired_inline': paired_inline,
+        'paired_by_worker': len([entry for entry in entries if entry.game]) - paired_inline,
+        'unpaired': len([entry for entry in entries if entry.waiting]),
+        'double_paired': double_paired(entries),
+        'games': len(game_keys),
+        'plays': len(results),
+        'play_conflicts': len([result for result in results if result[1] != 'ok']),
+        'play_latency_ms': percentiles([result[0] for result in results]),
+        'plays_per_sec': len(results) / elapsed if elapsed else 0,
+        'games_with_lost_moves': len(set(lost)),
+        'games_given_up': len(set(gave_up)),
+    }
+
+
+def main():
+    """Run the simulation and print its report."""
+    parser = argparse.ArgumentParser(description='Simulate matchmaking and concurrent play.')
+    parser.add_argument('--players', type=int, default=2000, help='players joining the pool')
+    parser.add_argument('--tasks-every', type=int, default=50,
+                        help='joins between runs of the pairing tasks')
+    parser.add_argument('--threads', type=int, default=20, help='games played at a time')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stubs = Stubs()
+    stubs.activate()
+    try:
+        report = simulate(stubs, args.players, args.tasks_every, args.threads)
+    finally:
+        stubs.deactivate()
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""moves.py - Benchmark the storage of a game's move history against the
+number of moves, with the moves stored as child Move entities (as before
+they were packed) and packed into the game.
+
+For each layout and number of moves, prints a JSON report of the stored
+size of the game and its moves, of the latency of getting the game and
+rendering it in full, and of rendering the history of its last moves, and
+of the latency and size of the write that stores one more move. Run
+from the repository root, with the App Engine SDK on the PYTHONPATH:
+
+    python -m benchmarks.moves --moves 10 100 1000 --last 10"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.stubs import Stubs
+
+
+def percentiles(samples):
+    """Returns the mean and percentiles of the given latencies."""
+    import perf
+    samples = sorted(samples)
+    return {'mean': sum(samples) / len(samples),
+            'p50': perf.percentile(samples, 50),
+            'p95': perf.percentile(samples, 95)}
+
+
+def store_game(count, packed):
+    """Stores a game of the given number of moves, in the packed or the
+    child entity layout. Returns its key and its stored size in bytes."""
+    from google.appengine.ext import ndb
+    from models import User, Game, Move
+    from packing import PackedMoves
+    game = Game(user=ndb.Key(User, 'user'), date=datetime.today(),
+                move_count=count)
+    game.put()
+    game_rules = game.get_rules()
+    moves = PackedMoves(game_rules.size)
+    children = []
+    for number in range(1, count + 1):
+        play, ai_play = random.randrange(game_rules.size), random.randrange(game_rules.size)
+        moves.append(play, ai_play)
+        children.append(Move(parent=game.key, id=number, play=game_rules.plays[play],
+                             ai_play=game_rules.plays[ai_play],
+                             result=game_rules.resolve(play, ai_play)[1]))
+    if packed:
+        game.move_data = moves.tostring()
+        children = []
+    entities = [game] + children
+    ndb.put_multi(entities)
+    return game.key, sum(len(entity._to_pb().Encode()) for entity in entities)
+
+
+def measure(count, packed, calls, last):
+    """Returns the report of the layout and number of moves given."""
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    key, size = store_game(count, packed)
+    form_ms, history_ms = [], []
+    renders = [(form_ms, lambda game: game.to_form(usernames={game.user: 'user'})),
+               (history_ms, lambda game: game.to_history_form(last))]
+    for _ in range(calls):
+        for samples, render in renders:
+            ndb.get_context().clear_cache()
+            memcache.flush_all()
+            start = time.time()
+            render(key.get())
+            samples.append((time.time() - start) * 1000)
+    put_ms, put_bytes = [], []
+    for _ in range(calls):
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        game = key.get()
+        start = time.time()
+        # A tie, so the game goes on; appending it repacks a packed history.
+        move = game.apply_play(0, 0)
+        game.save_moves([move])
+        put_ms.append((time.time() - start) * 1000)
+        put_bytes.append(sum(len(entity._to_pb().Encode())
+                             for entity in [game] + game._moves_to_put([move])))
+    return {'stored_bytes': size,
+            'get_form_ms': percentiles(form_ms),
+            'get_history_last_ms': percentiles(history_ms),
+            'put_move_ms': percentiles(put_ms),
+            'put_move_bytes': sum(put_bytes) / len(put_bytes)}
+
+
+def main():
+    """Run the benchmark and print its report."""
+    parser = argparse.ArgumentParser(description='Benchmark move history storage.')
+    parser.add_argument('--moves', type=int, nargs='+', default=[10, 100, 1000],
+                        help='numbers of moves per game')
+    parser.add_argument('--last', type=int, default=10,
+                        help='number of last moves in the history rendered')
+    parser.add_argument('--calls', type=int, default=20, help='calls per measurement')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stubs = Stubs()
+    stubs.activate()
+    try:
+        report = dict((str(count), {
+            'child_entities': measure(count, False, args.calls, args.last),
+            'packed': measure(count, True, args.calls, args.last),
+        }) for count in args.moves)
+    finally:
+        stubs.deactivate()
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
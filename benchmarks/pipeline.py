@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""pipeline.py - End-to-end run of the export and import pipeline.
+
+Seeds a synthetic dataset of users x games, runs an export job through its
+tasks, then downloads every chunk and imports it into another namespace
+through the application's handlers. Prints a JSON report of the time,
+throughput and size of both, and of whether the imported entities match the
+exported ones. Run from the repository root, with the App Engine SDK on the
+PYTHONPATH (the defaults seed a million games):
+
+    python -m benchmarks.pipeline --users 10000 --games 100 --moves 5"""
+
+import argparse
+import json
+import random
+import resource
+import sys
+import time
+
+from benchmarks.stubs import Stubs
+
+NAMESPACE = 'import'
+
+
+def max_rss_mb():
+    """Returns the peak resident memory of the process so far, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def verify(kinds, samples):
+    """Returns, for each kind, the number of entities exported and imported,
+    and whether a random sample of the imported entities match the exported
+    ones (but for the version of Games, incremented when imported)."""
+    from google.appengine.ext import ndb
+    report = {}
+    for kind in kinds:
+        exported = ndb.Query(kind=kind).count()
+        imported = ndb.Query(kind=kind, namespace=NAMESPACE).count()
+        keys = ndb.Query(kind=kind).fetch(samples * 10, keys_only=True)
+        sample = random.sample(keys, min(samples, len(keys)))
+        matches = 0
+        for key in sample:
+            original = key.get().to_dict(exclude=['version'])
+            copy = ndb.Key(flat=key.flat(), namespace=NAMESPACE).get()
+            if copy and copy.to_dict(exclude=['version']) == _in_namespace(original):
+                matches += 1
+        report[kind] = {'exported': exported, 'imported': imported,
+                        'sampled': len(sample), 'matching': matches}
+    return report
+
+
+def _in_namespace(values):
+    """Returns the given property values with their keys moved to the
+    import namespace."""
+    from google.appengine.ext import ndb
+
+    def _move(value):
+        """Move a single value."""
+        if isinstance(value, ndb.Key):
+            return ndb.Key(flat=value.flat(), namespace=NAMESPACE)
+        if isinstance(value, list):
+            return [_move(item) for item in value]
+        if isinstance(value, dict):
+            return dict((name, _move(item)) for name, item in value.items())
+        return value
+    return _move(values)
+
+
+def main():
+    """Run the pipeline and print its report."""
+    parser = argparse.ArgumentParser(description='Run the export and import pipeline.')
+    parser.add_argument('--users', type=int, default=10000, help='users to seed')
+    parser.add_argument('--games', type=int, default=100, help='games to seed per user')
+    parser.add_argument('--moves', type=int, default=5, help='moves to seed per game')
+    parser.add_argument('--samples', type=int, default=100,
+                        help='entities per kind compared after the import')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    stubs = Stubs()
+    stubs.activate()
+    try:
+        import webapp2
+        import main as application
+        from benchmarks import workload
+        from export import ExportJob, KINDS
+
+        start = time.time()
+        workload.seed(args.users, args.games, args.moves)
+        seed_sec = time.time() - start
+        seed_rss = max_rss_mb()
+
+        start = time.time()
+        webapp2.Request.blank('/tasks/export').get_response(application.app)
+        stubs.run_tasks(application.app, max_rounds=sys.maxint)
+        export_sec = time.time() - start
+        job = ExportJob.query().get()
+        export_rss = max_rss_mb()
+
+        start = time.time()
+        compressed = 0
+        for number in range(1, job.chunks + 1):
+            download = webapp2.Request.blank('/tasks/export_chunk?job={}&chunk={}'.format(
+                job.key.id(), number)).get_response(application.app)
+            compressed += len(download.body)
+            upload = webapp2.Request.blank('/tasks/import_chunk?namespace=' + NAMESPACE)
+            upload.method = 'POST'
+            upload.body = download.body
+            upload.get_response(application.app)
+        import_sec = time.time() - start
+        exported = sum(job.counts.values())
+
+        report = {
+            'config': vars(args),
+            'seed_sec': seed_sec,
+            'export': {'done': job.done, 'chunks': job.chunks, 'entities': job.counts,
+                       'compressed_bytes': compressed, 'sec': export_sec,
+                       'entities_per_sec': exported / export_sec,
+                       'peak_rss_growth_mb': export_rss - seed_rss},
+            'import': {'sec': import_sec, 'entities_per_sec': exported / import_sec,
+                       'peak_rss_growth_mb': max_rss_mb() - export_rss},
+            'verify': verify(KINDS, args.samples),
+        }
+    finally:
+        stubs.deactivate()
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
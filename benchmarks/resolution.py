@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""resolution.py - Benchmark resolving rounds of the classic game.
+
+Resolves the same random rounds with the if-chain make_play used before
+rules.py, with Rules.resolve one call per round, and with
+Rules.resolve_many for all rounds at once (also given arrays of plays
+with NumPy), and prints a JSON report of the
+resolutions per second of each, and of whether their outcomes agree.
+resolve_many is vectorized when NumPy is installed. Needs neither App
+Engine nor NumPy. Run from the repository root:
+
+    python -m benchmarks.resolution --rounds 1000000"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+import rules
+
+PLAYS = ['rock', 'paper', 'scissors']
+
+
+def if_chain(user_play, ai_play):
+    """Returns the outcome of a round of the given play names, as make_play
+    decided it before rules.py."""
+    if user_play == ai_play:
+        return rules.TIE
+    if user_play == 'scissors' and ai_play == 'paper' or\
+       user_play == 'rock' and ai_play == 'scissors' or\
+       user_play == 'paper' and ai_play == 'rock':
+        return rules.WIN
+    return rules.LOSE
+
+
+def timed(func):
+    """Returns the result of calling the given function and its duration in
+    seconds."""
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+
+def main():
+    """Run the benchmark and print its report."""
+    parser = argparse.ArgumentParser(description='Benchmark round resolution.')
+    parser.add_argument('--rounds', type=int, default=1000000, help='rounds to resolve')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    game_rules = rules.get_rules(rules.DEFAULT_VARIANT)
+    plays = [random.randrange(game_rules.size) for _ in range(args.rounds)]
+    ai_plays = [random.randrange(game_rules.size) for _ in range(args.rounds)]
+    names = [game_rules.plays[play] for play in plays]
+    ai_names = [game_rules.plays[play] for play in ai_plays]
+    resolve = game_rules.resolve
+
+    results = {
+        'if_chain': timed(lambda: [if_chain(play, ai_play)
+                                   for play, ai_play in zip(names, ai_names)]),
+        'resolve': timed(lambda: [resolve(play, ai_play)[0]
+                                  for play, ai_play in zip(plays, ai_plays)]),
+        'resolve_many': timed(lambda: game_rules.resolve_many(plays, ai_plays)),
+    }
+    if rules.numpy is not None:
+        # Simulations keep their plays in arrays, and skip the conversion.
+        play_array, ai_play_array = rules.numpy.array(plays), rules.numpy.array(ai_plays)
+        results['resolve_many_arrays'] = timed(
+            lambda: game_rules.resolve_many(play_array, ai_play_array))
+    expected = results['if_chain'][0]
+    report = {
+        'rounds': args.rounds,
+        'numpy': rules.numpy is not None,
+        'resolutions_per_sec': dict((name, args.rounds / elapsed if elapsed else 0)
+                                    for name, (_, elapsed) in results.items()),
+        'matching': dict((name, [int(outcome) for outcome in outcomes] == expected)
+                         for name, (outcomes, _) in results.items()),
+    }
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
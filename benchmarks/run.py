@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""run.py - Run a benchmark against the local App Engine stubs.
+
+Seeds a dataset of users x games x moves, runs a mixed workload over it and
+prints a JSON report of throughput, latency percentiles and RPC counts per
+operation. Run from the repository root, with the App Engine SDK on the
+PYTHONPATH:
+
+    python -m benchmarks.run --users 100 --games 20 --moves 5 \\
+        --operations 5000 --seed 1 --output before.json
+
+Pass --rpc-latency-ms to inject the latency of the production services into
+every RPC, so the benefit of RPCs made concurrently shows in the report.
+The report also measures the overhead of the perf.py instrumentation
+against perf.OVERHEAD_BUDGET_MS, and the run fails if it is over budget."""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks.stubs import Stubs, ROOT
+
+
+def git_revision():
+    """Returns the current git revision of the repository, if known."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """Run the benchmark and print or write its report."""
+    parser = argparse.ArgumentParser(description='Benchmark the API on the local stubs.')
+    parser.add_argument('--users', type=int, default=100, help='users to seed')
+    parser.add_argument('--games', type=int, default=20, help='games to seed per user')
+    parser.add_argument('--moves', type=int, default=5, help='moves to seed per game')
+    parser.add_argument('--open-fraction', type=float, default=0.2,
+                        help='fraction of seeded games left open')
+    parser.add_argument('--operations', type=int, default=5000,
+                        help='operations of the mixed workload to run')
+    parser.add_argument('--rpc-latency-ms', type=float, default=0,
+                        help='latency injected into every RPC, in milliseconds')
+    parser.add_argument('--overhead-calls', type=int, default=500,
+                        help='paired calls measuring the instrumentation overhead')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--output', help='file to write the JSON report to')
+    args = parser.parse_args()
+
+    # The application modules are imported once the stubs are active.
+    random.seed(args.seed)
+    stubs = Stubs(args.rpc_latency_ms)
+    stubs.activate()
+    try:
+        from benchmarks import workload
+        start = time.time()
+        usernames, open_games = workload.seed(args.users, args.games, args.moves,
+                                              args.open_fraction)
+        seed_time = time.time() - start
+        runner = workload.Workload(stubs, usernames, open_games)
+        elapsed = runner.run(args.operations)
+        overhead = runner.measure_overhead(args.overhead_calls)
+        report = {
+            'revision': git_revision(),
+            'config': vars(args),
+            'seed_sec': seed_time,
+            'elapsed_sec': elapsed,
+            'throughput_per_sec': args.operations / elapsed,
+            'operations': runner.report(),
+            'instrumentation': overhead,
+        }
+    finally:
+        stubs.deactivate()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+    if not overhead['within_budget']:
+        sys.exit('The instrumentation overhead is over its budget of {} ms.'.format(
+            overhead['budget_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""stubs.py - Local App Engine service stubs for the benchmarks."""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+import perf
+
+QUEUES = ['default', 'reminders', 'stats', 'export', 'matchmaking']
+
+
+class Latency(object):
+    """Injects a fixed latency into every API RPC, as the production
+    services would add. An RPC is not complete until the latency has passed
+    since it was made, so RPCs in flight together wait for it only once."""
+
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000.0
+        self.started = {}
+
+    def install(self):
+        """Installs the latency hooks on the current API proxy."""
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('latency', self.start)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('latency', self.finish)
+
+    def start(self, service, call, request, response, rpc):
+        """Record the time the RPC was made."""
+        self.started[id(rpc)] = time.time()
+
+    def finish(self, service, call, request, response, rpc):
+        """Wait out whatever is left of the latency of the RPC."""
+        started = self.started.pop(id(rpc), None)
+        if started is not None:
+            remaining = started + self.latency - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+
+
+class Stubs(object):
+    """Activates the testbed service stubs used by the application: a
+    strongly consistent datastore, memcache, the taskqueue (configured from
+    queue.yaml), mail and app identity. A latency in milliseconds may be
+    injected into every RPC."""
+
+    def __init__(self, rpc_latency_ms=0):
+        self.testbed = testbed.Testbed()
+        self.taskqueue = None
+        self.latency = Latency(rpc_latency_ms) if rpc_latency_ms else None
+
+    def activate(self):
+        """Activate the stubs."""
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_user_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        perf.install_hooks()
+        if self.latency:
+            self.latency.install()
+        ndb.get_context().clear_cache()
+
+    def deactivate(self):
+        """Deactivate the stubs, discarding all stored data."""
+        self.testbed.deactivate()
+
+    def run_tasks(self, app, max_rounds=100):
+        """Runs the queued tasks through the given WSGI application, until no
+        tasks are left (or for max_rounds rounds of tasks enqueued by other
+        tasks). Tasks are run whatever their ETA. Returns the number of tasks
+        run."""
+        count = 0
+        for _ in range(max_rounds):
+            tasks = []
+            for queue in QUEUES:
+                tasks.extend(self.taskqueue.get_filtered_tasks(queue_names=[queue]))
+                self.taskqueue.FlushQueue(queue)
+            if not tasks:
+                break
+            for task in tasks:
+                request = webapp2.Request.blank(task.url)
+                request.method = 'POST'
+                request.body = task.payload or ''
+                request.content_type = 'application/x-www-form-urlencoded'
+                request.get_response(app)
+                count += 1
+        return count
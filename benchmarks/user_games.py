@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""user_games.py - Benchmark listing a user's open games against the number
+of games in their history.
+
+Seeds a single user with each of the given numbers of games, about a fixed
+number of them open, and prints a JSON report of get_user_games latency and RPCs
+for each. Run from the repository root, with the App Engine SDK on the
+PYTHONPATH:
+
+    python -m benchmarks.user_games --games 100 1000 5000 --open 20"""
+
+import argparse
+import json
+import random
+import sys
+
+from benchmarks.stubs import Stubs
+
+
+def measure(history, open_games, calls):
+    """Seeds a user with the given numbers of games in their history and of
+    open games, and returns the report of the given number of calls of
+    get_user_games."""
+    stubs = Stubs()
+    stubs.activate()
+    try:
+        from benchmarks import workload
+        usernames, _ = workload.seed(1, history, 0, float(open_games) / history)
+        runner = workload.Workload(stubs, usernames, [])
+        for _ in range(calls):
+            runner.measure('get_user_games', runner.get_user_games)
+        return runner.report()['get_user_games']
+    finally:
+        stubs.deactivate()
+
+
+def main():
+    """Run the benchmark and print its report."""
+    parser = argparse.ArgumentParser(description='Benchmark get_user_games.')
+    parser.add_argument('--games', type=int, nargs='+', default=[100, 1000, 5000],
+                        help='numbers of games in the user history')
+    parser.add_argument('--open', type=int, default=20, help='number of open games')
+    parser.add_argument('--calls', type=int, default=50, help='calls per history size')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = dict((str(history), measure(history, args.open, args.calls))
+                  for history in args.games)
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""workload.py - Seeded datasets and the mixed workload of the benchmarks."""
+
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import endpoints
+import webapp2
+from google.appengine.ext import ndb
+
+import api
+import main
+import perf
+from models import User, Game, OpenGames, MakePlaysForm, PlayForm
+from packing import PackedMoves
+
+# Relative frequency of each operation in the mixed workload.
+DEFAULT_MIX = {
+    'create_user': 3,
+    'get_user': 5,
+    'new_game': 8,
+    'make_play': 45,
+    'make_plays': 5,
+    'get_game': 10,
+    'get_game_history': 5,
+    'get_user_games': 8,
+    'get_high_scores': 5,
+    'get_user_rankings': 5,
+    'get_games': 2,
+    'send_reminder': 1,
+}
+PLAYS = ['rock', 'paper', 'scissors']
+# Read-only operations whose instrumentation overhead is measured.
+OVERHEAD_OPERATIONS = ('get_user', 'get_game', 'get_game_history', 'get_user_games',
+                       'get_high_scores', 'get_games')
+# Plays of each make_plays batch, across random open games.
+BATCH_PLAYS = 10
+
+
+def seed(users, games_per_user, moves_per_game, open_fraction=0.2, batch_size=500):
+    """Stores a dataset of the given number of users, each with the given
+    number of games of the given number of moves. The given fraction of each
+    user's games is left open, and the rest are finished with the users'
+    stats updated to match. Returns the usernames and the urlsafe keys of
+    the open games."""
+    usernames = ['user{}'.format(i) for i in range(users)]
+    open_games = []
+    start = datetime.today() - timedelta(days=30)
+    entities = []
+    for username in usernames:
+        user = User(id=username, username=username, display_name=username.title(),
+                    email='{}@example.com'.format(username))
+        open_games_entity = OpenGames(key=OpenGames.key_for(user.key), migrated=True)
+        for number in range(games_per_user):
+            moves = PackedMoves(len(PLAYS))
+            for _ in range(moves_per_game):
+                play = random.randrange(len(PLAYS))
+                moves.append(play, play)
+            game = Game(id='{}-{}'.format(username, number), user=user.key,
+                        date=start + timedelta(minutes=number),
+                        last_move_at=start + timedelta(minutes=number),
+                        move_count=moves_per_game, move_data=moves.tostring())
+            if random.random() < open_fraction:
+                open_games.append(game.key.urlsafe())
+                open_games_entity.game_keys.append(game.key)
+            else:
+                game.game_over = True
+                game.won = random.random() < 0.5
+                user.record_result(game.won)
+            entities.append(game)
+            if len(entities) >= batch_size:
+                ndb.put_multi(entities)
+                entities = []
+        # Stored once all of the user's games have been added.
+        entities.extend([user, open_games_entity])
+    ndb.put_multi(entities)
+    ndb.get_context().clear_cache()
+    return usernames, open_games
+
+
+class Workload(object):
+    """Mixed workload over a seeded dataset. Each operation calls an
+    endpoint of the API, or a cron handler of main.app, and the tasks they
+    enqueue are run after each operation and measured apart."""
+
+    def __init__(self, stubs, usernames, open_games, mix=None):
+        self.stubs = stubs
+        self.usernames = list(usernames)
+        self.open_games = list(open_games)
+        self.service = api.RockPaperScissorsApi()
+        self.mix = sorted((mix or DEFAULT_MIX).items())
+        self.total_weight = sum(weight for _, weight in self.mix)
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def choose(self):
+        """Returns the name of a randomly chosen operation of the mix."""
+        point = random.uniform(0, self.total_weight)
+        for name, weight in self.mix:
+            point -= weight
+            if point <= 0:
+                return name
+        return self.mix[-1][0]
+
+    def run(self, operations):
+        """Runs the given number of operations. Returns the elapsed time."""
+        start = time.time()
+        for _ in range(operations):
+            name = self.choose()
+            self.measure(name, getattr(self, name))
+            self.measure('tasks', self.stubs.run_tasks, main.app)
+        return time.time() - start
+
+    def measure(self, name, func, *args):
+        """Calls the given function, recording its wall time and RPCs under
+        the given operation name. Endpoint exceptions are counted as errors."""
+        start = time.time()
+        with perf.recording() as record:
+            try:
+                result = func(*args)
+            except endpoints.ServiceException:
+                self.errors[name] += 1
+                result = None
+        if name == 'tasks' and not result:
+            return
+        self.samples[name].append(((time.time() - start) * 1000,
+                                   dict(record.datastore),
+                                   record.memcache_hits,
+                                   record.memcache_misses))
+
+    def _request(self, container, **kwargs):
+        """Returns a request message of the given endpoints ResourceContainer."""
+        return container.combined_message_class(**kwargs)
+
+    def create_user(self):
+        """Create a new user."""
+        username = 'user{}'.format(len(self.usernames))
+        self.usernames.append(username)
+        self.service.create_user(self._request(api.USER_REQUEST, username=username,
+                                               display_name=username.title(),
+                                               email='{}@example.com'.format(username)))
+
+    def get_user(self):
+        """Get a random user."""
+        self.service.get_user(self._request(api.GET_USER_REQUEST,
+                                            username=random.choice(self.usernames)))
+
+    def new_game(self):
+        """Create a new game for a random user."""
+        form = self.service.new_game(self._request(api.NEW_GAME_REQUEST,
+                                                   username=random.choice(self.usernames)))
+        self.open_games.append(form.urlsafe_key)
+
+    def make_play(self):
+        """Make a play in a random open game, or create a game if none is
+        open."""
+        if not self.open_games:
+            return self.new_game()
+        index = random.randrange(len(self.open_games))
+        key = self.open_games[index]
+        form = self.service.make_play(self._request(api.MAKE_PLAY_REQUEST,
+                                                    urlsafe_game_key=key,
+                                                    play=random.choice(PLAYS)))
+        if form.game_over:
+            self.open_games[index] = self.open_games[-1]
+            self.open_games.pop()
+
+    def make_plays(self):
+        """Make a batch of BATCH_PLAYS plays across random open games, or
+        create a game if none is open. Games the batch ended are no longer
+        played."""
+        if not self.open_games:
+            return self.new_game()
+        plays = [PlayForm(urlsafe_game_key=random.choice(self.open_games),
+                          play=random.choice(PLAYS)) for _ in range(BATCH_PLAYS)]
+        form = self.service.make_plays(MakePlaysForm(plays=plays))
+        over = set(result.urlsafe_game_key for result in form.results if result.game_over)
+        self.open_games = [key for key in self.open_games if key not in over]
+
+    def _random_game(self):
+        """Returns the urlsafe key of a random open game, creating one if none
+        is open."""
+        if not self.open_games:
+            self.new_game()
+        return random.choice(self.open_games)
+
+    def get_game(self):
+        """Get a random open game."""
+        self.service.get_game(self._request(api.GET_GAME_REQUEST,
+                                            urlsafe_game_key=self._random_game()))
+
+    def get_game_history(self):
+        """Get the history of a random open game."""
+        self.service.get_game_history(self._request(api.GET_GAME_HISTORY_REQUEST,
+                                                    urlsafe_game_key=self._random_game()))
+
+    def get_user_games(self):
+        """Get the first page of a random user's open games."""
+        self.service.get_user_games(self._request(api.USER_GAMES_REQUEST,
+                                                  username=random.choice(self.usernames)))
+
+    def get_high_scores(self):
+        """Get the first page of the high scores."""
+        self.service.get_high_scores(self._request(api.LEADERBOARD_REQUEST))
+
+    def get_user_rankings(self):
+        """Get the first page of the user rankings."""
+        self.service.get_user_rankings(self._request(api.LEADERBOARD_REQUEST))
+
+    def get_users(self):
+        """Get the first page of all users."""
+        self.service.get_users(self._request(api.PAGE_REQUEST))
+
+    def get_games(self):
+        """Get the first page of all games."""
+        self.service.get_games(self._request(api.PAGE_REQUEST))
+
+    def send_reminder(self):
+        """Run the reminder cron, along with the tasks it enqueues."""
+        webapp2.Request.blank('/crons/send_reminder').get_response(main.app)
+        self.stubs.run_tasks(main.app)
+
+    def measure_overhead(self, calls):
+        """Returns the mean and percentiles of the time the instrumentation
+        of perf.py adds to each call, and whether its median stays within
+        perf.OVERHEAD_BUDGET_MS. Each of the given number of calls of a
+        read-only operation is paired with the same call made
+        uninstrumented, in alternating order, and the overhead is the
+        difference of their wall times."""
+        overheads = []
+        for number in range(calls):
+            name = OVERHEAD_OPERATIONS[number % len(OVERHEAD_OPERATIONS)]
+            state = random.getstate()
+            times = {}
+            for instrumented in ((True, False) if number % 2 else (False, True)):
+                # Both calls pick the same user or game.
+                random.setstate(state)
+                start = time.time()
+                if instrumented:
+                    getattr(self, name)()
+                else:
+                    with perf.uninstrumented():
+                        getattr(self, name)()
+                times[instrumented] = (time.time() - start) * 1000
+            overheads.append(times[True] - times[False])
+        overheads.sort()
+        return {'calls': calls,
+                'budget_ms': perf.OVERHEAD_BUDGET_MS,
+                'within_budget': perf.percentile(overheads, 50) <= perf.OVERHEAD_BUDGET_MS,
+                'overhead_ms': {'mean': sum(overheads) / len(overheads),
+                                'p50': perf.percentile(overheads, 50),
+                                'p95': perf.percentile(overheads, 95),
+                                'p99': perf.percentile(overheads, 99)}}
+
+    def report(self):
+        """Returns a dictionary reporting, for each operation, its count,
+        errors, throughput, latency percentiles and mean RPC counts."""
+        report = {}
+        for name, samples in sorted(self.samples.items()):
+            latencies = sorted(sample[0] for sample in samples)
+            count = len(samples)
+            datastore = defaultdict(int)
+            for sample in samples:
+                for call, calls in sample[1].items():
+                    datastore[call] += calls
+            report[name] = {
+                'count': count,
+                'errors': self.errors[name],
+                'throughput_per_sec': count / (sum(latencies) / 1000) if sum(latencies) else 0,
+                'latency_ms': {'mean': sum(latencies) / count,
+                               'p50': perf.percentile(latencies, 50),
+                               'p95': perf.percentile(latencies, 95),
+                               'p99': perf.percentile(latencies, 99)},
+                'datastore_rpcs': dict((call, float(calls) / count)
+                                       for call, calls in sorted(datastore.items())),
+                'memcache_hits': float(sum(sample[2] for sample in samples)) / count,
+                'memcache_misses': float(sum(sample[3] for sample in samples)) / count,
+            }
+            if name == 'make_plays':
+                # Batches are compared with make_play per play.
+                report[name]['per_play'] = {
+                    'latency_ms': dict((stat, value / BATCH_PLAYS) for stat, value
+                                       in report[name]['latency_ms'].items()),
+                    'datastore_rpcs': dict((call, calls / BATCH_PLAYS) for call, calls
+                                           in report[name]['datastore_rpcs'].items()),
+                }
+        return report
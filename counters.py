@@ -0,0 +1,174 @@
+"""counters.py - Sharded counters for global game results.
+
+Each counter is split over a number of CounterShard entities, so frequent
+increments of the same counter are spread over several entity groups instead
+of contending for one. Totals are summed from the shards and cached in
+memcache.
+
+Increments are applied by a task, enqueued in the transaction that
+produces them (see add_increments), so that the shards do not add entity
+groups, nor contention, to that transaction. Each batch of increments is
+applied once, along with a marker of the batch.
+
+Only the totals of all users are counted here. A user's results are kept on
+the User, which is written whenever one of their games ends anyway, to
+update the leaderboards; per-user counters would add writes without taking
+any off the User's entity group."""
+
+import json
+import random
+import time
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+DEFAULT_NUM_SHARDS = 20
+# Cached totals expire, so a total cached while an increment was being
+# committed is not served for long.
+CACHE_TIME = 60
+# Numbers of shards are cached by each instance for this long, so that
+# incrementing does not read the CounterConfig every time.
+NUM_SHARDS_CACHE_TIME = 60
+INCREMENT_URL = '/tasks/increment_counters'
+
+WINS = 'wins'
+LOSSES = 'losses'
+DRAWS = 'draws'
+
+
+class CounterConfig(ndb.Model):
+    """Number of shards of a counter, keyed by counter name. Counters without
+    a CounterConfig use DEFAULT_NUM_SHARDS."""
+    num_shards = ndb.IntegerProperty(required=True, default=DEFAULT_NUM_SHARDS)
+
+
+class CounterShard(ndb.Model):
+    """A single shard of a counter, keyed by counter name and shard index."""
+    count = ndb.IntegerProperty(required=True, default=0)
+
+
+class CounterIncrement(ndb.Model):
+    """Marks a batch of increments as applied, keyed by the ID of the batch,
+    so that a task run more than once applies its increments only once."""
+    applied = ndb.DateTimeProperty(auto_now_add=True)
+
+
+# Number of shards and expiry time of each counter, keyed by counter name.
+_num_shards = {}
+
+
+def counter_name(result):
+    """Returns the name of the global counter of the given result (WINS,
+    LOSSES or DRAWS)."""
+    return 'global:{}'.format(result)
+
+
+def _cache_key(name):
+    """Returns the memcache key of the total of the named counter."""
+    return 'counter:{}'.format(name)
+
+
+def _shard_key(name, index):
+    """Returns the key of the shard of the named counter with given index."""
+    return ndb.Key(CounterShard, '{}:{}'.format(name, index))
+
+
+def get_num_shards(name):
+    """Returns the number of shards of the named counter, as cached by the
+    instance for NUM_SHARDS_CACHE_TIME seconds. A number cached before
+    shards were added only spreads increments over fewer shards, as totals
+    are summed from all of them."""
+    cached = _num_shards.get(name)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    num_shards = _read_num_shards(name)
+    _num_shards[name] = (num_shards, time.time() + NUM_SHARDS_CACHE_TIME)
+    return num_shards
+
+
+@ndb.non_transactional
+def _read_num_shards(name):
+    """Reads the number of shards of the named counter. Read outside of any
+    transaction, so incrementing does not add an entity group."""
+    config = CounterConfig.get_by_id(name)
+    return config.num_shards if config else DEFAULT_NUM_SHARDS
+
+
+def increase_shards(name, num_shards):
+    """Increases the number of shards of the named counter. The number of
+    shards is never decreased, as that would drop the counts of the removed
+    shards from the total. Other instances use the new shards once their
+    cached number of shards expires."""
+    @ndb.transactional
+    def _increase_shards_txn():
+        """Store the new number of shards, if it is larger."""
+        config = CounterConfig.get_by_id(name) or CounterConfig(id=name)
+        if num_shards > config.num_shards:
+            config.num_shards = num_shards
+            config.put()
+        return config.num_shards
+    _num_shards[name] = (_increase_shards_txn(), time.time() + NUM_SHARDS_CACHE_TIME)
+
+
+def add_increments(increment_id, deltas):
+    """Enqueues a task adding the given deltas, keyed by counter name, to the
+    counters (see apply_increments). Called inside a transaction, the task
+    is only enqueued if the transaction commits. The given ID must be unique
+    to the batch of increments."""
+    taskqueue.add(url=INCREMENT_URL,
+                  params={'id': increment_id, 'deltas': json.dumps(deltas)},
+                  transactional=ndb.in_transaction())
+
+
+def apply_increments(increment_id, deltas):
+    """Adds the given deltas, keyed by counter name, to a randomly chosen
+    shard of each counter, unless the batch of increments with the given ID
+    has already been applied. The cached totals are only updated once the
+    increments have been committed. Returns whether they were applied."""
+    names = sorted(name for name, delta in deltas.items() if delta)
+    keys = [_shard_key(name, random.randint(0, get_num_shards(name) - 1)) for name in names]
+    marker_key = ndb.Key(CounterIncrement, increment_id)
+
+    @ndb.transactional(xg=True)
+    def _apply_increments_txn():
+        """Add the deltas, and the marker of the batch, unless it is stored."""
+        if marker_key.get():
+            return False
+        shards = [shard or CounterShard(key=key)
+                  for shard, key in zip(ndb.get_multi(keys), keys)]
+        for name, shard in zip(names, shards):
+            shard.count += deltas[name]
+        ndb.put_multi(shards + [CounterIncrement(key=marker_key)])
+
+        def _update_totals():
+            """Update the cached totals. A missing total is summed afresh."""
+            for name in names:
+                memcache.incr(_cache_key(name), delta=deltas[name])
+        ndb.get_context().call_on_commit(_update_totals)
+        return True
+    return _apply_increments_txn()
+
+
+def get_counts(names):
+    """Returns a dictionary of the totals of the named counters. Totals are
+    read from memcache, and those missing are summed from all their shards
+    in a single batch get."""
+    counts = memcache.get_multi(names, key_prefix='counter:')
+    missing = [name for name in names if name not in counts]
+    if not missing:
+        return counts
+    configs = ndb.get_multi([ndb.Key(CounterConfig, name) for name in missing])
+    shard_keys = [[_shard_key(name, index)
+                   for index in range(config.num_shards if config else DEFAULT_NUM_SHARDS)]
+                  for name, config in zip(missing, configs)]
+    shards = iter(ndb.get_multi([key for keys in shard_keys for key in keys]))
+    totals = {}
+    for name, keys in zip(missing, shard_keys):
+        totals[name] = sum(shard.count for shard in [next(shards) for _ in keys] if shard)
+    memcache.add_multi(totals, key_prefix='counter:', time=CACHE_TIME)
+    counts.update(totals)
+    return counts
+
+
+def get_count(name):
+    """Returns the total of the named counter."""
+    return get_counts([name])[name]
@@ -0,0 +1,261 @@
+"""export.py - Bulk export and import of users and games.
+
+An ExportJob walks each exported kind in key order with query cursors, one
+batch at a time, and stores each batch as an ExportChunk of gzip-compressed
+newline-delimited JSON, one entity per line:
+
+    {"key": ["Game", 123], "properties": {"user": ["User", "ann"], ...}}
+
+Each chunk is stored in the same transaction as the cursor it ends at, so
+a job resumes from its last chunk however its tasks are retried, and no
+more than one batch of entities is ever held in memory. A chunk also ends
+early once its compressed size nears MAX_CHUNK_BYTES, so that it always
+fits in an entity, however large the exported entities are. Chunks are
+imported, from an export of this or another application, by put_multi in
+batches, optionally into another namespace."""
+
+import base64
+import gzip
+import json
+from cStringIO import StringIO
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import User, OpenGames, Game, Move
+
+# Exported kinds, in order. Moves are only stored as entities for games
+# whose moves have not been packed.
+KINDS = [User._get_kind(), OpenGames._get_kind(), Game._get_kind(), Move._get_kind()]
+BATCH_SIZE = 500
+# Leaves room under the 1 MB entity limit for the rest of the ExportChunk.
+MAX_CHUNK_BYTES = 900 * 1024
+# The compressed size of a chunk is measured by flushing the compressor
+# every so many bytes of NDJSON.
+FLUSH_BYTES = 64 * 1024
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def _encode_value(prop, value):
+    """Returns the JSON representation of a single value of the given
+    property."""
+    if value is None:
+        return None
+    if isinstance(prop, ndb.StructuredProperty):
+        return _encode_properties(value)
+    if isinstance(prop, ndb.KeyProperty):
+        return list(value.flat())
+    if isinstance(prop, (ndb.DateTimeProperty, ndb.DateProperty)):
+        return value.isoformat()
+    if isinstance(prop, (ndb.JsonProperty, ndb.TextProperty)):
+        return value
+    if isinstance(prop, ndb.BlobProperty):
+        return base64.b64encode(value)
+    return value
+
+
+def _decode_value(prop, value, namespace):
+    """Returns the value of the given property that the JSON value
+    represents. Keys are made in the given namespace."""
+    if value is None:
+        return None
+    if isinstance(prop, ndb.StructuredProperty):
+        return _decode_properties(prop._modelclass(), value, namespace)
+    if isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value, namespace=namespace)
+    if isinstance(prop, ndb.DateProperty):
+        return datetime.strptime(value, DATE_FORMAT).date()
+    if isinstance(prop, ndb.DateTimeProperty):
+        for date_format in DATETIME_FORMATS:
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        raise ValueError('Invalid datetime {}'.format(value))
+    if isinstance(prop, (ndb.JsonProperty, ndb.TextProperty)):
+        return value
+    if isinstance(prop, ndb.BlobProperty):
+        return base64.b64decode(value)
+    return value
+
+
+def _encode_properties(entity):
+    """Returns a dictionary of the JSON representations of the stored
+    properties of the given entity, keyed by property name. Computed
+    properties are left out, as they are computed again on import."""
+    properties = {}
+    for prop in entity._properties.values():
+        if isinstance(prop, ndb.ComputedProperty):
+            continue
+        value = getattr(entity, prop._code_name)
+        if prop._repeated:
+            properties[prop._code_name] = [_encode_value(prop, item) for item in value]
+        else:
+            properties[prop._code_name] = _encode_value(prop, value)
+    return properties
+
+
+def _decode_properties(entity, properties, namespace):
+    """Sets the properties of the given entity from their JSON
+    representations, and returns the entity."""
+    for name, value in properties.items():
+        prop = getattr(type(entity), name)
+        if prop._repeated:
+            value = [_decode_value(prop, item, namespace) for item in value]
+        else:
+            value = _decode_value(prop, value, namespace)
+        setattr(entity, name, value)
+    return entity
+
+
+def encode_entity(entity):
+    """Returns the NDJSON line, without its newline, of the given entity."""
+    return json.dumps({'key': list(entity.key.flat()),
+                       'properties': _encode_properties(entity)},
+                      separators=(',', ':'), sort_keys=True)
+
+
+def decode_entity(line, namespace=None):
+    """Returns the unsaved entity of the given NDJSON line, keyed in the
+    given namespace."""
+    record = json.loads(line)
+    key = ndb.Key(flat=record['key'], namespace=namespace)
+    entity = ndb.Model._lookup_model(key.kind())(key=key)
+    return _decode_properties(entity, record['properties'], namespace)
+
+
+def import_chunk(data, namespace=None, batch_size=BATCH_SIZE):
+    """Stores the entities of the given gzip-compressed NDJSON chunk with
+    put_multi, in batches of the given size, keyed in the given namespace.
+    Entities already stored under the same keys are overwritten, so a chunk
+    can safely be imported again. Returns the number of entities stored."""
+    count = 0
+    batch = []
+    with gzip.GzipFile(fileobj=StringIO(data), mode='rb') as lines:
+        for line in lines:
+            if not line.strip():
+                continue
+            batch.append(decode_entity(line, namespace))
+            if len(batch) >= batch_size:
+                ndb.put_multi(batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        ndb.put_multi(batch)
+        count += len(batch)
+    return count
+
+
+class ExportChunk(ndb.Model):
+    """A single chunk of an export: the gzip-compressed NDJSON of one batch
+    of entities of a kind, of at most MAX_CHUNK_BYTES unless a single
+    entity is larger. Stored as a child of its ExportJob, with IDs
+    numbering the chunks from 1."""
+    kind = ndb.StringProperty(required=True, indexed=False)
+    count = ndb.IntegerProperty(required=True, indexed=False)
+    data = ndb.BlobProperty(required=True)
+
+
+class ExportJob(ndb.Model):
+    """Progress of an export: the kind being exported, the cursor the next
+    chunk starts at, the number of chunks stored so far, and the number of
+    entities exported of each kind."""
+    kinds = ndb.StringProperty(repeated=True, indexed=False)
+    kind_index = ndb.IntegerProperty(default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    chunks = ndb.IntegerProperty(default=0, indexed=False)
+    counts = ndb.JsonProperty(default={})
+    done = ndb.BooleanProperty(default=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def start(cls, kinds=None):
+        """Stores a new export of the given kinds (all of KINDS by default),
+        enqueues its first task and returns it."""
+        job = cls(kinds=kinds or KINDS)
+        job.put()
+        job.enqueue()
+        return job
+
+    def enqueue(self):
+        """Enqueues the task exporting the job's next chunks. Tasks are named
+        after the position they start at, so a retried task does not enqueue
+        a second one."""
+        try:
+            taskqueue.add(url='/tasks/export',
+                          name='export-{}-{}-{}'.format(self.key.id(), self.kind_index,
+                                                        self.chunks),
+                          params={'job': self.key.id()},
+                          queue_name='export')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    def chunk_key(self, number):
+        """Returns the key of the job's chunk with the given number."""
+        return ndb.Key(ExportChunk, number, parent=self.key)
+
+    def export_chunk(self, batch_size=BATCH_SIZE, max_bytes=MAX_CHUNK_BYTES):
+        """Exports the next batch of entities as a chunk, and stores it along
+        with the job's progress. The batch ends early, at the cursor before
+        the first entity left out, if adding that entity could take the
+        compressed chunk over max_bytes. No chunk is stored for an empty
+        batch. Returns the job as stored, which is unchanged if another task
+        has exported the batch in the meantime."""
+        if self.done:
+            return self
+        kind = self.kinds[self.kind_index]
+        cursor = Cursor(urlsafe=self.cursor) if self.cursor else None
+        entities = ndb.Query(kind=kind).iter(start_cursor=cursor, limit=batch_size,
+                                             batch_size=batch_size, produce_cursors=True)
+        count = 0
+        out = StringIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as lines:
+            # Bytes of NDJSON written since the compressor was last flushed.
+            # They may not have reached out yet, so they are counted at their
+            # uncompressed size.
+            unflushed = 0
+            for entity in entities:
+                line = encode_entity(entity) + '\n'
+                if count and out.tell() + unflushed + len(line) > max_bytes:
+                    next_cursor, more = entities.cursor_before(), True
+                    break
+                lines.write(line)
+                count += 1
+                unflushed += len(line)
+                if unflushed >= FLUSH_BYTES:
+                    lines.flush()
+                    unflushed = 0
+            else:
+                next_cursor = entities.cursor_after() if count else None
+                more = count == batch_size
+        chunk = ExportChunk(key=self.chunk_key(self.chunks + 1), kind=kind,
+                            count=count, data=out.getvalue())
+
+        @ndb.transactional
+        def _export_chunk_txn():
+            """Store the chunk and the job's progress, unless another task
+            has exported the batch."""
+            job = self.key.get()
+            if (job.kind_index, job.cursor) != (self.kind_index, self.cursor):
+                return job
+            to_put = [job]
+            if count:
+                job.chunks += 1
+                to_put.append(chunk)
+            job.counts = dict(job.counts or {})
+            job.counts[kind] = job.counts.get(kind, 0) + count
+            if more and next_cursor:
+                job.cursor = next_cursor.urlsafe()
+            else:
+                job.cursor = None
+                job.kind_index += 1
+                if job.kind_index >= len(job.kinds):
+                    job.done = True
+                    job.finished = datetime.today()
+            ndb.put_multi(to_put)
+            return job
+        return _export_chunk_txn()
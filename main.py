@@ -2,16 +2,27 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or cronjobs."""
 
+import json
+import logging
+from datetime import datetime, timedelta
+
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.appengine.runtime import apiproxy_errors
 
+import counters
 from api import RockPaperScissorsApi
+from export import ExportJob, import_chunk
 
-from models import User, Game
+from models import User, Game, Reminder, Stats, OpenGames, LeaderboardBucket, MatchRequest
+from perf import instrument
 
 
 class MainHandler(webapp2.RequestHandler):
     """Main handler for requests."""
+    @instrument
     def get(self):
         """Return generic HTML page with link to API Explorer."""
         self.response.write("""<!doctype html><head><link rel="stylesheet"\
@@ -25,23 +36,413 @@ class MainHandler(webapp2.RequestHandler):
 
 class SendReminderEmail(webapp2.RequestHandler):
     """Handler for requests for sending reminder emails."""
+    @instrument
     def get(self):
-        """Send a reminder email to each User with incomplete games."""
+        """Start sending a reminder email to each User with incomplete games.
+        The users are collected and emailed in batches by taskqueue tasks."""
+        taskqueue.add(url='/tasks/collect_reminders', queue_name='reminders')
+
+
+class CollectReminders(webapp2.RequestHandler):
+    """Handler for tasks collecting the Users with incomplete games. Each task
+    reads one page of the keys of the OpenGames holding any games, whose
+    parents are the users to remind, fans them out to SendReminderBatch tasks
+    and enqueues the task for the next page. Users not yet migrated to
+    OpenGames are not reminded."""
+    PAGE_SIZE = 500
+    BATCH_SIZE = 50
+
+    @instrument
+    def post(self):
+        """Collect one page of users to remind."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        query = OpenGames.query(OpenGames.has_games == True)
+        keys, next_cursor, more = query.fetch_page(self.PAGE_SIZE, start_cursor=cursor,
+                                                   keys_only=True)
+        user_keys = [key.parent().urlsafe() for key in keys]
+        tasks = [taskqueue.Task(url='/tasks/send_reminders',
+                                params={'user_key': user_keys[i:i + self.BATCH_SIZE]})
+                 for i in range(0, len(user_keys), self.BATCH_SIZE)]
+        if more and next_cursor:
+            tasks.append(taskqueue.Task(url='/tasks/collect_reminders',
+                                        params={'cursor': next_cursor.urlsafe()}))
+        if tasks:
+            taskqueue.Queue('reminders').add(tasks)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    """Handler for tasks sending reminder emails to a batch of Users. Users
+    already reminded within Reminder.INTERVAL are skipped, so retried tasks
+    and repeated cron runs do not send duplicate emails."""
+    @instrument
+    def post(self):
+        """Send a reminder email to each due User in the batch."""
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            games = Game.query().filter(Game.game_over == False).filter(Game.user == user.key)
-            if games.count() > 0:
+        user_keys = [ndb.Key(urlsafe=key) for key in self.request.get_all('user_key')]
+        reminder_keys = [Reminder.key_for(key) for key in user_keys]
+        entities = ndb.get_multi(user_keys + reminder_keys)
+        users, reminders = entities[:len(user_keys)], entities[len(user_keys):]
+
+        now = datetime.now()
+        sent = []
+        try:
+            for user, reminder, reminder_key in zip(users, reminders, reminder_keys):
+                if not user or not user.email:
+                    continue
+                if reminder and not reminder.is_due(now):
+                    continue
                 subject = 'Time to Make Your Move in Rock, Paper, Scissors!'
                 body = """Hello {}, it looks like you have some incomplete\
                           games of Rock, Paper, Scissors waiting for you.""".format(user.username)
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+                try:
+                    mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                                   user.email,
+                                   subject,
+                                   body)
+                except (mail.Error, apiproxy_errors.Error):
+                    # A bad address must not fail the rest of the batch; the
+                    # user is tried again by the next cron run.
+                    logging.exception('Could not send a reminder to %s', user.username)
+                    continue
+                sent.append(Reminder(key=reminder_key, last_sent=now))
+        finally:
+            # Stored even if the task fails partway, so a retry skips the
+            # users already emailed.
+            ndb.put_multi(sent)
+
+
+class UpdateStats(webapp2.RequestHandler):
+    """Handler for tasks folding newly finished games into the global Stats.
+    Games ended over Stats.FOLD_LAG seconds ago are read in date order from
+    the Stats' watermark, skipping those already folded in with the
+    watermark's date, and the Stats are only stored if no other task has
+    moved the watermark in the meantime, so retried and overlapping tasks
+    never count a game twice nor skip one."""
+    BATCH_SIZE = 200
+
+    @instrument
+    def post(self):
+        """Fold one batch of finished games into the Stats."""
+        stats = Stats.get_by_id(Stats.ID) or Stats(id=Stats.ID)
+        watermark = (stats.last_game_date, list(stats.last_game_keys))
+        cutoff = datetime.today() - timedelta(seconds=Stats.FOLD_LAG)
+        query = Game.query(Game.game_over == True, Game.date < cutoff)\
+            .order(Game.date, Game.key)
+        if stats.last_game_date:
+            query = query.filter(Game.date >= stats.last_game_date)
+        games, cursor, more = [], None, True
+        while more and not games:
+            page, cursor, more = query.fetch_page(self.BATCH_SIZE, start_cursor=cursor)
+            games = [game for game in page if not stats.is_folded(game)]
+        if not games:
+            return
+
+        for game, moves in zip(games, Game.get_moves(games)):
+            if not game.cancelled:
+                stats.add_game(game, [move for _, move in moves])
+            stats.advance_watermark(game)
+
+        @ndb.transactional
+        def _update_stats_txn():
+            """Store the Stats, unless another task has updated them."""
+            stored = stats.key.get()
+            if ((stored.last_game_date, stored.last_game_keys) if stored
+                    else (None, [])) != watermark:
+                return False
+            stats.put()
+            return True
+        if not _update_stats_txn():
+            return
+        memcache.set(Stats.CACHE_KEY, stats)
+        if more:
+            taskqueue.add(url='/tasks/cache_average_attempts', queue_name='stats',
+                          countdown=Stats.COALESCE_SECONDS)
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+    """Handler for the one-off job rebuilding User aggregate stats from the
+    existing Game history. Users are processed in batches, with each batch
+    enqueueing the next one from the last query cursor. Each User's stats
+    are stored in their own transaction, and recomputed again if one of
+    their games ends meanwhile (see User.backfill_stats)."""
+    BATCH_SIZE = 50
+
+    @instrument
+    def get(self):
+        """Start the backfill job by enqueueing its first batch."""
+        taskqueue.add(url='/tasks/backfill_user_stats')
+        self.response.write('User stats backfill started.')
+
+    @instrument
+    def post(self):
+        """Recompute the stats of one batch of users."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        user_keys, next_cursor, more = User.query().fetch_page(self.BATCH_SIZE,
+                                                               start_cursor=cursor,
+                                                               keys_only=True)
+        for user_key in user_keys:
+            if not User.backfill_stats(user_key):
+                logging.warning('Could not backfill the stats of %s', user_key)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+    """Handler for the one-off job moving Users created with auto-generated
+    IDs to keys named by username, along with the Game references to them."""
+    BATCH_SIZE = 20
+
+    @instrument
+    def get(self):
+        """Start the migration job by enqueueing its first batch."""
+        taskqueue.add(url='/tasks/migrate_user_keys')
+        self.response.write('User key migration started.')
+
+    @instrument
+    def post(self):
+        """Migrate one batch of users."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(self.BATCH_SIZE,
+                                                           start_cursor=cursor)
+        for user in users:
+            if user.key.id() != user.username:
+                user.rekey_by_username()
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_user_keys',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class MigrateOpenGames(webapp2.RequestHandler):
+    """Handler for the one-off job building the OpenGames of Users with games
+    created before open games were tracked. Should be run once Users have
+    been migrated to username keys."""
+    BATCH_SIZE = 20
+
+    @instrument
+    def get(self):
+        """Start the migration job by enqueueing its first batch."""
+        taskqueue.add(url='/tasks/migrate_open_games')
+        self.response.write('Open games migration started.')
+
+    @instrument
+    def post(self):
+        """Migrate one batch of users."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        user_keys, next_cursor, more = User.query().fetch_page(self.BATCH_SIZE,
+                                                               start_cursor=cursor,
+                                                               keys_only=True)
+        for user_key in user_keys:
+            OpenGames.migrate(user_key)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_open_games',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class PackGameMoves(webapp2.RequestHandler):
+    """Handler for the one-off job packing the moves of games stored before
+    moves were packed, as child Move entities or inline, into the games'
+    move_data."""
+    BATCH_SIZE = 50
+
+    @instrument
+    def get(self):
+        """Start the migration job by enqueueing its first batch."""
+        taskqueue.add(url='/tasks/pack_game_moves')
+        self.response.write('Game moves packing started.')
+
+    @instrument
+    def post(self):
+        """Pack the moves of one batch of games."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query().fetch_page(self.BATCH_SIZE,
+                                                           start_cursor=cursor)
+        for game in games:
+            game.pack_moves()
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/pack_game_moves',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class ExportData(webapp2.RequestHandler):
+    """Handler for the export of Users and Games (see export.py). Each task
+    exports a number of chunks, one batch of entities at a time, then
+    enqueues the next task from the job's stored cursor."""
+    CHUNKS_PER_TASK = 20
+
+    @instrument
+    def get(self):
+        """Start an export job."""
+        job = ExportJob.start()
+        self.response.write('Export {} started.'.format(job.key.id()))
+
+    @instrument
+    def post(self):
+        """Export the next chunks of a job."""
+        job = ExportJob.get_by_id(int(self.request.get('job')))
+        for _ in range(self.CHUNKS_PER_TASK):
+            if not job or job.done:
+                return
+            job = job.export_chunk()
+        job.enqueue()
+
+
+class ExportChunkDownload(webapp2.RequestHandler):
+    """Handler for downloading a chunk of an export, as gzip-compressed
+    NDJSON."""
+    @instrument
+    def get(self):
+        """Write the chunk with the given job ID and number."""
+        job = ExportJob.get_by_id(int(self.request.get('job')))
+        chunk = job.chunk_key(int(self.request.get('chunk'))).get() if job else None
+        if not chunk:
+            self.abort(404)
+        self.response.content_type = 'application/gzip'
+        self.response.write(chunk.data)
+
+
+class ImportChunk(webapp2.RequestHandler):
+    """Handler for importing a chunk of an export, posted as the request
+    body, into the namespace given as a query parameter (the default
+    namespace if none). Chunks can be posted in any order, and again."""
+    @instrument
+    def post(self):
+        """Import the posted chunk."""
+        count = import_chunk(self.request.body, self.request.GET.get('namespace') or None)
+        self.response.write('Imported {} entities.'.format(count))
+
+
+class CompactLeaderboards(webapp2.RequestHandler):
+    """Handler for the daily job deleting expired LeaderboardBuckets. Their
+    results are kept in the coarser buckets updated along with them (the
+    week of a daily bucket, and the User's all-time stats for a weekly
+    one), so only the leaderboards of the current periods need them. Each
+    task deletes one batch of each period and enqueues the next task while
+    any are left."""
+    BATCH_SIZE = 500
+
+    @instrument
+    def get(self):
+        """Start the compaction job by enqueueing its first batch."""
+        taskqueue.add(url='/tasks/compact_leaderboards')
+        self.response.write('Leaderboard compaction started.')
+
+    @instrument
+    def post(self):
+        """Delete one batch of expired buckets of each period."""
+        more = False
+        for period in LeaderboardBucket.PERIODS:
+            keys = LeaderboardBucket.query_expired(period).fetch(self.BATCH_SIZE,
+                                                                 keys_only=True)
+            ndb.delete_multi(keys)
+            more = more or len(keys) == self.BATCH_SIZE
+        if more:
+            taskqueue.add(url='/tasks/compact_leaderboards')
+
+
+class PairPlayers(webapp2.RequestHandler):
+    """Handler for the tasks pairing a waiting matchmaking entry that could
+    not be paired when it joined. Each attempt widens the range of skill
+    buckets searched by one, and enqueues the next attempt while the entry
+    is still waiting, up to MatchRequest.MAX_PAIR_ATTEMPTS."""
+    @instrument
+    def post(self):
+        """Try to pair one entry."""
+        entry = MatchRequest.key_for(self.request.get('username')).get()
+        attempt = int(self.request.get('attempt'))
+        if not entry or not entry.waiting:
+            return
+        entry = entry.pair(attempt + 1)
+        if entry.waiting and attempt < MatchRequest.MAX_PAIR_ATTEMPTS:
+            entry.enqueue_pairing(attempt + 1)
+
+
+class ExpireGames(webapp2.RequestHandler):
+    """Handler for the cron job cancelling abandoned games: open games with
+    no move made within Game.INACTIVITY_TTL, or the number of days given as
+    the 'days' parameter. Each task cancels one batch of the games found by
+    a keys-only query, and enqueues the next task while batches are full,
+    so a run only reads the expired games."""
+    BATCH_SIZE = 500
+
+    def _ttl(self):
+        """Returns the inactivity TTL of the request."""
+        days = self.request.get('days')
+        return timedelta(days=int(days)) if days else Game.INACTIVITY_TTL
+
+    @instrument
+    def get(self):
+        """Start the sweep by enqueueing its first batch."""
+        taskqueue.add(url='/tasks/expire_games', params={'days': self._ttl().days})
+        self.response.write('Abandoned games sweep started.')
+
+    @instrument
+    def post(self):
+        """Cancel one batch of abandoned games."""
+        ttl = self._ttl()
+        keys = Game.query_abandoned(ttl).fetch(self.BATCH_SIZE, keys_only=True)
+        cancelled = Game.cancel_abandoned(keys, ttl)
+        # The query is eventually consistent, so stop once a batch finds no
+        # game left to cancel.
+        if len(keys) == self.BATCH_SIZE and cancelled:
+            taskqueue.add(url='/tasks/expire_games', params={'days': ttl.days})
+
+
+class IncrementCounters(webapp2.RequestHandler):
+    """Handler for the tasks adding a batch of increments to the global
+    counters, enqueued by the transactions that end games. A task that is
+    run again does not apply its increments twice."""
+
+    @instrument
+    def post(self):
+        """Apply one batch of increments."""
+        counters.apply_increments(self.request.get('id'),
+                                  json.loads(self.request.get('deltas')))
+
+
+class BackfillLastMoveAt(webapp2.RequestHandler):
+    """Handler for the one-off job setting the last_move_at of open games
+    created before it was tracked to their date, so that the abandoned
+    games sweeper finds them."""
+    BATCH_SIZE = 500
+
+    @instrument
+    def get(self):
+        """Start the backfill job by enqueueing its first batch."""
+        taskqueue.add(url='/tasks/backfill_last_move_at')
+        self.response.write('Game last move backfill started.')
+
+    @instrument
+    def post(self):
+        """Backfill one batch of open games."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(Game.game_over == False)\
+            .fetch_page(self.BATCH_SIZE, start_cursor=cursor)
+        games = [game for game in games if not game.last_move_at]
+        for game in games:
+            game.last_move_at = game.date
+        ndb.put_multi(games)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_last_move_at',
+                          params={'cursor': next_cursor.urlsafe()})
 
 
 app = webapp2.WSGIApplication([
     ('/', MainHandler),
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/collect_reminders', CollectReminders),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/cache_average_attempts', UpdateStats),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/migrate_open_games', MigrateOpenGames),
+    ('/tasks/pack_game_moves', PackGameMoves),
+    ('/tasks/export', ExportData),
+    ('/tasks/export_chunk', ExportChunkDownload),
+    ('/tasks/import_chunk', ImportChunk),
+    ('/tasks/compact_leaderboards', CompactLeaderboards),
+    ('/tasks/pair', PairPlayers),
+    ('/tasks/expire_games', ExpireGames),
+    ('/tasks/backfill_last_move_at', BackfillLastMoveAt),
+    (counters.INCREMENT_URL, IncrementCounters),
 ], debug=True)
@@ -1,27 +1,277 @@
 """models.py - Class definitions for Datastore entities used."""
 
+import heapq
+import logging
 import random
-from datetime import date, datetime
+import time
+from array import array
+from datetime import date, datetime, timedelta
 from protorpc import messages
+from google.appengine.api import datastore_errors, memcache, taskqueue
 from google.appengine.ext import ndb
 
+import counters
+import packing
+import rules
+import strategies
+
+
+LEADERBOARD_VERSION_KEY = 'leaderboard:version'
+
+
+def _copy_entity(entity, key):
+    """Returns an unsaved copy of the given entity under the given key.
+    Computed properties are left to be computed again."""
+    computed = [name for name, prop in entity._properties.items()
+                if isinstance(prop, ndb.ComputedProperty)]
+    return type(entity)(key=key, **entity.to_dict(exclude=computed))
+
+
+def _record_result(stats, won):
+    """Applies the result of a single finished game to the given User or
+    LeaderboardBucket's stats (total games, wins, win percentage and
+    streaks)."""
+    stats.total_games = (stats.total_games or 0) + 1
+    if won:
+        stats.wins = (stats.wins or 0) + 1
+        stats.current_streak = (stats.current_streak or 0) + 1
+        stats.longest_win_streak = max(stats.longest_win_streak or 0,
+                                       stats.current_streak)
+    else:
+        stats.wins = stats.wins or 0
+        stats.current_streak = 0
+        stats.longest_win_streak = stats.longest_win_streak or 0
+    stats.win_percentage = float(stats.wins) / stats.total_games
+
 
 class User(ndb.Model):
-    """User profile."""
+    """User profile, keyed by username."""
+    # Users are cached in memcache by username (see get_by_username), so
+    # ndb's own memcache caching is not needed on top of that.
+    _use_memcache = False
+    # Cached Users expire after this long, so that a User cached by a read
+    # racing with a write is not served stale for longer.
+    CACHE_SECONDS = 60
+    # The aggregate stats, applied as games end and rebuilt by
+    # recompute_stats.
+    STATS = ('total_games', 'wins', 'win_percentage', 'current_streak',
+             'longest_win_streak', 'draws')
+
     username = ndb.StringProperty(required=True)
     display_name = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
-    total_games = ndb.IntegerProperty()
-    wins = ndb.IntegerProperty()
-    win_percentage = ndb.FloatProperty()
-    longest_win_streak = ndb.IntegerProperty()
+    total_games = ndb.IntegerProperty(default=0)
+    wins = ndb.IntegerProperty(default=0)
+    win_percentage = ndb.FloatProperty(default=0.0)
+    current_streak = ndb.IntegerProperty(default=0)
+    longest_win_streak = ndb.IntegerProperty(default=0)
+    # Drawn moves of the User's finished games.
+    draws = ndb.IntegerProperty(default=0)
 
-    def to_form(self):
-        """Returns a UserForm representation of the User."""
+    @classmethod
+    def cache_key(cls, username):
+        """Returns the memcache key for the User with the given username."""
+        return 'user:{}'.format(username)
+
+    @classmethod
+    def get_by_username(cls, username):
+        """Returns the User with the given username, or None if not found.
+        Reads through memcache, where Users expire after CACHE_SECONDS.
+        Users created before Users were keyed by username are found by
+        query until they have been migrated."""
+        if not username:
+            return None
+        cache_key = cls.cache_key(username)
+        user = memcache.get(cache_key)
+        if user is None:
+            user = cls.get_by_id(username)
+            if user is None:
+                user = cls.query(cls.username == username).get()
+            if user is not None:
+                memcache.add(cache_key, user, time=cls.CACHE_SECONDS)
+        return user
+
+    @classmethod
+    def create(cls, username, display_name, email):
+        """Creates and returns a new User keyed by username, or returns None
+        if a User with that username already exists."""
+        @ndb.transactional
+        def _create_txn():
+            """Insert the User unless the username is already taken."""
+            key = ndb.Key(cls, username)
+            if key.get():
+                return None
+            user = cls(key=key,
+                       username=username,
+                       display_name=display_name,
+                       email=email)
+            ndb.put_multi([user, OpenGames(key=OpenGames.key_for(key), migrated=True)])
+            return user
+        return _create_txn()
+
+    @classmethod
+    def get_leaderboard_version(cls):
+        """Returns the version of the leaderboards, which changes whenever a
+        User is written. A lost version is replaced by one based on the
+        current time, so versions are never reused."""
+        version = memcache.get(LEADERBOARD_VERSION_KEY)
+        if version is None:
+            memcache.add(LEADERBOARD_VERSION_KEY, int(time.time() * 1000))
+            version = memcache.get(LEADERBOARD_VERSION_KEY)
+        return version
+
+    def _post_put_hook(self, future):
+        """Invalidate the cached User, and move the leaderboards to a new
+        version, once the write has been committed."""
+        cache_key = self.cache_key(self.username)
+        def _invalidate():
+            """Delete the cached User and bump the leaderboard version."""
+            memcache.delete(cache_key)
+            memcache.incr(LEADERBOARD_VERSION_KEY)
+        ndb.get_context().call_on_commit(_invalidate)
+
+    def rekey_by_username(self):
+        """Moves a User stored under an auto-generated ID to a key named by
+        its username, along with the entities keyed by the User (its
+        OpenGames, LeaderboardBuckets and UserAnalytics, its Reminder and
+        its AIStates), and repoints the User's games (as the User or as the
+        opponent) and matchmaking entry at the new key."""
+        old_key = self.key
+        new_key = ndb.Key(User, self.username)
+        if old_key == new_key:
+            return
+        if not new_key.get():
+            User(key=new_key, **self.to_dict()).put()
+        self._move_keyed_entities(old_key, new_key)
+
+        for player in (Game.user, Game.opponent):
+            query = Game.query(player == old_key)
+            cursor, more = None, True
+            while more:
+                games, cursor, more = query.fetch_page(100, start_cursor=cursor)
+                for game in games:
+                    if game.user == old_key:
+                        game.user = new_key
+                    if game.opponent == old_key:
+                        game.opponent = new_key
+                ndb.put_multi(games)
+
+        @ndb.transactional
+        def _repoint_match_request_txn():
+            """Repoint the User's matchmaking entry, if any."""
+            entry = MatchRequest.key_for(self.username).get()
+            if entry and entry.user == old_key:
+                entry.user = new_key
+                entry.put()
+        _repoint_match_request_txn()
+        old_key.delete()
+        memcache.delete(self.cache_key(self.username))
+
+    @staticmethod
+    def _move_keyed_entities(old_key, new_key):
+        """Moves the entities keyed by the User with the given old key to
+        the given new key. Entities already moved by an earlier, interrupted
+        run are kept as they are, and the old ones are deleted."""
+        moves = [(child, ndb.Key(child.key.kind(), child.key.id(), parent=new_key))
+                 for child in ndb.Query(ancestor=old_key).fetch()
+                 if child.key != old_key]
+        reminder = Reminder.key_for(old_key).get()
+        if reminder:
+            moves.append((reminder, Reminder.key_for(new_key)))
+        # AIStates are keyed by User ID, strategy and variant. The cached
+        # state may be ahead of the stored one.
+        prefix = u'{}:'.format(old_key.id())
+        states = AIState.query(AIState.key >= ndb.Key(AIState, prefix),
+                               AIState.key < ndb.Key(AIState, prefix + u'\ufffd')).fetch()
+        for state in states:
+            cached = memcache.get(AIState.cache_key(state.key))
+            moves.append((cached or state,
+                          ndb.Key(AIState, new_key.id() + state.key.id()[len(prefix) - 1:])))
+
+        moved = ndb.get_multi([key for _, key in moves])
+        ndb.put_multi([_copy_entity(entity, key)
+                       for (entity, key), stored in zip(moves, moved) if not stored])
+        ndb.delete_multi([entity.key for entity, _ in moves])
+        memcache.delete_multi([AIState.cache_key(state.key) for state in states])
+
+    def record_result(self, won, draws=0):
+        """Applies the result of a single finished game, with the given
+        number of drawn moves, to the User's aggregate stats (total games,
+        wins, win percentage, streaks and draws)."""
+        _record_result(self, won)
+        self.draws = (self.draws or 0) + draws
+
+    def recompute_stats(self):
+        """Rebuilds the User's aggregate stats from the full history of
+        completed (and not cancelled) games, both those played as the User
+        and as the opponent of a player-vs-player game. Used to backfill
+        existing data."""
+        self.total_games = 0
+        self.wins = 0
+        self.win_percentage = 0.0
+        self.current_streak = 0
+        self.longest_win_streak = 0
+        self.draws = 0
+
+        def _history(role, player):
+            """Yield the games played in the given role, in date order."""
+            games = Game.query()\
+                .filter(Game.game_over == True)\
+                .filter(Game.cancelled == False)\
+                .filter(player == self.key).order(Game.date)
+            for game in games:
+                yield game.date, role, game
+        for _, _, game in heapq.merge(_history(0, Game.user), _history(1, Game.opponent)):
+            self.record_result(game.result_for(self.key), game.drawn_moves())
+
+    @classmethod
+    def backfill_stats(cls, user_key, retries=3):
+        """Recomputes the stats of the User with the given key from their
+        game history, and stores them in a transaction unless a game of the
+        User has ended in the meantime (which changes total_games). The
+        stats are then recomputed again, up to the given number of retries.
+        Returns whether the stats were stored."""
+        for _ in range(retries):
+            user = user_key.get(use_cache=False)
+            if not user:
+                return False
+            total_games = user.total_games
+            user.recompute_stats()
+
+            @ndb.transactional
+            def _store_stats_txn():
+                """Store the recomputed stats, unless a game has ended."""
+                stored = user_key.get(use_cache=False)
+                if not stored or stored.total_games != total_games:
+                    return False
+                for name in cls.STATS:
+                    setattr(stored, name, getattr(user, name))
+                stored.put()
+                return True
+            if _store_stats_txn():
+                return True
+        return False
+
+    def get_result_counts(self):
+        """Returns a dictionary of the User's number of won and lost games
+        and of drawn moves in finished games, keyed by counters.WINS, LOSSES
+        and DRAWS."""
+        wins = self.wins or 0
+        return {counters.WINS: wins,
+                counters.LOSSES: (self.total_games or 0) - wins,
+                counters.DRAWS: self.draws or 0}
+
+    def to_form(self, result_counts=None):
+        """Returns a UserForm representation of the User. The User's result
+        counts are included if given."""
         form = UserForm()
         form.username = self.username
         form.display_name = self.display_name
         form.email = self.email
+        if result_counts is not None:
+            form.wins = result_counts[counters.WINS]
+            form.losses = result_counts[counters.LOSSES]
+            form.draws = result_counts[counters.DRAWS]
         return form
 
     def to_rank_form(self):
@@ -29,9 +279,9 @@ class User(ndb.Model):
         form = UserRankingForm()
         form.username = self.username
         form.display_name = self.display_name
-        form.total_games = self.total_games
-        form.wins = self.wins
-        form.win_percentage = '%.4f' % self.win_percentage
+        form.total_games = self.total_games or 0
+        form.wins = self.wins or 0
+        form.win_percentage = '%.4f' % (self.win_percentage or 0.0)
         return form
 
     def to_score_form(self):
@@ -39,12 +289,564 @@ class User(ndb.Model):
         form = UserScoreForm()
         form.username = self.username
         form.display_name = self.display_name
-        form.score = self.longest_win_streak
+        form.score = self.longest_win_streak or 0
+        return form
+
+
+class LeaderboardBucket(ndb.Model):
+    """A User's stats over a single leaderboard period: a day, or a week
+    starting on Monday (UTC). Stored as children of the User and updated in
+    the same transactions as the User's all-time stats (see
+    Game.save_moves), so the leaderboard of a period is a single ordered
+    query on its bucket. Expired buckets are deleted by the compaction job,
+    as their results are kept in the coarser buckets (weeks, and the
+    all-time stats of the User) updated along with them."""
+    DAY = 'day'
+    WEEK = 'week'
+    ALL_TIME = 'all'
+    PERIODS = (DAY, WEEK)
+    RETENTION = {DAY: timedelta(days=14), WEEK: timedelta(weeks=12)}
+
+    bucket = ndb.StringProperty(required=True)
+    period = ndb.StringProperty(required=True)
+    start = ndb.DateProperty(required=True)
+    username = ndb.StringProperty()
+    display_name = ndb.StringProperty()
+    total_games = ndb.IntegerProperty(default=0)
+    wins = ndb.IntegerProperty(default=0)
+    win_percentage = ndb.FloatProperty(default=0.0)
+    current_streak = ndb.IntegerProperty(default=0)
+    longest_win_streak = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    def period_start(cls, period, day):
+        """Returns the first day of the period (DAY or WEEK) holding the
+        given day."""
+        if period == cls.WEEK:
+            return day - timedelta(days=day.weekday())
+        return day
+
+    @classmethod
+    def bucket_name(cls, period, day):
+        """Returns the name of the bucket of the period holding the given
+        day, e.g. 'week:2016-05-02'."""
+        return '{}:{}'.format(period, cls.period_start(period, day).isoformat())
+
+    @classmethod
+    @ndb.tasklet
+    def get_for_async(cls, user_key, period, day):
+        """Returns a Future for the bucket of the given User for the period
+        holding the given day, or for a new, unsaved bucket if the User has
+        none stored."""
+        name = cls.bucket_name(period, day)
+        key = ndb.Key(cls, name, parent=user_key)
+        bucket = yield key.get_async()
+        raise ndb.Return(bucket or cls(key=key, bucket=name, period=period,
+                                       start=cls.period_start(period, day)))
+
+    @classmethod
+    def query_expired(cls, period):
+        """Returns a query of the buckets of the given period that are past
+        its retention."""
+        return cls.query(cls.period == period,
+                         cls.start < date.today() - cls.RETENTION[period])
+
+    def record_result(self, user, won):
+        """Applies the result of a single finished game of the given User to
+        the bucket's stats."""
+        self.username = user.username
+        self.display_name = user.display_name
+        _record_result(self, won)
+
+    def to_rank_form(self):
+        """Returns a UserRankingForm representation of the bucket."""
+        form = UserRankingForm()
+        form.username = self.username
+        form.display_name = self.display_name
+        form.total_games = self.total_games or 0
+        form.wins = self.wins or 0
+        form.win_percentage = '%.4f' % (self.win_percentage or 0.0)
         return form
 
+    def to_score_form(self):
+        """Returns a UserScoreForm representation of the bucket."""
+        form = UserScoreForm()
+        form.username = self.username
+        form.display_name = self.display_name
+        form.score = self.longest_win_streak or 0
+        return form
+
+
+class OpenGames(ndb.Model):
+    """Keys of a User's open (unfinished) games, in the order the games were
+    created. Stored as the single child entity of the User, and updated in
+    the same transactions that create and end the games, so a User's open
+    games are listed with a strongly consistent get. Users whose games
+    predate it are only listed from it once migrated (see migrate)."""
+    ID = 'open'
+
+    game_keys = ndb.KeyProperty(kind='Game', repeated=True)
+    migrated = ndb.BooleanProperty(default=False)
+    has_games = ndb.ComputedProperty(lambda self: bool(self.game_keys))
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of the OpenGames of the User with the given key."""
+        return ndb.Key(cls, cls.ID, parent=user_key)
+
+    @classmethod
+    @ndb.tasklet
+    def get_for_async(cls, user_key):
+        """Returns a Future for the OpenGames of the User with the given key,
+        or for a new, unsaved OpenGames if the User has none stored."""
+        key = cls.key_for(user_key)
+        open_games = yield key.get_async()
+        raise ndb.Return(open_games or cls(key=key))
+
+    def remove(self, game_key):
+        """Removes a game from the open games. Returns whether it was open,
+        i.e. whether the OpenGames needs to be stored."""
+        if game_key not in self.game_keys:
+            return False
+        self.game_keys.remove(game_key)
+        return True
+
+    @classmethod
+    def migrate(cls, user_key):
+        """Adds the open games of the given User found by query to their
+        OpenGames, and marks it as migrated."""
+        game_keys = Game.query(Game.game_over == False, Game.user == user_key)\
+            .fetch(keys_only=True)
+        # The query is eventually consistent, so check that the games are
+        # still open.
+        game_keys = [game.key for game in ndb.get_multi(game_keys)
+                     if game and not game.game_over]
+
+        @ndb.transactional
+        def _migrate_txn():
+            """Merge the games found into the stored open games."""
+            key = cls.key_for(user_key)
+            open_games = key.get() or cls(key=key)
+            open_games.game_keys = [game_key for game_key in game_keys
+                                    if game_key not in open_games.game_keys]\
+                + open_games.game_keys
+            open_games.migrated = True
+            open_games.put()
+        _migrate_txn()
+
+
+class MatchRequest(ndb.Model):
+    """A User's entry in the matchmaking pool of a game variant, keyed by
+    username. Waiting entries are bucketed by the User's win percentage
+    when they joined, so pairing is a single indexed query of the oldest
+    entries in the nearest buckets rather than a scan of the pool. Once
+    paired, both entries hold the key of their player-vs-player game."""
+    BUCKETS = 10
+    CANDIDATES = 5
+    PAIR_INTERVAL = 2
+    MAX_PAIR_ATTEMPTS = 30
+
+    user = ndb.KeyProperty(required=True, kind='User')
+    variant = ndb.StringProperty(required=True)
+    bucket = ndb.IntegerProperty(required=True)
+    any_skill = ndb.BooleanProperty(default=False, indexed=False)
+    waiting = ndb.BooleanProperty(default=True)
+    joined = ndb.DateTimeProperty(required=True)
+    game = ndb.KeyProperty(kind='Game', indexed=False)
+
+    @classmethod
+    def key_for(cls, username):
+        """Returns the key of the entry of the User with the given username."""
+        return ndb.Key(cls, username)
+
+    @classmethod
+    def bucket_for(cls, user):
+        """Returns the skill bucket of the given User."""
+        return min(int((user.win_percentage or 0.0) * cls.BUCKETS), cls.BUCKETS - 1)
+
+    @classmethod
+    def join(cls, user, variant, any_skill=False):
+        """Stores and returns a waiting entry of the given User for a game of
+        the given variant, replacing any previous entry. Unless any_skill is
+        set, the User is only paired with players of a similar win
+        percentage at first (see pair)."""
+        entry = cls(key=cls.key_for(user.username), user=user.key, variant=variant,
+                    bucket=cls.bucket_for(user), any_skill=any_skill, waiting=True,
+                    joined=datetime.today())
+        entry.put()
+        return entry
+
+    @classmethod
+    def leave(cls, username):
+        """Removes the waiting entry of the User with the given username.
+        Returns False, removing nothing, if the User has no entry or has
+        already been paired."""
+        @ndb.transactional
+        def _leave_txn():
+            """Delete the entry, unless it has been paired."""
+            entry = cls.key_for(username).get()
+            if not entry or not entry.waiting:
+                return False
+            entry.key.delete()
+            return True
+        return _leave_txn()
+
+    def query_candidates(self, distance):
+        """Returns a query of the waiting entries of the entry's variant in
+        the order they joined, limited to the buckets within the given
+        distance of the entry's own unless any_skill is set."""
+        query = MatchRequest.query(MatchRequest.variant == self.variant,
+                                   MatchRequest.waiting == True)
+        if not self.any_skill:
+            buckets = range(max(self.bucket - distance, 0),
+                            min(self.bucket + distance + 1, self.BUCKETS))
+            query = query.filter(MatchRequest.bucket.IN(buckets))
+        return query.order(MatchRequest.joined)
+
+    def pair(self, distance=0):
+        """Pairs the entry with the longest waiting candidate within the
+        given bucket distance (see query_candidates), creating their game.
+        Each candidate is claimed in a transaction that checks both entries
+        are still waiting, so no entry is ever paired twice. Returns the
+        entry as stored, which is still waiting if no candidate could be
+        paired with it."""
+        candidates = self.query_candidates(distance).fetch(self.CANDIDATES + 1,
+                                                           keys_only=True)
+
+        @ndb.transactional(xg=True)
+        def _pair_txn(candidate_key):
+            """Create the game of both entries, unless either has been paired
+            or has left."""
+            entry, other = ndb.get_multi([self.key, candidate_key], use_cache=False)
+            if not entry or not entry.waiting:
+                return entry
+            if not other or not other.waiting or other.variant != entry.variant:
+                return entry
+            # The player who has waited longer is the game's User, and the
+            # joining player its opponent.
+            game = Game.new_game(other.user, entry.variant, opponent=entry.user)
+            for matched in (entry, other):
+                matched.waiting = False
+                matched.game = game.key
+            ndb.put_multi([entry, other])
+            return entry
+
+        entry = self
+        for candidate_key in candidates:
+            if candidate_key == self.key:
+                continue
+            entry = _pair_txn(candidate_key)
+            if not entry or not entry.waiting:
+                break
+        return entry
+
+    def enqueue_pairing(self, attempt=1):
+        """Enqueues the task retrying to pair the entry, with the bucket
+        distance widened by one for each attempt. Tasks are named after the
+        entry and attempt, so a retried task does not enqueue a second one."""
+        try:
+            taskqueue.add(url='/tasks/pair',
+                          name='pair-{}-{}-{}'.format(self.key.urlsafe(),
+                                                      int(time.mktime(self.joined.timetuple())),
+                                                      attempt),
+                          params={'username': self.key.id(), 'attempt': attempt},
+                          countdown=self.PAIR_INTERVAL,
+                          queue_name='matchmaking')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    def to_form(self, opponent=None):
+        """Returns a MatchForm representation of the entry, with the username
+        of the opponent it has been paired with, if any."""
+        form = MatchForm()
+        form.username = self.key.id()
+        form.variant = self.variant
+        form.status = 'waiting' if self.waiting else 'matched'
+        if self.game:
+            form.urlsafe_game_key = self.game.urlsafe()
+        form.opponent = opponent
+        return form
+
+
+class Reminder(ndb.Model):
+    """Tracks when a User was last sent a reminder email. Stored apart from
+    the User, keyed by the User's ID, so that sending reminders does not
+    contend with game results being written to the User."""
+    INTERVAL = timedelta(hours=11)
+    last_sent = ndb.DateTimeProperty(required=True)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of the Reminder for the given User key."""
+        return ndb.Key(cls, user_key.id())
+
+    def is_due(self, now):
+        """Returns whether another reminder may be sent at the given time."""
+        return self.last_sent <= now - self.INTERVAL
+
+
+class AIState(ndb.Model):
+    """What an AI strategy has learned about a User's plays in a game variant,
+    as the packed array of counts kept by the strategy. Keyed by User ID,
+    strategy and variant, and cached in memcache. The cached state is updated
+    after every play, and only stored every STORE_EVERY plays, so the AI does
+    not add a write to every play."""
+    # AI states are cached in memcache by get_for, so ndb's own memcache
+    # caching is not needed on top of that.
+    _use_memcache = False
+    STORE_EVERY = 10
+
+    counts = ndb.BlobProperty()
+    plays = ndb.IntegerProperty(default=0)
+    stored_plays = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    def key_for(cls, game):
+        """Returns the key of the AIState used to play the given game."""
+        return ndb.Key(cls, '{}:{}:{}'.format(game.user.id(),
+                                              game.strategy or strategies.DEFAULT_STRATEGY,
+                                              game.variant or rules.DEFAULT_VARIANT))
+
+    @classmethod
+    def cache_key(cls, key):
+        """Returns the memcache key for the AIState with the given key."""
+        return 'ai:{}'.format(key.id())
+
+    @classmethod
+    def get_for(cls, game):
+        """Returns the AIState used to play the given game, reading through
+        memcache. Strategies without state are never read or stored."""
+        strategy = game.get_strategy()
+        key = cls.key_for(game)
+        state = None
+        if strategy.state_size():
+            state = memcache.get(cls.cache_key(key))
+            if state is None:
+                state = key.get()
+        if state is None:
+            state = cls(key=key)
+        state.strategy = strategy
+        if state.counts:
+            state.state = array('i')
+            state.state.fromstring(state.counts)
+        else:
+            state.state = strategy.new_state()
+        return state
+
+    def choose(self):
+        """Returns the play code for the AI to play next."""
+        return self.strategy.choose(self.state)
+
+    def record(self, play):
+        """Updates the state with the User's given play code."""
+        self.strategy.update(self.state, play)
+        self.plays = (self.plays or 0) + 1
+
+    def store(self):
+        """Caches the updated state, and stores it if at least STORE_EVERY
+        plays have been recorded since it was last stored."""
+        self.store_async().get_result()
+
+    @ndb.tasklet
+    def store_async(self):
+        """Asynchronous version of store: the state is cached and stored
+        concurrently, and with any other RPCs in flight."""
+        if not self.strategy.state_size():
+            return
+        self.counts = self.state.tostring()
+        futures = [ndb.get_context().memcache_set(self.cache_key(self.key), self)]
+        if self.plays - (self.stored_plays or 0) >= self.STORE_EVERY:
+            self.stored_plays = self.plays
+            futures.append(self.put_async())
+        yield futures
+
+
+class Stats(ndb.Model):
+    """Precomputed global game stats, stored as a single entity and cached in
+    memcache. Finished games are folded in by the stats task in order of
+    their date. The task's watermark is the date of the last game folded in,
+    along with the keys of the games folded in with that same date."""
+    # Stats are cached in memcache by get_current, so ndb's own memcache
+    # caching is not needed on top of that.
+    _use_memcache = False
+    ID = 'global'
+    CACHE_KEY = 'stats:global'
+    # Games ending within the same window are folded in by a single task.
+    COALESCE_SECONDS = 10
+    # A game's date is set before the transaction ending it commits, and the
+    # task's query is eventually consistent, so games are only folded in
+    # once they ended this long ago: by then every game dated before them
+    # has been committed and indexed.
+    FOLD_LAG = 60
+
+    games = ndb.IntegerProperty(default=0)
+    moves = ndb.IntegerProperty(default=0)
+    draws = ndb.IntegerProperty(default=0)
+    play_counts = ndb.JsonProperty()
+    first_game_date = ndb.DateTimeProperty()
+    last_game_date = ndb.DateTimeProperty()
+    last_game_keys = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+
+    @classmethod
+    def get_current(cls):
+        """Returns the current Stats, reading through memcache. Returns an
+        empty Stats if no game has been folded in yet."""
+        stats = memcache.get(cls.CACHE_KEY)
+        if stats is None:
+            stats = cls.get_by_id(cls.ID) or cls(id=cls.ID)
+            memcache.add(cls.CACHE_KEY, stats)
+        return stats
+
+    @classmethod
+    def schedule_update(cls):
+        """Enqueues the task folding newly finished games into the Stats.
+        Tasks are named after the current coalescing window, so any number
+        of games ending within one window enqueue a single task. The task
+        runs once the games of the window are older than FOLD_LAG."""
+        window = int(time.time() // cls.COALESCE_SECONDS)
+        try:
+            taskqueue.add(url='/tasks/cache_average_attempts',
+                          name='stats-{}'.format(window),
+                          countdown=cls.FOLD_LAG + cls.COALESCE_SECONDS,
+                          queue_name='stats')
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+        except taskqueue.Error:
+            # The games are picked up by the next task, so a failed enqueue
+            # must not fail the play that ended the game.
+            logging.warning('Could not enqueue the stats task', exc_info=True)
+
+    def add_game(self, game, moves):
+        """Folds a single finished game and its Moves into the Stats."""
+        play_counts = self.play_counts or {}
+        self.games = (self.games or 0) + 1
+        self.moves = (self.moves or 0) + len(moves)
+        for move in moves:
+            if move.play == move.ai_play:
+                self.draws = (self.draws or 0) + 1
+            play_counts[move.play] = play_counts.get(move.play, 0) + 1
+        self.play_counts = play_counts
+        if not self.first_game_date:
+            self.first_game_date = game.date
+
+    def is_folded(self, game):
+        """Returns whether the given game, dated no earlier than the
+        watermark, has already been folded in."""
+        return game.date == self.last_game_date and game.key in self.last_game_keys
+
+    def advance_watermark(self, game):
+        """Moves the watermark past the given game, the next one in date
+        order, whether or not it was counted."""
+        if game.date != self.last_game_date:
+            self.last_game_date = game.date
+            self.last_game_keys = []
+        self.last_game_keys.append(game.key)
+
+    def to_form(self):
+        """Returns a StatsForm representation of the Stats."""
+        games = self.games or 0
+        moves = self.moves or 0
+        play_counts = self.play_counts or {}
+        form = StatsForm()
+        form.games = games
+        form.moves = moves
+        form.average_moves = float(moves) / games if games else 0.0
+        form.draw_rate = float(self.draws or 0) / moves if moves else 0.0
+        if self.first_game_date:
+            days = (self.last_game_date - self.first_game_date).days + 1
+            form.games_per_day = float(games) / days
+        else:
+            form.games_per_day = 0.0
+        counts = counters.get_counts([counters.counter_name(result) for result in
+                                      (counters.WINS, counters.LOSSES, counters.DRAWS)])
+        form.wins = counts[counters.counter_name(counters.WINS)]
+        form.losses = counts[counters.counter_name(counters.LOSSES)]
+        form.draws = counts[counters.counter_name(counters.DRAWS)]
+        form.plays = [PlayCountForm(play=play,
+                                    count=count,
+                                    percentage=float(count) / moves if moves else 0.0)
+                      for play, count in sorted(play_counts.items())]
+        return form
+
+
+def _play_count_forms(play_counts):
+    """Returns PlayCountForms of the given play counts, keyed by play name,
+    in order of play name."""
+    total = sum(play_counts.values())
+    return [PlayCountForm(play=play,
+                          count=count,
+                          percentage=float(count) / total if total else 0.0)
+            for play, count in sorted(play_counts.items())]
+
+
+class AnalyticsSummary(ndb.Model):
+    """Aggregates of the game history computed offline by analytics.py from
+    an export, and imported as a chunk of the export format. Stored as a
+    single entity, replaced by each run."""
+    ID = 'global'
+
+    computed = ndb.DateTimeProperty()
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    moves = ndb.IntegerProperty(default=0, indexed=False)
+    play_counts = ndb.JsonProperty(default={})
+    ai_play_counts = ndb.JsonProperty(default={})
+    first_play_counts = ndb.JsonProperty(default={})
+    # Number of win streaks of each length, from 1.
+    streak_lengths = ndb.JsonProperty(default=[])
+    ai_games = ndb.IntegerProperty(default=0, indexed=False)
+    ai_wins = ndb.IntegerProperty(default=0, indexed=False)
+    # [games, AI wins] per AI strategy.
+    strategies = ndb.JsonProperty(default={})
+
+    def to_form(self, user_analytics=None):
+        """Returns an AnalyticsForm representation of the summary, with the
+        given UserAnalytics of a User, if any."""
+        form = AnalyticsForm()
+        form.computed = str(self.computed)
+        form.games = self.games or 0
+        form.moves = self.moves or 0
+        form.plays = _play_count_forms(self.play_counts or {})
+        form.ai_plays = _play_count_forms(self.ai_play_counts or {})
+        form.first_plays = _play_count_forms(self.first_play_counts or {})
+        form.streak_lengths = [StreakCountForm(length=length, count=count)
+                               for length, count in enumerate(self.streak_lengths or [], 1)
+                               if count]
+        form.ai_games = self.ai_games or 0
+        form.ai_win_rate = float(self.ai_wins or 0) / self.ai_games if self.ai_games else 0.0
+        form.strategies = [AIWinRateForm(strategy=strategy,
+                                         games=games,
+                                         ai_win_rate=float(wins) / games if games else 0.0)
+                           for strategy, (games, wins) in sorted((self.strategies or {}).items())]
+        if user_analytics:
+            form.user_ai_games = user_analytics.ai_games or 0
+            form.user_ai_win_rate = user_analytics.ai_win_rate()
+        return form
+
+
+class UserAnalytics(ndb.Model):
+    """A User's aggregates of the last AnalyticsSummary run: their games
+    against the AI and how many the AI won. Stored as a child of the User."""
+    ID = 'analytics'
+
+    ai_games = ndb.IntegerProperty(default=0, indexed=False)
+    ai_wins = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key of the UserAnalytics of the User with the given
+        key."""
+        return ndb.Key(cls, cls.ID, parent=user_key)
+
+    def ai_win_rate(self):
+        """Returns the fraction of the User's games the AI won."""
+        return float(self.ai_wins or 0) / self.ai_games if self.ai_games else 0.0
+
 
 class Move(ndb.Model):
-    """Move object."""
+    """Move object. The moves of a game are packed into its move_data, and
+    Moves are decoded from it on read. Games whose moves have not yet been
+    packed (see Game.pack_moves) store them as child entities, with IDs
+    numbering the moves from 1."""
     play = ndb.StringProperty(required=True, default='')
     ai_play = ndb.StringProperty(required=True, default='')
     result = ndb.StringProperty(required=True, default='')
@@ -54,9 +856,22 @@ class Move(ndb.Model):
         return {'play': str(self.play), 'ai_play': str(self.ai_play),\
                 'result': str(self.result)}
 
+    def to_form(self, number=None):
+        """Returns a MoveForm representation of the Move. The move number
+        defaults to the ID of the Move's key."""
+        return MoveForm(number=number or self.key.id(),
+                        play=self.play,
+                        ai_play=self.ai_play,
+                        result=self.result)
+
 
 class Game(ndb.Model):
     """Game object."""
+    # Open games with no move made for this long are cancelled by the
+    # abandoned games sweeper (see cancel_abandoned).
+    INACTIVITY_TTL = timedelta(days=30)
+    ABANDONED_MSG = 'Game cancelled after {} days without a move.'
+
     play = ndb.StringProperty(required=True, default='')
     ai_play = ndb.StringProperty(required=True, default='')
     game_over = ndb.BooleanProperty(required=True, default=False)
@@ -65,22 +880,393 @@ class Game(ndb.Model):
     date = ndb.DateTimeProperty(required=True)
     message = ndb.StringProperty(required=True, default='')
     cancelled = ndb.BooleanProperty(required=True, default=False)
+    variant = ndb.StringProperty(default=rules.DEFAULT_VARIANT)
+    strategy = ndb.StringProperty(default=strategies.DEFAULT_STRATEGY)
+    move_count = ndb.IntegerProperty(default=0)
+    version = ndb.IntegerProperty(default=0)
+    # When the game was created or last played. None for games created
+    # before it was tracked, until backfilled.
+    last_move_at = ndb.DateTimeProperty()
+    # The second player of a player-vs-player game, whose plays are stored
+    # as the ai_play of the game and its moves. None for games against the
+    # AI.
+    opponent = ndb.KeyProperty(kind='User')
+    # Play codes of the current round of a player-vs-player game, sealed
+    # until both players have played (see submit_play).
+    sealed_play = ndb.IntegerProperty(indexed=False)
+    sealed_opponent_play = ndb.IntegerProperty(indexed=False)
+    # Move history packed by packing.PackedMoves. None for games whose
+    # moves are stored as child Move entities or inline, until packed.
+    move_data = ndb.BlobProperty()
+    # Legacy inline move history. Packed into move_data the next time a
+    # move is made (see new_move).
     moves = ndb.StructuredProperty(Move, repeated=True)
 
     @classmethod
-    def new_game(cls, user):
-        """Creates and returns a new game."""
+    def new_game(cls, user, variant=None, strategy=None, opponent=None):
+        """Creates and returns a new game of the given variant against the
+        given AI strategy, or of the classic variant against the random
+        strategy if none are given. Given the key of an opponent User, the
+        game is a player-vs-player game against them instead."""
+        now = datetime.today()
         game = Game(user=user,
-                    date=datetime.today(),
-                    game_over=False)
-        game.put()
+                    opponent=opponent,
+                    date=now,
+                    last_move_at=now,
+                    game_over=False,
+                    variant=variant or rules.DEFAULT_VARIANT,
+                    strategy=None if opponent else strategy or strategies.DEFAULT_STRATEGY)
+
+        @ndb.transactional_tasklet(xg=True)
+        def _new_game_txn():
+            """Store the game and add it to the players' open games, which
+            are read while the game is being put."""
+            open_games_futures = [OpenGames.get_for_async(player) for player in game.players()]
+            yield game.put_async()
+            for open_games_future in open_games_futures:
+                open_games = yield open_games_future
+                open_games.game_keys.append(game.key)
+                yield open_games.put_async()
+        _new_game_txn().get_result()
         return game
 
-    def to_form(self, message=''):
-        """Returns a GameForm representation of the Game."""
+    def players(self):
+        """Returns the keys of the Users playing the game: the User, and the
+        opponent of a player-vs-player game."""
+        return [self.user, self.opponent] if self.opponent else [self.user]
+
+    def result_for(self, player):
+        """Returns whether the player with the given User key won the game."""
+        return self.won if player == self.user else not self.won
+
+    @classmethod
+    def submit_play(cls, game_key, player, play):
+        """Seals the given play code of the player with the given User key in
+        a player-vs-player game. Once both players have played, the round is
+        applied as by apply_play and saved as by save_moves, within the same
+        transaction, so concurrent plays are never lost. Returns the game as
+        stored, the Move of the round if it was resolved (or else None), and
+        whether the play was accepted: it is not if the game is over or the
+        player has already played this round."""
+        @ndb.transactional(xg=True)
+        def _submit_play_txn():
+            """Seal the play, and resolve the round once both are sealed."""
+            # Not cached, so that save_moves reads the game as stored.
+            game = game_key.get(use_cache=False)
+            slot = 'sealed_play' if player == game.user else 'sealed_opponent_play'
+            if game.game_over or getattr(game, slot) is not None:
+                return game, None, False
+            setattr(game, slot, play)
+            game.last_move_at = datetime.today()
+            if game.sealed_play is None or game.sealed_opponent_play is None:
+                game.put()
+                return game, None, True
+            move = game.apply_play(game.sealed_play, game.sealed_opponent_play)
+            game.sealed_play = game.sealed_opponent_play = None
+            if not game.save_moves([move]):
+                raise datastore_errors.TransactionFailedError('Game changed while saved')
+            return game, move, True
+        return _submit_play_txn()
+
+    def _pre_put_hook(self):
+        """Stamp every write of the game with a new version, so responses
+        cached for an older version are never served."""
+        self.version = (self.version or 0) + 1
+
+    def etag(self):
+        """Returns the ETag of the game's current state."""
+        return str(self.version or 0)
+
+    @classmethod
+    def get_usernames(cls, games):
+        """Returns a dictionary mapping the User keys of the players of the
+        given games to their usernames, resolving all distinct users in a
+        single batch get."""
+        return cls.get_usernames_async(games).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_usernames_async(cls, games):
+        """Asynchronous version of get_usernames."""
+        user_keys = list(set(player for game in games for player in game.players()))
+        users = yield ndb.get_multi_async(user_keys)
+        raise ndb.Return(dict((user.key, user.username) for user in users if user))
+
+    @classmethod
+    def get_moves(cls, games):
+        """Returns a list holding, for each of the given games, a list of the
+        move number and Move of each move made in the game. The Moves of all
+        games are fetched in a single batch."""
+        return cls.get_moves_async(games).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_moves_async(cls, games):
+        """Asynchronous version of get_moves."""
+        move_keys = [game.move_keys() for game in games]
+        all_moves = iter((yield ndb.get_multi_async(
+            [key for keys in move_keys for key in keys])))
+        game_moves = []
+        for game, keys in zip(games, move_keys):
+            moves = [next(all_moves) for _ in keys]
+            if game.has_packed_moves():
+                game_moves.append(list(game.iter_moves()))
+            else:
+                game_moves.append([(move.key.id(), move) for move in moves if move])
+        raise ndb.Return(game_moves)
+
+    @classmethod
+    def to_forms(cls, games):
+        """Returns a list of GameForm representations of the given games,
+        fetching the users and moves of all games in one batch each."""
+        return cls.to_forms_async(games).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def to_forms_async(cls, games):
+        """Asynchronous version of to_forms. The batches of users and of
+        moves are fetched concurrently."""
+        usernames, game_moves = yield (cls.get_usernames_async(games),
+                                       cls.get_moves_async(games))
+        forms = []
+        for game, moves in zip(games, game_moves):
+            move_forms = [move.to_form(number) for number, move in moves]
+            forms.append(game.to_form(usernames=usernames, move_forms=move_forms))
+        raise ndb.Return(forms)
+
+    def get_move_count(self):
+        """Returns the number of moves made in the game."""
+        return self.move_count or len(self.moves)
+
+    def has_packed_moves(self):
+        """Returns whether the game's moves are read from move_data (or from
+        the legacy inline history), rather than from child Move entities.
+        This is the case for all games but those with child Moves that have
+        not been packed yet."""
+        return self.move_data is not None or not self.move_count
+
+    def packed_moves(self):
+        """Returns the PackedMoves of the game's move history, packing any
+        legacy inline history."""
+        game_rules = self.get_rules()
+        if self.moves:
+            packed = packing.PackedMoves(game_rules.size)
+            for move in self.moves:
+                packed.append(game_rules.code(move.play), game_rules.code(move.ai_play))
+            return packed
+        return packing.PackedMoves(game_rules.size, self.move_count or 0,
+                                   self.move_data or '')
+
+    def _decode_moves(self, last=None):
+        """Yields the move number and the Rules index of the pair of plays
+        of each packed move, or of only the last number of them if
+        specified. Only these moves are decoded."""
+        packed = self.packed_moves()
+        first = max(len(packed) - last, 0) if last else 0
+        for number, index in enumerate(packed.indexes(first), first + 1):
+            yield number, index
+
+    def _packed_move_forms(self, last=None):
+        """Returns the MoveForms of the packed moves, or of only the last
+        number of them if specified."""
+        game_rules = self.get_rules()
+        plays, size, messages = game_rules.plays, game_rules.size, game_rules.messages
+        return [MoveForm(number=number, play=plays[index // size],
+                         ai_play=plays[index % size], result=messages[index])
+                for number, index in self._decode_moves(last)]
+
+    def move_keys(self, last=None):
+        """Returns the keys of the Moves stored as children of the game, or
+        of only the last number of them if specified. Games with packed moves
+        have none."""
+        if self.has_packed_moves():
+            return []
+        count = self.move_count or 0
+        first = max(count - last, 0) if last else 0
+        return [ndb.Key(Move, number, parent=self.key)
+                for number in range(first + 1, count + 1)]
+
+    def iter_moves(self, last=None, batch_size=100):
+        """Yields the move number and Move for each move made in the game, in
+        order, or for only the last number of them if specified. Packed
+        moves are decoded one by one, and child Moves fetched in batches, so
+        long histories are never loaded all at once."""
+        if self.has_packed_moves():
+            game_rules = self.get_rules()
+            plays, size, messages = game_rules.plays, game_rules.size, game_rules.messages
+            for number, index in self._decode_moves(last):
+                yield number, Move(play=plays[index // size], ai_play=plays[index % size],
+                                   result=messages[index])
+            return
+        keys = self.move_keys(last)
+        for index in range(0, len(keys), batch_size):
+            for move in ndb.get_multi(keys[index:index + batch_size]):
+                if move:
+                    yield move.key.id(), move
+
+    @ndb.tasklet
+    def move_forms_async(self):
+        """Returns a Future for the MoveForms of all moves made in the game,
+        in order. Child Moves are fetched in a single batch."""
+        if self.has_packed_moves():
+            raise ndb.Return(self._packed_move_forms())
+        moves = yield ndb.get_multi_async(self.move_keys())
+        raise ndb.Return([move.to_form(move.key.id()) for move in moves if move])
+
+    def new_move(self, play, ai_play, result):
+        """Returns the next Move of the game. Unless the game still stores
+        its moves as child Moves, the move is packed into move_data, along
+        with any legacy inline history. Nothing is stored until the Move is
+        passed to save_moves or end_game."""
+        if self.has_packed_moves():
+            game_rules = self.get_rules()
+            packed = self.packed_moves()
+            packed.append(game_rules.code(play), game_rules.code(ai_play))
+            self.move_data = packed.tostring()
+            self.moves = []
+        self.move_count = self.get_move_count() + 1
+        self.last_move_at = datetime.today()
+        return Move(parent=self.key, id=self.move_count,
+                    play=play, ai_play=ai_play, result=result)
+
+    def drawn_moves(self):
+        """Returns the number of drawn moves of a game ended by a move: all
+        but the last, as any other outcome ends the game."""
+        return max(self.get_move_count() - 1, 0)
+
+    def get_rules(self):
+        """Returns the Rules of the game's variant."""
+        return rules.get_rules(self.variant)
+
+    def get_strategy(self):
+        """Returns the AI strategy the game is played against."""
+        return strategies.get_strategy(self.strategy, self.get_rules().size)
+
+    def apply_play(self, play, ai_play):
+        """Applies a round of the given user and AI play codes to the game,
+        and returns its Move. A round that is not a tie ends the game. Neither
+        the game nor the Move is stored until passed to save_moves."""
+        game_rules = self.get_rules()
+        outcome, msg = game_rules.resolve(play, ai_play)
+        move = self.new_move(game_rules.plays[play], game_rules.plays[ai_play], msg)
+        if outcome != rules.TIE:
+            self.play = move.play
+            self.ai_play = move.ai_play
+            self.won = outcome == rules.WIN
+            self.game_over = True
+            self.message = msg
+        return move
+
+    def _moves_to_put(self, moves):
+        """Returns the Move entities to store along with the game: none if
+        the moves are packed into the game, or else the child Moves."""
+        return [] if self.has_packed_moves() else list(moves)
+
+    @staticmethod
+    def _is_current(stored, version):
+        """Returns whether the stored game is still in the state it was read
+        in at the given version: it is not over, and has not been written
+        since (by a play, a sealed play, a cancellation or packing)."""
+        if not stored or stored.game_over:
+            return False
+        return (stored.version or 0) == (version or 0)
+
+    def save_moves(self, moves):
+        """Stores the game and its new Moves in a single transaction. If the
+        Moves ended the game, the transaction also removes it from the open
+        games of each player (the User, and the opponent of a
+        player-vs-player game) and applies the result to their aggregate
+        stats and LeaderboardBuckets of the day and week, and the game is
+        then folded into the global Stats by a coalesced task. Cancelled
+        games are not counted towards either. Returns False, without saving
+        anything, if the game has changed since it was read."""
+        return self.save_moves_async(moves).get_result()
+
+    @ndb.tasklet
+    def save_moves_async(self, moves):
+        """Asynchronous version of save_moves. Within the transaction, the
+        entities it reads are fetched concurrently, and then all writes are
+        made concurrently. The global counters are incremented by a task
+        enqueued in the transaction, so their shards add no contention to
+        it."""
+        ending = self.game_over
+        counted = ending and not self.cancelled
+        if ending:
+            self.date = datetime.today()
+        entities = [self] + self._moves_to_put(moves)
+        version = self.version
+
+        @ndb.transactional_tasklet(xg=True)
+        def _save_moves_txn():
+            """Store the game and moves, unless the game has changed."""
+            # The put of a failed attempt has already bumped the version, so
+            # each attempt starts again from the version the game was read at.
+            self.version = version
+            players = self.players()
+            stored_future = self.key.get_async()
+            open_games_futures = [OpenGames.get_for_async(player) for player in players]\
+                if ending else []
+            user_futures = [player.get_async() for player in players] if counted else []
+            bucket_futures = [[LeaderboardBucket.get_for_async(player, period, self.date.date())
+                               for period in LeaderboardBucket.PERIODS]
+                              for player in players] if counted else []
+            if not self._is_current((yield stored_future), version):
+                raise ndb.Return(False)
+            to_put = list(entities)
+            for open_games_future in open_games_futures:
+                open_games = yield open_games_future
+                if open_games.remove(self.key):
+                    to_put.append(open_games)
+            # Drawn moves are counted once the game is over, as by the User
+            # stats and the Stats.
+            deltas = {counters.counter_name(counters.DRAWS): self.drawn_moves()}
+            for user_future, player_bucket_futures in zip(user_futures, bucket_futures):
+                user = yield user_future
+                won = self.result_for(user.key)
+                user.record_result(won, self.drawn_moves())
+                to_put.append(user)
+                for bucket in (yield player_bucket_futures):
+                    bucket.record_result(user, won)
+                    to_put.append(bucket)
+                result = counters.counter_name(counters.WINS if won else counters.LOSSES)
+                deltas[result] = deltas.get(result, 0) + 1
+            if counted:
+                counters.add_increments(self.key.urlsafe(), deltas)
+            yield ndb.put_multi_async(to_put)
+            raise ndb.Return(True)
+        saved = yield _save_moves_txn()
+        if saved and counted:
+            Stats.schedule_update()
+        raise ndb.Return(saved)
+
+    def to_form(self, message='', usernames=None, move_forms=None):
+        """Returns a GameForm representation of the Game. A dictionary of
+        pre-resolved usernames keyed by User key, and the MoveForms of the
+        game's moves, may be passed in to avoid fetching them."""
+        return self.to_form_async(message, usernames, move_forms).get_result()
+
+    @ndb.tasklet
+    def to_form_async(self, message='', usernames=None, move_forms=None):
+        """Asynchronous version of to_form. The Users and the Moves, if not
+        passed in, are fetched concurrently."""
+        missing = [player for player in self.players()
+                   if usernames is None or player not in usernames]
+        users_future = ndb.get_multi_async(missing) if missing else None
+        moves_future = self.move_forms_async() if move_forms is None else None
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.username = self.user.get().username
+        if users_future:
+            usernames = dict(usernames or {})
+            for user in (yield users_future):
+                if user:
+                    usernames[user.key] = user.username
+        form.username = usernames[self.user]
+        if self.opponent:
+            form.opponent = usernames[self.opponent]
+            form.sealed = [usernames[player] for player, play in
+                           ((self.user, self.sealed_play),
+                            (self.opponent, self.sealed_opponent_play))
+                           if play is not None]
         form.game_over = self.game_over
         form.message = message if message != '' else self.message
         form.ai_play = self.ai_play
@@ -88,24 +1274,128 @@ class Game(ndb.Model):
         form.won = self.won
         form.date = str(self.date)
         form.cancelled = self.cancelled
-        for index, move in enumerate(self.moves):
-            self.moves[index] = move.to_dict()
-        form.moves = ', '.join(map(str, self.moves))
-        return form
+        form.variant = self.variant or rules.DEFAULT_VARIANT
+        if not self.opponent:
+            form.strategy = self.strategy or strategies.DEFAULT_STRATEGY
+        form.etag = self.etag()
+        if moves_future:
+            move_forms = yield moves_future
+        form.moves = move_forms
+        raise ndb.Return(form)
+
+    def to_history_form(self, last=None):
+        """Returns a GameHistoryForm representation of the Game moves, or of
+        only the last number of them if specified. Only those moves are
+        decoded or fetched."""
+        if self.has_packed_moves():
+            move_forms = self._packed_move_forms(last)
+        else:
+            move_forms = [move.to_form(number) for number, move in self.iter_moves(last)]
+        return GameHistoryForm(move_count=self.get_move_count(),
+                               moves=move_forms,
+                               etag=self.etag())
 
-    def to_history_form(self):
-        """Returns a StringMessage representation of the Game moves."""
-        # Convert each move to a dictionary for pretty output
-        for index, move in enumerate(self.moves):
-            self.moves[index] = move.to_dict()
-        return StringMessage(message=', '.join(map(str, self.moves)))
+    def end_game(self, won=False, move=None):
+        """Ends the game. Update necessary attributes for Game object, and
+        store it with the final Move (if any) as described in save_moves.
+        Returns False, without saving anything, if the game has changed since
+        it was read."""
+        return self.end_game_async(won, move).get_result()
 
-    def end_game(self, won=False):
-        """Ends the game. Update necessary attributes for Game object."""
+    def end_game_async(self, won=False, move=None):
+        """Asynchronous version of end_game."""
         self.game_over = True
         self.won = won
-        self.date = datetime.today()
-        self.put()
+        return self.save_moves_async([move] if move else [])
+
+    @classmethod
+    def query_abandoned(cls, ttl=None):
+        """Returns a query of the open games with no move made within the
+        given inactivity TTL (INACTIVITY_TTL by default). Only the abandoned
+        games are read from the (game_over, last_move_at) index, however
+        many games there are."""
+        cutoff = datetime.today() - (ttl or cls.INACTIVITY_TTL)
+        return cls.query(cls.game_over == False, cls.last_move_at < cutoff)
+
+    @classmethod
+    def cancel_abandoned(cls, game_keys, ttl=None):
+        """Cancels the given abandoned games. Each game is cancelled as by
+        cancel_game, in a transaction (see save_moves) that removes it from
+        its players' open games, and is skipped if it has been played or
+        ended since it was read. The games of each User are cancelled one
+        after another, as their transactions would contend for the User's
+        OpenGames, and the Users' games concurrently. Cancelled games are
+        not counted towards any stats, so no User is written. Returns the
+        number of games cancelled."""
+        ttl = ttl or cls.INACTIVITY_TTL
+        cutoff = datetime.today() - ttl
+        games_by_user = {}
+        for game in ndb.get_multi(game_keys):
+            if game and not game.game_over and game.last_move_at\
+                    and game.last_move_at < cutoff:
+                games_by_user.setdefault(game.user, []).append(game)
+
+        @ndb.tasklet
+        def _cancel_async(games):
+            """Cancel the given games in turn. Returns the number cancelled."""
+            cancelled = 0
+            for game in games:
+                game.cancelled = True
+                game.message = cls.ABANDONED_MSG.format(ttl.days)
+                game.sealed_play = game.sealed_opponent_play = None
+                try:
+                    if (yield game.end_game_async(True)):
+                        cancelled += 1
+                except datastore_errors.TransactionFailedError:
+                    # Left open, for the next sweep.
+                    logging.warning('Could not cancel abandoned game %s', game.key,
+                                    exc_info=True)
+            raise ndb.Return(cancelled)
+        futures = [_cancel_async(games) for games in games_by_user.values()]
+        return sum(future.get_result() for future in futures)
+
+    def pack_moves(self):
+        """Packs the moves of a game stored as child Moves, or inline, into
+        move_data, then deletes the child Moves. Returns False, without
+        packing anything, if the moves are already packed or a move has been
+        saved since the game was read."""
+        if self.move_data is not None or (not self.move_count and not self.moves):
+            return False
+        if self.moves:
+            packed = self.packed_moves()
+        else:
+            game_rules = self.get_rules()
+            packed = packing.PackedMoves(game_rules.size)
+            for _, move in self.iter_moves():
+                packed.append(game_rules.code(move.play), game_rules.code(move.ai_play))
+        move_keys = self.move_keys()
+        count = self.get_move_count()
+
+        @ndb.transactional
+        def _pack_moves_txn():
+            """Store the packed moves, unless a move has been saved since."""
+            game = self.key.get()
+            if not game or game.move_data is not None or game.get_move_count() != count:
+                return False
+            game.move_data = packed.tostring()
+            game.move_count = len(packed)
+            game.moves = []
+            game.put()
+            return True
+        if not _pack_moves_txn():
+            return False
+        # The child Moves are no longer read once move_data is stored.
+        for index in range(0, len(move_keys), 500):
+            ndb.delete_multi(move_keys[index:index + 500])
+        return True
+
+
+class MoveForm(messages.Message):
+    """MoveForm for outbound information about a single move."""
+    number = messages.IntegerField(1, required=True)
+    play = messages.StringField(2, required=True)
+    ai_play = messages.StringField(3, required=True)
+    result = messages.StringField(4, required=True)
 
 
 class GameForm(messages.Message):
@@ -119,27 +1409,71 @@ class GameForm(messages.Message):
     won = messages.BooleanField(7, required=True, default=False)
     date = messages.StringField(8, required=True)
     cancelled = messages.BooleanField(9, required=True, default=False)
-    moves = messages.StringField(10, required=True)
+    moves = messages.MessageField(MoveForm, 10, repeated=True)
+    variant = messages.StringField(11)
+    strategy = messages.StringField(12)
+    etag = messages.StringField(13)
+    not_modified = messages.BooleanField(14, default=False)
+    opponent = messages.StringField(15)
+    sealed = messages.StringField(16, repeated=True)
 
 
 class GameForms(messages.Message):
     """Return multiple GameForm objects."""
     games = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class GameHistoryForm(messages.Message):
     """GameHistoryForm for outbound game history information."""
-    moves = messages.StringField(1, required=True)
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+    move_count = messages.IntegerField(2, required=True)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4, default=False)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     username = messages.StringField(1, required=True)
+    variant = messages.StringField(2)
+    strategy = messages.StringField(3)
 
 
 class MakePlayForm(messages.Message):
-    """Used to make a play in an existing game."""
+    """Used to make a play in an existing game. The username of the player
+    is required in player-vs-player games."""
+    play = messages.StringField(1, required=True)
+    username = messages.StringField(2)
+
+
+class PlayForm(messages.Message):
+    """PlayForm for a single play in a batch of plays."""
     play = messages.StringField(1, required=True)
+    urlsafe_game_key = messages.StringField(2)
+
+
+class MakePlaysForm(messages.Message):
+    """Used to make a batch of plays. Plays without a game key are made in
+    the game of urlsafe_game_key."""
+    plays = messages.MessageField(PlayForm, 1, repeated=True)
+    urlsafe_game_key = messages.StringField(2)
+
+
+class PlayResultForm(messages.Message):
+    """PlayResultForm for outbound information about the result of a play
+    in a batch of plays."""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    play = messages.StringField(2, required=True)
+    accepted = messages.BooleanField(3, required=True)
+    message = messages.StringField(4, required=True)
+    ai_play = messages.StringField(5)
+    game_over = messages.BooleanField(6)
+    won = messages.BooleanField(7)
+
+
+class PlayResultForms(messages.Message):
+    """Return multiple PlayResultForms."""
+    results = messages.MessageField(PlayResultForm, 1, repeated=True)
 
 
 class UserForm(messages.Message):
@@ -147,11 +1481,15 @@ class UserForm(messages.Message):
     username = messages.StringField(1, required=True)
     display_name = messages.StringField(2, required=True)
     email = messages.StringField(3, required=True)
+    wins = messages.IntegerField(4)
+    losses = messages.IntegerField(5)
+    draws = messages.IntegerField(6)
 
 
 class UserForms(messages.Message):
     """Return multiple UserForms."""
     users = messages.MessageField(UserForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class UserRankingForm(messages.Message):
@@ -166,6 +1504,9 @@ class UserRankingForm(messages.Message):
 class UserRankingForms(messages.Message):
     """Return multiple UserRankingForms."""
     rankings = messages.MessageField(UserRankingForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4, default=False)
 
 
 class UserScoreForm(messages.Message):
@@ -179,6 +1520,99 @@ class UserScoreForm(messages.Message):
 class UserScoreForms(messages.Message):
     """Return multiple UserScoreForms."""
     scores = messages.MessageField(UserScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4, default=False)
+
+
+class PlayCountForm(messages.Message):
+    """PlayCountForm for outbound information about how often a play is made."""
+    play = messages.StringField(1, required=True)
+    count = messages.IntegerField(2, required=True)
+    percentage = messages.FloatField(3, required=True)
+
+
+class StatsForm(messages.Message):
+    """StatsForm for outbound global game stats."""
+    games = messages.IntegerField(1, required=True)
+    moves = messages.IntegerField(2, required=True)
+    average_moves = messages.FloatField(3, required=True)
+    draw_rate = messages.FloatField(4, required=True)
+    games_per_day = messages.FloatField(5, required=True)
+    plays = messages.MessageField(PlayCountForm, 6, repeated=True)
+    wins = messages.IntegerField(7)
+    losses = messages.IntegerField(8)
+    draws = messages.IntegerField(9)
+
+
+class StreakCountForm(messages.Message):
+    """StreakCountForm for outbound information about how many win streaks
+    of a length were played."""
+    length = messages.IntegerField(1, required=True)
+    count = messages.IntegerField(2, required=True)
+
+
+class AIWinRateForm(messages.Message):
+    """AIWinRateForm for outbound information about how often an AI
+    strategy wins."""
+    strategy = messages.StringField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+    ai_win_rate = messages.FloatField(3, required=True)
+
+
+class AnalyticsForm(messages.Message):
+    """AnalyticsForm for outbound game history analytics, with those of a
+    single user if requested."""
+    computed = messages.StringField(1)
+    games = messages.IntegerField(2, required=True)
+    moves = messages.IntegerField(3, required=True)
+    plays = messages.MessageField(PlayCountForm, 4, repeated=True)
+    ai_plays = messages.MessageField(PlayCountForm, 5, repeated=True)
+    first_plays = messages.MessageField(PlayCountForm, 6, repeated=True)
+    streak_lengths = messages.MessageField(StreakCountForm, 7, repeated=True)
+    ai_games = messages.IntegerField(8, required=True)
+    ai_win_rate = messages.FloatField(9, required=True)
+    strategies = messages.MessageField(AIWinRateForm, 10, repeated=True)
+    user_ai_games = messages.IntegerField(11)
+    user_ai_win_rate = messages.FloatField(12)
+
+
+class PerfStatsForm(messages.Message):
+    """PerfStatsForm for outbound performance stats of an endpoint or handler
+    over its most recent requests. Times are in milliseconds."""
+    name = messages.StringField(1, required=True)
+    count = messages.IntegerField(2, required=True)
+    wall_ms_p50 = messages.FloatField(3, required=True)
+    wall_ms_p95 = messages.FloatField(4, required=True)
+    wall_ms_p99 = messages.FloatField(5, required=True)
+    datastore_rpcs_mean = messages.FloatField(6, required=True)
+    datastore_rpcs_max = messages.IntegerField(7, required=True)
+    memcache_hits = messages.IntegerField(8, required=True)
+    memcache_misses = messages.IntegerField(9, required=True)
+    response_bytes_mean = messages.FloatField(10, required=True)
+    overhead_ms_p50 = messages.FloatField(11, required=True)
+    overhead_ms_p99 = messages.FloatField(12, required=True)
+
+
+class PerfStatsForms(messages.Message):
+    """Return multiple PerfStatsForms."""
+    stats = messages.MessageField(PerfStatsForm, 1, repeated=True)
+
+
+class JoinQueueForm(messages.Message):
+    """Used to join the matchmaking pool of a game variant."""
+    username = messages.StringField(1, required=True)
+    variant = messages.StringField(2)
+    any_skill = messages.BooleanField(3, default=False)
+
+
+class MatchForm(messages.Message):
+    """MatchForm for outbound matchmaking information."""
+    username = messages.StringField(1, required=True)
+    variant = messages.StringField(2)
+    status = messages.StringField(3, required=True)
+    urlsafe_game_key = messages.StringField(4)
+    opponent = messages.StringField(5)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,64 @@
+"""packing.py - Packed binary encoding of the move history of a game.
+
+Each move is stored as the index of its pair of plays in the game's Rules
+(user code * size + AI code), in the fewest bits that hold every index of
+the variant: 4 bits per move for the classic game, 14 for the largest
+weapons variant. The outcome and result message of a move are looked up
+from the same index, so they are not stored at all. Moves are packed back
+to back, least significant bit first, so any move can be decoded on its
+own without decoding the moves before it."""
+
+
+def bits_per_move(size):
+    """Returns the number of bits a move takes in a variant with the given
+    number of plays."""
+    return max(1, (size * size - 1).bit_length())
+
+
+class PackedMoves(object):
+    """A packed move history. The number of moves is kept by the game, as
+    the last byte of the data may only be partly used."""
+
+    def __init__(self, size, count=0, data=''):
+        self.size = size
+        self.bits = bits_per_move(size)
+        self.count = count
+        self.data = bytearray(data)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, play, ai_play):
+        """Appends a move of the given user and AI play codes."""
+        offset = self.count * self.bits
+        end_byte = (offset + self.bits + 7) // 8
+        if len(self.data) < end_byte:
+            self.data.extend(b'\0' * (end_byte - len(self.data)))
+        byte, shift = divmod(offset, 8)
+        value = (play * self.size + ai_play) << shift
+        while value:
+            self.data[byte] |= value & 0xff
+            value >>= 8
+            byte += 1
+        self.count += 1
+
+    def index(self, number):
+        """Returns the Rules index of the pair of plays of the move with the
+        given 0-based number."""
+        byte, shift = divmod(number * self.bits, 8)
+        value = 0
+        for position, octet in enumerate(self.data[byte:byte + (shift + self.bits + 7) // 8]):
+            value |= octet << (8 * position)
+        return (value >> shift) & ((1 << self.bits) - 1)
+
+    def indexes(self, start=0, stop=None):
+        """Yields the Rules index of each move from the 0-based start number
+        up to the stop number (the end by default). Only these moves are
+        decoded."""
+        stop = self.count if stop is None else min(stop, self.count)
+        for number in range(max(start, 0), stop):
+            yield self.index(number)
+
+    def tostring(self):
+        """Returns the packed moves as a byte string, for a BlobProperty."""
+        return str(self.data)
@@ -0,0 +1,200 @@
+"""perf.py - Per-request performance instrumentation.
+
+Requests to the endpoints and handlers decorated with instrument are timed,
+and the API RPCs they make are counted through API proxy hooks: datastore
+RPCs by call (Get, Put, RunQuery, Next, Commit, ...) and memcache hits and
+misses. Each request is logged as a line of JSON and kept as a sample. The
+samples of each instance are merged into a rolling window in memcache at
+most every FLUSH_INTERVAL seconds, so instrumentation costs no RPCs on most
+requests. The time the instrumentation itself takes is recorded with every
+sample, and should stay within OVERHEAD_BUDGET_MS; the benchmarks measure
+it against calls made without instrumentation (see uninstrumented)."""
+
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from protorpc import messages, protojson
+from google.appengine.api import apiproxy_stub_map, memcache
+
+CACHE_KEY = 'perf:samples'
+# Number of most recent samples kept per endpoint or handler.
+WINDOW = 500
+FLUSH_INTERVAL = 10
+OVERHEAD_BUDGET_MS = 2.0
+
+_local = threading.local()
+_lock = threading.Lock()
+_pending = defaultdict(list)
+_last_flush = [time.time()]
+
+
+class _Record(object):
+    """RPC counts of the code being recorded by the current thread."""
+
+    def __init__(self):
+        self.datastore = defaultdict(int)
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+
+
+def _records():
+    """Returns the list of records active in the current thread."""
+    if not hasattr(_local, 'records'):
+        _local.records = []
+    return _local.records
+
+
+def _pre_call_hook(service, call, request, response):
+    """Count each datastore RPC in every active record by call."""
+    if service == 'datastore_v3':
+        for record in _records():
+            record.datastore[call] += 1
+
+
+def _post_call_hook(service, call, request, response):
+    """Count the memcache hits and misses in every active record."""
+    if service == 'memcache' and call == 'Get':
+        for record in _records():
+            record.memcache_hits += response.item_size()
+            record.memcache_misses += request.key_size() - response.item_size()
+
+
+def install_hooks():
+    """Installs the RPC counting hooks on the current API proxy. Done on
+    import, and needed again whenever the API proxy is replaced, as by the
+    testbed used in the benchmarks."""
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('perf', _pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('perf', _post_call_hook)
+
+
+install_hooks()
+
+
+@contextlib.contextmanager
+def recording():
+    """Context manager counting the API RPCs made by the current thread
+    inside it, in the _Record it yields. Recordings can be nested."""
+    record = _Record()
+    _records().append(record)
+    try:
+        yield record
+    finally:
+        _records().remove(record)
+
+
+@contextlib.contextmanager
+def uninstrumented():
+    """Context manager calling instrumented methods without their
+    instrumentation inside it, in the current thread, so that the overhead
+    of the instrumentation can be measured."""
+    _local.uninstrumented = True
+    try:
+        yield
+    finally:
+        _local.uninstrumented = False
+
+
+def _response_size(handler, result):
+    """Returns the size in bytes of the response to the request."""
+    if isinstance(result, messages.Message):
+        return len(protojson.encode_message(result))
+    response = getattr(handler, 'response', None)
+    return len(response.body) if response is not None else 0
+
+
+def instrument(func):
+    """Decorator recording the performance of each call of an endpoint
+    method or request handler method."""
+    @functools.wraps(func)
+    def _instrumented(handler, *args, **kwargs):
+        """Call the method, recording its performance."""
+        if getattr(_local, 'uninstrumented', False):
+            return func(handler, *args, **kwargs)
+        name = '{}.{}'.format(type(handler).__name__, func.__name__)
+        start = time.time()
+        result = None
+        try:
+            with recording() as record:
+                result = func(handler, *args, **kwargs)
+            return result
+        finally:
+            wall_ms = (time.time() - start) * 1000
+            size = _response_size(handler, result)
+            datastore_rpcs = sum(record.datastore.values())
+            logging.info(json.dumps({'perf': name,
+                                     'wall_ms': round(wall_ms, 2),
+                                     'datastore': record.datastore,
+                                     'memcache_hits': record.memcache_hits,
+                                     'memcache_misses': record.memcache_misses,
+                                     'response_bytes': size}))
+            overhead_ms = (time.time() - start) * 1000 - wall_ms
+            _add_sample(name, (wall_ms, datastore_rpcs, record.memcache_hits,
+                               record.memcache_misses, size, overhead_ms))
+    return _instrumented
+
+
+def _add_sample(name, sample):
+    """Adds a sample, and merges the pending samples of this instance into
+    memcache if they were last merged over FLUSH_INTERVAL seconds ago."""
+    with _lock:
+        _pending[name].append(sample)
+        if time.time() - _last_flush[0] < FLUSH_INTERVAL:
+            return
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    flush(pending)
+
+
+def flush(pending, retries=3):
+    """Merges the given lists of samples, keyed by endpoint or handler name,
+    into the rolling windows in memcache. Samples are dropped if memcache is
+    updated concurrently more than retries times."""
+    client = memcache.Client()
+    for _ in range(retries):
+        samples = client.gets(CACHE_KEY)
+        merged = dict(samples or {})
+        for name, new_samples in pending.items():
+            merged[name] = (merged.get(name, []) + new_samples)[-WINDOW:]
+        if samples is None:
+            if client.add(CACHE_KEY, merged):
+                return
+        elif client.cas(CACHE_KEY, merged):
+            return
+    logging.warning('Dropped perf samples after concurrent updates')
+
+
+def percentile(values, percent):
+    """Returns the given percentile of a sorted list of values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def get_summaries():
+    """Returns a list of dictionaries summarizing the rolling window of each
+    endpoint or handler, sorted by name."""
+    samples = memcache.get(CACHE_KEY) or {}
+    summaries = []
+    for name in sorted(samples):
+        wall, rpcs, hits, misses, sizes, overhead = [sorted(values)
+                                                     for values in zip(*samples[name])]
+        count = len(wall)
+        summaries.append({'name': name,
+                          'count': count,
+                          'wall_ms_p50': percentile(wall, 50),
+                          'wall_ms_p95': percentile(wall, 95),
+                          'wall_ms_p99': percentile(wall, 99),
+                          'datastore_rpcs_mean': float(sum(rpcs)) / count,
+                          'datastore_rpcs_max': rpcs[-1],
+                          'memcache_hits': sum(hits),
+                          'memcache_misses': sum(misses),
+                          'response_bytes_mean': float(sum(sizes)) / count,
+                          'overhead_ms_p50': percentile(overhead, 50),
+                          'overhead_ms_p99': percentile(overhead, 99)})
+    return summaries
@@ -0,0 +1,112 @@
+"""rules.py - Rules of the game variants, with precomputed play outcomes.
+
+Plays are interned to small integer codes, the index of the play in its
+variant, and the outcome and result message of every pair of plays is
+computed once per variant."""
+
+import re
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is not among the App Engine libraries of app.yaml, so it is
+    # only used where installed, as in offline simulations.
+    numpy = None
+
+TIE = 0
+WIN = 1
+LOSE = -1
+
+DEFAULT_VARIANT = 'classic'
+MAX_WEAPONS = 101
+
+TIE_MSG = 'Looks like we both picked {}. Play again!'
+WIN_MSG = """Congratulations, your {} beats my {}.\
+                You win!"""
+LOSE_MSG = """Sorry, my {} beats your {}. You lose!"""
+
+
+class Rules(object):
+    """Rules of a game variant with an odd number of plays, ordered so that
+    each play beats the plays an odd number of places before it (wrapping
+    around) and loses to the rest."""
+
+    def __init__(self, variant, plays):
+        self.variant = variant
+        self.plays = tuple(plays)
+        self.size = len(self.plays)
+        self.codes = dict((play, code) for code, play in enumerate(self.plays))
+        names = [play.title() for play in self.plays]
+        self.invalid_play_msg = 'Uh-oh. You need to specify either {}, or {}.'\
+            .format(', '.join(names[:-1]), names[-1])
+
+        # Outcomes and messages, from the user's point of view, indexed by
+        # user code * size + AI code.
+        self.outcomes = []
+        self.messages = []
+        for play in range(self.size):
+            for ai_play in range(self.size):
+                if play == ai_play:
+                    outcome, msg = TIE, TIE_MSG.format(names[play])
+                elif (play - ai_play) % self.size % 2:
+                    outcome, msg = WIN, WIN_MSG.format(names[play], names[ai_play])
+                else:
+                    outcome, msg = LOSE, LOSE_MSG.format(names[ai_play], names[play])
+                self.outcomes.append(outcome)
+                self.messages.append(msg)
+        self.outcomes = tuple(self.outcomes)
+        self.messages = tuple(self.messages)
+        self.outcome_array = numpy.array(self.outcomes, dtype=numpy.int8) if numpy else None
+
+    def code(self, play):
+        """Returns the code of the given play name, ignoring case, or None if
+        it is not a play of this variant."""
+        return self.codes.get(play.lower()) if play else None
+
+    def resolve(self, play, ai_play):
+        """Returns the outcome (WIN, LOSE or TIE) and result message of a
+        round of the given user and AI play codes."""
+        index = play * self.size + ai_play
+        return self.outcomes[index], self.messages[index]
+
+    def resolve_many(self, plays, ai_plays):
+        """Returns the outcomes of many rounds of the given sequences of user
+        and AI play codes, for simulations. With NumPy, all rounds are
+        resolved in one vectorized lookup and returned as an array."""
+        if numpy is not None:
+            plays = numpy.asarray(plays, dtype=numpy.intp)
+            ai_plays = numpy.asarray(ai_plays, dtype=numpy.intp)
+            return self.outcome_array[plays * self.size + ai_plays]
+        outcomes = self.outcomes
+        size = self.size
+        return [outcomes[play * size + ai_play] for play, ai_play in zip(plays, ai_plays)]
+
+
+def _weapons(size):
+    """Returns the plays of the variant with the given number of weapons.
+    The classic and Lizard-Spock plays come first, so those variants are the
+    3 and 5 weapon games."""
+    plays = ['rock', 'paper', 'scissors', 'spock', 'lizard']
+    return plays[:size] + ['weapon{}'.format(i) for i in range(len(plays) + 1, size + 1)]
+
+
+VARIANT_SIZES = {DEFAULT_VARIANT: 3, 'lizard_spock': 5}
+_RULES = {}
+
+
+def get_rules(variant=None):
+    """Returns the Rules of the named variant: 'classic', 'lizard_spock' or
+    'weapons_N' for an odd number N of weapons from 3 to MAX_WEAPONS. Returns
+    the classic Rules if no variant is given, and None for unknown variants.
+    Rules are built once per variant."""
+    variant = variant or DEFAULT_VARIANT
+    rules = _RULES.get(variant)
+    if rules is None:
+        size = VARIANT_SIZES.get(variant)
+        match = re.match(r'^weapons_(\d+)$', variant)
+        if match:
+            size = int(match.group(1))
+        if not size or size < 3 or size > MAX_WEAPONS or not size % 2:
+            return None
+        rules = _RULES[variant] = Rules(variant, _weapons(size))
+    return rules
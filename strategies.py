@@ -0,0 +1,129 @@
+"""strategies.py - AI opponent strategies.
+
+Strategies are stateless. What a strategy has learned about a user's plays is
+kept in a fixed-size array of counts, created by new_state and updated in
+place by update, so choosing and learning from a play take constant time
+however many plays have been made."""
+
+import random
+from array import array
+
+DEFAULT_STRATEGY = 'random'
+# Largest number of counts a strategy may keep for a game variant.
+MAX_STATE_SIZE = 65536
+
+
+def _argmax(counts, start, size):
+    """Returns the index (from start) of the largest of size counts, with
+    ties broken at random, or None if all of them are zero."""
+    best = max(counts[start:start + size])
+    if not best:
+        return None
+    return random.choice([i for i in range(size) if counts[start + i] == best])
+
+
+class Strategy(object):
+    """Strategy playing at random. Base class of the adaptive strategies."""
+
+    def __init__(self, size):
+        self.size = size
+
+    def state_size(self):
+        """Returns the number of counts kept by the strategy."""
+        return 0
+
+    def new_state(self):
+        """Returns the state of the strategy before any play was made."""
+        return array('i', [0] * self.state_size())
+
+    def counter(self, play):
+        """Returns the play code beating the given play code."""
+        return (play + 1) % self.size
+
+    def choose(self, state):
+        """Returns the play code to play next, given the state."""
+        return random.randrange(self.size)
+
+    def update(self, state, play):
+        """Updates the state in place with the opponent's given play code."""
+        pass
+
+
+class FrequencyStrategy(Strategy):
+    """Strategy beating the play the opponent has made most often. The state
+    holds the number of times each play was made."""
+
+    def state_size(self):
+        """Returns the number of counts kept by the strategy."""
+        return self.size
+
+    def choose(self, state):
+        """Returns the play code to play next, given the state."""
+        predicted = _argmax(state, 0, self.size)
+        if predicted is None:
+            return random.randrange(self.size)
+        return self.counter(predicted)
+
+    def update(self, state, play):
+        """Updates the state in place with the opponent's given play code."""
+        state[play] += 1
+
+
+class MarkovStrategy(Strategy):
+    """Strategy beating the play the opponent has made most often after
+    their last order plays. The state holds the number of plays made so far
+    (capped at order), the code of the last order plays as a number in base
+    size, and the count of each play after each sequence of order plays."""
+
+    def __init__(self, size, order=1):
+        super(MarkovStrategy, self).__init__(size)
+        self.order = order
+        self.contexts = size ** order
+
+    def state_size(self):
+        """Returns the number of counts kept by the strategy."""
+        return 2 + self.contexts * self.size
+
+    def choose(self, state):
+        """Returns the play code to play next, given the state."""
+        predicted = None
+        if state[0] >= self.order:
+            predicted = _argmax(state, 2 + state[1] * self.size, self.size)
+        if predicted is None:
+            return random.randrange(self.size)
+        return self.counter(predicted)
+
+    def update(self, state, play):
+        """Updates the state in place with the opponent's given play code."""
+        if state[0] >= self.order:
+            state[2 + state[1] * self.size + play] += 1
+        else:
+            state[0] += 1
+        state[1] = (state[1] * self.size + play) % self.contexts
+
+
+STRATEGIES = {
+    DEFAULT_STRATEGY: (Strategy, {}),
+    'frequency': (FrequencyStrategy, {}),
+    'markov': (MarkovStrategy, {'order': 1}),
+    'markov2': (MarkovStrategy, {'order': 2}),
+}
+_STRATEGIES = {}
+
+
+def get_strategy(name, size):
+    """Returns the named strategy for a game variant with the given number of
+    plays, or the random strategy if no name is given. Returns None for
+    unknown strategies, and for strategies which would keep more than
+    MAX_STATE_SIZE counts for the variant."""
+    name = name or DEFAULT_STRATEGY
+    strategy = _STRATEGIES.get((name, size))
+    if strategy is None:
+        if name not in STRATEGIES:
+            return None
+        cls, kwargs = STRATEGIES[name]
+        strategy = cls(size, **kwargs)
+        if strategy.state_size() > MAX_STATE_SIZE:
+            return None
+        _STRATEGIES[(name, size)] = strategy
+    return strategy
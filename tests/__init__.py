@@ -0,0 +1,7 @@
+"""tests - Unit tests against the local App Engine stubs.
+
+Each test runs the API and the main.py handlers on a fresh set of the
+testbed stubs of benchmarks/stubs.py. Run from the repository root, with
+the App Engine SDK on the PYTHONPATH:
+
+    python -m unittest discover -s tests -t ."""
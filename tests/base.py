@@ -0,0 +1,62 @@
+"""base.py - Base test case activating the App Engine stubs."""
+
+import unittest
+
+import webapp2
+
+from benchmarks.stubs import Stubs
+
+import api
+import main
+
+
+class TestCase(unittest.TestCase):
+    """Test case running each test on a fresh, empty set of stubs, with
+    helpers calling the API."""
+
+    def setUp(self):
+        self.stubs = Stubs()
+        self.stubs.activate()
+        self.service = api.RockPaperScissorsApi()
+
+    def tearDown(self):
+        self.stubs.deactivate()
+
+    def request(self, container, **kwargs):
+        """Returns a request message of the given endpoints
+        ResourceContainer."""
+        return container.combined_message_class(**kwargs)
+
+    def create_user(self, username):
+        """Creates a User with the given username. Returns its UserForm."""
+        return self.service.create_user(self.request(
+            api.USER_REQUEST, username=username, display_name=username.title(),
+            email='{}@example.com'.format(username)))
+
+    def new_game(self, username):
+        """Creates a game for the named user. Returns its GameForm."""
+        return self.service.new_game(self.request(api.NEW_GAME_REQUEST, username=username))
+
+    def make_play(self, urlsafe_game_key, play='rock'):
+        """Makes a play in the given game. Returns its GameForm."""
+        return self.service.make_play(self.request(api.MAKE_PLAY_REQUEST,
+                                                   urlsafe_game_key=urlsafe_game_key,
+                                                   play=play))
+
+    def get_game(self, urlsafe_game_key, etag=None):
+        """Returns the GameForm of the given game."""
+        return self.service.get_game(self.request(api.GET_GAME_REQUEST,
+                                                  urlsafe_game_key=urlsafe_game_key,
+                                                  etag=etag))
+
+    def get_game_history(self, urlsafe_game_key, last=None, etag=None):
+        """Returns the GameHistoryForm of the given game."""
+        return self.service.get_game_history(self.request(
+            api.GET_GAME_HISTORY_REQUEST, urlsafe_game_key=urlsafe_game_key,
+            last=last, etag=etag))
+
+    def run_handler(self, url):
+        """Gets the given URL of main.app, then runs the tasks it
+        enqueued."""
+        webapp2.Request.blank(url).get_response(main.app)
+        self.stubs.run_tasks(main.app)
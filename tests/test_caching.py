@@ -0,0 +1,115 @@
+"""test_caching.py - Cached responses are never served stale.
+
+get_game and get_game_history cache their responses by game version, and
+the leaderboards by leaderboard version. Each test caches a response, then
+changes the game through make_play, cancel_game or the abandoned games
+sweeper, and checks that the next response shows the change."""
+
+from datetime import datetime, timedelta
+
+from google.appengine.ext import ndb
+
+import api
+from models import Game
+from tests.base import TestCase
+
+
+class GameCacheTest(TestCase):
+    """Cached game and game history responses."""
+
+    def setUp(self):
+        super(GameCacheTest, self).setUp()
+        self.create_user('alice')
+        self.game_key = self.new_game('alice').urlsafe_key
+
+    def test_get_game_is_cached_until_changed(self):
+        first = self.get_game(self.game_key)
+        second = self.get_game(self.game_key, etag=first.etag)
+        self.assertEqual(second.etag, first.etag)
+        self.assertTrue(second.not_modified)
+
+    def test_get_game_after_make_play(self):
+        before = self.get_game(self.game_key)
+        played = self.make_play(self.game_key)
+        after = self.get_game(self.game_key, etag=before.etag)
+        self.assertNotEqual(after.etag, before.etag)
+        self.assertFalse(after.not_modified)
+        self.assertEqual(len(after.moves), len(before.moves) + 1)
+        self.assertEqual(after.game_over, played.game_over)
+
+    def test_get_game_history_after_make_play(self):
+        before = self.get_game_history(self.game_key)
+        last_before = self.get_game_history(self.game_key, last=1)
+        self.make_play(self.game_key)
+        after = self.get_game_history(self.game_key, etag=before.etag)
+        last_after = self.get_game_history(self.game_key, last=1)
+        self.assertFalse(after.not_modified)
+        self.assertEqual(after.move_count, before.move_count + 1)
+        self.assertEqual(len(after.moves), len(before.moves) + 1)
+        self.assertEqual(len(last_before.moves), 0)
+        self.assertEqual(len(last_after.moves), 1)
+
+    def test_get_game_after_cancel_game(self):
+        before = self.get_game(self.game_key)
+        history = self.get_game_history(self.game_key)
+        self.service.cancel_game(self.request(api.CANCEL_GAME_REQUEST,
+                                              urlsafe_game_key=self.game_key))
+        after = self.get_game(self.game_key, etag=before.etag)
+        self.assertTrue(after.cancelled)
+        self.assertTrue(after.game_over)
+        self.assertFalse(after.not_modified)
+        self.assertNotEqual(self.get_game_history(self.game_key).etag, history.etag)
+
+    def test_get_game_after_sweeper(self):
+        game = ndb.Key(urlsafe=self.game_key).get()
+        game.last_move_at = datetime.today() - Game.INACTIVITY_TTL - timedelta(days=1)
+        game.put()
+        before = self.get_game(self.game_key)
+        history = self.get_game_history(self.game_key)
+        self.run_handler('/tasks/expire_games')
+        after = self.get_game(self.game_key, etag=before.etag)
+        self.assertTrue(after.cancelled)
+        self.assertFalse(after.not_modified)
+        self.assertEqual(after.message, Game.ABANDONED_MSG.format(Game.INACTIVITY_TTL.days))
+        self.assertNotEqual(self.get_game_history(self.game_key).etag, history.etag)
+        open_games = self.service.get_user_games(self.request(api.USER_GAMES_REQUEST,
+                                                              username='alice'))
+        self.assertEqual(open_games.games, [])
+
+
+class LeaderboardCacheTest(TestCase):
+    """Cached leaderboard responses."""
+
+    def _win_game(self, username):
+        """Plays new games of the named user until one is won."""
+        for _ in range(100):
+            key = self.new_game(username).urlsafe_key
+            form = self.make_play(key)
+            while not form.game_over:
+                form = self.make_play(key)
+            if form.won:
+                return
+        self.fail('No game was won')
+
+    def test_high_scores_after_game_won(self):
+        self.create_user('alice')
+        before = self.service.get_high_scores(self.request(api.LEADERBOARD_REQUEST))
+        self.assertEqual([(score.username, score.score) for score in before.scores],
+                         [('alice', 0)])
+        self._win_game('alice')
+        after = self.service.get_high_scores(self.request(api.LEADERBOARD_REQUEST,
+                                                          etag=before.etag))
+        self.assertNotEqual(after.etag, before.etag)
+        self.assertFalse(after.not_modified)
+        self.assertEqual(after.scores[0].username, 'alice')
+        self.assertGreaterEqual(after.scores[0].score, 1)
+
+    def test_user_rankings_after_game_ended(self):
+        self.create_user('alice')
+        before = self.service.get_user_rankings(self.request(api.LEADERBOARD_REQUEST))
+        key = self.new_game('alice').urlsafe_key
+        while not self.make_play(key).game_over:
+            pass
+        after = self.service.get_user_rankings(self.request(api.LEADERBOARD_REQUEST))
+        self.assertNotEqual(after.etag, before.etag)
+        self.assertEqual(after.rankings[0].total_games, 1)
@@ -0,0 +1,142 @@
+"""test_counters.py - The global counters under load, and what they count."""
+
+import threading
+from datetime import datetime
+
+from google.appengine.api import datastore_errors, memcache
+from google.appengine.ext import ndb
+
+import counters
+import main
+from models import Game, User
+from tests.base import TestCase
+
+GAMES = 10000
+THREADS = 4
+ROCK, PAPER = 0, 1
+
+
+class HotUserTest(TestCase):
+    """Games of one user ended from several threads at once are all counted
+    exactly once, in the User's stats and in the global counters."""
+
+    def _store_games(self, user_key):
+        """Stores GAMES open games of the User. Returns their keys."""
+        now = datetime.today()
+        keys = []
+        for start in range(0, GAMES, 500):
+            keys.extend(ndb.put_multi([Game(user=user_key, date=now, last_move_at=now)
+                                       for _ in range(start, min(start + 500, GAMES))]))
+        return keys
+
+    def _end_games(self, keys):
+        """Ends the given games from THREADS threads, retrying each game on
+        conflict. Game number n has n % 3 drawn moves, and is won if n is
+        even. Returns the number of conflicts."""
+        pending = list(enumerate(keys))
+        conflicts = []
+        lock = threading.Lock()
+
+        def _end(number, key):
+            """End one game, retrying until it is saved."""
+            while True:
+                game = key.get(use_cache=False)
+                if game.game_over:
+                    return
+                moves = [game.apply_play(ROCK, ROCK) for _ in range(number % 3)]
+                moves.append(game.apply_play(PAPER, ROCK) if number % 2 == 0
+                             else game.apply_play(ROCK, PAPER))
+                try:
+                    if game.save_moves(moves):
+                        return
+                except datastore_errors.TransactionFailedError:
+                    with lock:
+                        conflicts.append(number)
+
+        def _worker():
+            """End games until none are left."""
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    number, key = pending.pop()
+                _end(number, key)
+        threads = [threading.Thread(target=_worker) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(conflicts)
+
+    def test_exact_totals(self):
+        self.create_user('bot')
+        user_key = ndb.Key(User, 'bot')
+        keys = self._store_games(user_key)
+        names = [counters.counter_name(result)
+                 for result in (counters.WINS, counters.LOSSES, counters.DRAWS)]
+        # Caches the totals, which are then incremented as games end.
+        self.assertEqual(counters.get_counts(names), dict((name, 0) for name in names))
+
+        self._end_games(keys)
+        self.stubs.run_tasks(main.app)
+        wins = len(range(0, GAMES, 2))
+        draws = sum(number % 3 for number in range(GAMES))
+        expected = {names[0]: wins, names[1]: GAMES - wins, names[2]: draws}
+
+        user = user_key.get(use_cache=False)
+        self.assertEqual(user.total_games, GAMES)
+        self.assertEqual(user.get_result_counts(), {counters.WINS: wins,
+                                                    counters.LOSSES: GAMES - wins,
+                                                    counters.DRAWS: draws})
+        self.assertEqual(counters.get_counts(names), expected)
+        memcache.flush_all()
+        self.assertEqual(counters.get_counts(names), expected)
+        ended = ndb.get_multi(keys, use_cache=False)
+        self.assertTrue(all(game.game_over for game in ended))
+
+
+class CountedGamesTest(TestCase):
+    """The global counters only count games that are over and were not
+    cancelled, and each game once."""
+
+    def setUp(self):
+        super(CountedGamesTest, self).setUp()
+        self.create_user('alice')
+        self.user_key = ndb.Key(User, 'alice')
+        self.names = [counters.counter_name(result)
+                      for result in (counters.WINS, counters.LOSSES, counters.DRAWS)]
+
+    def _play(self, draws, won=None, cancel=False):
+        """Plays a game with the given number of drawn moves, then wins or
+        loses it, or cancels it, or leaves it open if won is None."""
+        game = Game.new_game(self.user_key)
+        self.assertTrue(game.save_moves([game.apply_play(ROCK, ROCK) for _ in range(draws)]))
+        if cancel:
+            game.cancelled = True
+            self.assertTrue(game.end_game(True))
+        elif won is not None:
+            move = game.apply_play(PAPER, ROCK) if won else game.apply_play(ROCK, PAPER)
+            self.assertTrue(game.save_moves([move]))
+        return game
+
+    def test_only_finished_games_are_counted(self):
+        self._play(2, won=True)
+        self._play(3, won=False)
+        self._play(4)
+        self._play(5, cancel=True)
+        self.stubs.run_tasks(main.app)
+        self.assertEqual(counters.get_counts(self.names),
+                         dict(zip(self.names, (1, 1, 5))))
+        user = self.user_key.get(use_cache=False)
+        self.assertEqual(user.get_result_counts(), {counters.WINS: 1,
+                                                    counters.LOSSES: 1,
+                                                    counters.DRAWS: 5})
+
+    def test_increments_are_applied_once(self):
+        game = self._play(1, won=True)
+        deltas = {self.names[0]: 1, self.names[2]: 1}
+        self.stubs.run_tasks(main.app)
+        self.assertFalse(counters.apply_increments(game.key.urlsafe(), deltas))
+        memcache.flush_all()
+        self.assertEqual(counters.get_counts(self.names),
+                         dict(zip(self.names, (1, 0, 1))))
@@ -0,0 +1,56 @@
+"""test_export.py - Exporting and importing users and games."""
+
+import os
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+from export import ExportJob, import_chunk
+from models import Game, User
+from tests.base import TestCase
+
+GAMES = 20
+MOVE_DATA_BYTES = 50 * 1024
+MAX_BYTES = 200 * 1024
+
+
+class ExportChunkTest(TestCase):
+    """Chunks are limited by their compressed size as well as by count."""
+
+    def setUp(self):
+        super(ExportChunkTest, self).setUp()
+        user_key = ndb.Key(User, 'alice')
+        # Random move data, which does not compress.
+        self.games = [Game(user=user_key, date=datetime.today(),
+                           move_data=os.urandom(MOVE_DATA_BYTES))
+                      for _ in range(GAMES)]
+        ndb.put_multi(self.games)
+
+    def _export(self, batch_size):
+        """Runs an export of the games to its end. Returns its chunks."""
+        job = ExportJob(kinds=[Game._get_kind()])
+        job.put()
+        while not job.done:
+            job = job.export_chunk(batch_size, MAX_BYTES)
+        chunks = ndb.get_multi([job.chunk_key(number) for number in range(1, job.chunks + 1)])
+        self.assertEqual(job.counts, {Game._get_kind(): GAMES})
+        return chunks
+
+    def test_chunks_are_cut_by_size(self):
+        chunks = self._export(batch_size=GAMES)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk.data) <= MAX_BYTES for chunk in chunks))
+        self.assertEqual(sum(chunk.count for chunk in chunks), GAMES)
+
+    def test_chunks_are_cut_by_count(self):
+        chunks = self._export(batch_size=2)
+        self.assertEqual([chunk.count for chunk in chunks], [2] * (GAMES // 2))
+
+    def test_import_round_trip(self):
+        chunks = self._export(batch_size=GAMES)
+        imported = sum(import_chunk(chunk.data, 'copy') for chunk in chunks)
+        self.assertEqual(imported, GAMES)
+        copies = ndb.get_multi([ndb.Key(flat=game.key.flat(), namespace='copy')
+                                for game in self.games])
+        self.assertEqual([copy.move_data for copy in copies],
+                         [game.move_data for game in self.games])
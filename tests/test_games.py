@@ -0,0 +1,129 @@
+"""test_games.py - Saving games that change while being played."""
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import api
+from models import AIState, Game, MakePlaysForm, PlayForm, User
+from tests.base import TestCase
+
+
+class SaveMovesTest(TestCase):
+    """Game.save_moves only saves games unchanged since they were read."""
+
+    def setUp(self):
+        super(SaveMovesTest, self).setUp()
+        self.create_user('alice')
+        self.game_key = ndb.Key(urlsafe=self.new_game('alice').urlsafe_key)
+
+    def _tie(self, game):
+        """Applies a tied round to the given game. Returns its Move."""
+        return game.apply_play(0, 0)
+
+    def test_save_moves_stores_the_move(self):
+        game = self.game_key.get()
+        self.assertTrue(game.save_moves([self._tie(game)]))
+        stored = self.game_key.get(use_cache=False)
+        self.assertEqual(stored.get_move_count(), 1)
+        self.assertEqual(stored.version, game.version)
+
+    def test_stale_play_is_rejected(self):
+        stale = self.game_key.get(use_cache=False)
+        game = self.game_key.get(use_cache=False)
+        self.assertTrue(game.save_moves([self._tie(game)]))
+        self.assertFalse(stale.save_moves([self._tie(stale)]))
+        self.assertEqual(self.game_key.get(use_cache=False).get_move_count(), 1)
+
+    def test_stale_cancel_does_not_overwrite_a_play(self):
+        stale = self.game_key.get(use_cache=False)
+        game = self.game_key.get(use_cache=False)
+        self.assertTrue(game.save_moves([self._tie(game)]))
+        stale.cancelled = True
+        self.assertFalse(stale.end_game(True))
+        stored = self.game_key.get(use_cache=False)
+        self.assertFalse(stored.game_over)
+        self.assertEqual(stored.get_move_count(), 1)
+        self.assertEqual(stored.move_data, game.move_data)
+
+    def test_stale_cancel_does_not_overwrite_a_sealed_play(self):
+        self.create_user('bob')
+        alice, bob = User.get_by_username('alice'), User.get_by_username('bob')
+        game = Game.new_game(alice.key, opponent=bob.key)
+        stale = game.key.get(use_cache=False)
+        Game.submit_play(game.key, bob.key, 0)
+        stale.cancelled = True
+        self.assertFalse(stale.end_game(True))
+        self.assertEqual(game.key.get(use_cache=False).sealed_opponent_play, 0)
+
+    def test_saved_after_several_saves(self):
+        game = self.game_key.get()
+        for _ in range(3):
+            self.assertTrue(game.save_moves([self._tie(game)]))
+        game.cancelled = True
+        self.assertTrue(game.end_game(True))
+        stored = self.game_key.get(use_cache=False)
+        self.assertTrue(stored.cancelled)
+        self.assertEqual(stored.get_move_count(), 3)
+
+
+class MakePlaysTest(TestCase):
+    """make_plays saves batches spanning several games of several users."""
+
+    def setUp(self):
+        super(MakePlaysTest, self).setUp()
+        self.game_keys = []
+        for username in ('alice', 'bob'):
+            self.create_user(username)
+            self.game_keys.extend(self.new_game(username).urlsafe_key for _ in range(5))
+
+    def _make_plays(self):
+        """Makes a play in each game. Returns the PlayResultForms."""
+        return self.service.make_plays(MakePlaysForm(plays=[
+            PlayForm(urlsafe_game_key=key, play='rock') for key in self.game_keys]))
+
+    def test_games_of_the_same_user_are_all_saved(self):
+        form = self._make_plays()
+        self.assertTrue(all(result.accepted for result in form.results))
+        for key in self.game_keys:
+            self.assertEqual(ndb.Key(urlsafe=key).get(use_cache=False).get_move_count(), 1)
+
+    def test_failed_transaction_is_reported_per_game(self):
+        failing = ndb.Key(urlsafe=self.game_keys[0])
+        save_moves_async = Game.save_moves_async
+
+        def _save_moves_async(game, moves):
+            """Fail the transaction of one game."""
+            if game.key == failing:
+                raise datastore_errors.TransactionFailedError()
+            return save_moves_async(game, moves)
+        Game.save_moves_async = _save_moves_async
+        try:
+            form = self._make_plays()
+        finally:
+            Game.save_moves_async = save_moves_async
+        self.assertFalse(form.results[0].accepted)
+        self.assertEqual(form.results[0].message, api.CONCURRENT_PLAY_MSG)
+        self.assertTrue(all(result.accepted for result in form.results[1:]))
+        self.assertEqual(failing.get(use_cache=False).get_move_count(), 0)
+
+    def test_ai_learns_only_from_saved_plays(self):
+        alice = ndb.Key(User, 'alice')
+        games = [Game.new_game(alice, strategy='frequency') for _ in range(2)]
+        save_moves_async = Game.save_moves_async
+
+        def _save_moves_async(game, moves):
+            """Fail the transaction of the first game."""
+            if game.key == games[0].key:
+                raise datastore_errors.TransactionFailedError()
+            return save_moves_async(game, moves)
+        Game.save_moves_async = _save_moves_async
+        try:
+            form = self.service.make_plays(MakePlaysForm(plays=[
+                PlayForm(urlsafe_game_key=game.key.urlsafe(), play='rock')
+                for game in games + games]))
+        finally:
+            Game.save_moves_async = save_moves_async
+        accepted = [result.accepted for result in form.results]
+        self.assertEqual(accepted[0::2], [False, False])
+        self.assertTrue(accepted[1])
+        self.assertEqual(AIState.get_for(games[1]).plays, sum(accepted))
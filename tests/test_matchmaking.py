@@ -0,0 +1,24 @@
+"""test_matchmaking.py - Matchmaking and concurrent player-vs-player play.
+
+Runs a small simulation of benchmarks/matchmaking.py: players join the pool
+in random order, and every matched game is played with both players of each
+round playing at once from separate threads."""
+
+import random
+
+from benchmarks import matchmaking
+from tests.base import TestCase
+
+PLAYERS = 200
+THREADS = 10
+
+
+class MatchmakingTest(TestCase):
+    """No player is paired twice, and no accepted play is lost."""
+
+    def test_no_double_pairing_nor_lost_moves(self):
+        random.seed(1)
+        report = matchmaking.simulate(self.stubs, PLAYERS, tasks_every=20, threads=THREADS)
+        self.assertGreater(report['games'], 0)
+        self.assertEqual(report['double_paired'], 0)
+        self.assertEqual(report['games_with_lost_moves'], 0)
@@ -0,0 +1,31 @@
+"""test_perf.py - The overhead of the perf.py instrumentation."""
+
+import random
+
+import api
+import perf
+from benchmarks import workload
+from tests.base import TestCase
+
+CALLS = 300
+
+
+class OverheadTest(TestCase):
+    """The instrumentation adds no more than perf.OVERHEAD_BUDGET_MS to a
+    request."""
+
+    def test_overhead_within_budget(self):
+        random.seed(1)
+        usernames, open_games = workload.seed(20, 10, 5)
+        runner = workload.Workload(self.stubs, usernames, open_games)
+        report = runner.measure_overhead(CALLS)
+        self.assertLessEqual(report['overhead_ms']['p50'], perf.OVERHEAD_BUDGET_MS, report)
+        self.assertTrue(report['within_budget'])
+
+    def test_uninstrumented_calls_are_not_recorded(self):
+        self.create_user('alice')
+        with perf.recording() as record:
+            with perf.uninstrumented():
+                self.service.get_users(self.request(api.PAGE_REQUEST))
+        self.assertTrue(record.datastore)
+        self.assertFalse(perf._pending.get('RockPaperScissorsApi.get_users'))
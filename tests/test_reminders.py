@@ -0,0 +1,113 @@
+"""test_reminders.py - Sending reminder emails in batches."""
+
+from collections import Counter
+
+import webapp2
+from google.appengine.api import mail
+from google.appengine.ext import ndb, testbed
+
+import main
+from models import Game, OpenGames, Reminder, User
+from tests.base import TestCase
+
+USERS = 100000
+# Users with no open game, who are not reminded.
+IDLE_EVERY = 10
+
+
+class SendReminderBatchTest(TestCase):
+    """A failing email does not resend the emails sent before it."""
+
+    def setUp(self):
+        super(SendReminderBatchTest, self).setUp()
+        self.user_keys = []
+        for username in ('alice', 'bob', 'carol'):
+            self.create_user(username)
+            self.user_keys.append(ndb.Key(User, username))
+            Game.new_game(self.user_keys[-1])
+        self.failures = {}
+        self.send_mail = mail.send_mail
+        mail.send_mail = self._send_mail
+
+    def tearDown(self):
+        mail.send_mail = self.send_mail
+        super(SendReminderBatchTest, self).tearDown()
+
+    def _send_mail(self, sender, to, subject, body):
+        """Send the email, unless its address is set to fail."""
+        if to in self.failures:
+            raise self.failures[to]
+        self.send_mail(sender, to, subject, body)
+
+    def _send_batch(self):
+        """Runs the task sending the reminders of the batch of all users."""
+        webapp2.Request.blank('/tasks/send_reminders',
+                              POST=[('user_key', key.urlsafe()) for key in self.user_keys])\
+            .get_response(main.app)
+
+    def _sent_to(self):
+        """Returns the addresses emailed so far, in order."""
+        stub = self.stubs.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        return [message.to for message in stub.get_sent_messages()]
+
+    def test_bad_address_does_not_fail_the_batch(self):
+        self.failures['bob@example.com'] = mail.InvalidEmailError()
+        self._send_batch()
+        self.assertEqual(self._sent_to(), ['alice@example.com', 'carol@example.com'])
+        self.assertIsNone(Reminder.key_for(self.user_keys[1]).get())
+        del self.failures['bob@example.com']
+        self._send_batch()
+        self.assertEqual(self._sent_to(), ['alice@example.com', 'carol@example.com',
+                                           'bob@example.com'])
+
+    def test_retried_batch_does_not_resend(self):
+        self.failures['bob@example.com'] = RuntimeError('Task failed')
+        # main.app runs in debug mode, so the failure reaches the test.
+        self.assertRaises(RuntimeError, self._send_batch)
+        self.assertEqual(self._sent_to(), ['alice@example.com'])
+        self.assertIsNotNone(Reminder.key_for(self.user_keys[0]).get())
+        del self.failures['bob@example.com']
+        self._send_batch()
+        self.assertEqual(self._sent_to(), ['alice@example.com', 'bob@example.com',
+                                           'carol@example.com'])
+
+
+class ReminderCronTest(TestCase):
+    """The reminder cron, through CollectReminders and SendReminderBatch,
+    emails every user with open games exactly once."""
+
+    def setUp(self):
+        super(ReminderCronTest, self).setUp()
+        self.expected = set()
+        entities = []
+        for number in range(USERS):
+            username = 'user{}'.format(number)
+            user = User(id=username, username=username, display_name=username.title(),
+                        email='{}@example.com'.format(username))
+            open_games = OpenGames(key=OpenGames.key_for(user.key), migrated=True)
+            if number % IDLE_EVERY:
+                open_games.game_keys = [ndb.Key(Game, username)]
+                self.expected.add(user.email)
+            entities.extend([user, open_games])
+            if len(entities) >= 500:
+                ndb.put_multi(entities)
+                entities = []
+        ndb.put_multi(entities)
+
+    def _run_cron(self):
+        """Runs the reminder cron and every task it leads to."""
+        webapp2.Request.blank('/crons/send_reminder').get_response(main.app)
+        self.stubs.run_tasks(main.app, max_rounds=USERS // main.CollectReminders.PAGE_SIZE + 10)
+
+    def _sent_to(self):
+        """Returns the number of emails sent so far to each address."""
+        stub = self.stubs.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        return Counter(message.to for message in stub.get_sent_messages())
+
+    def test_each_user_is_reminded_once(self):
+        self._run_cron()
+        sent = self._sent_to()
+        self.assertEqual(set(sent), self.expected)
+        self.assertEqual(set(sent.values()), set([1]))
+        self._run_cron()
+        self.assertEqual(self._sent_to(), sent)
@@ -0,0 +1,55 @@
+"""test_rpcs.py - List endpoints make a constant number of RPCs per page.
+
+get_games resolves the usernames of all the games of a page with a single
+batch get, so a page costs the same datastore RPCs whether its games belong
+to a few users or each to a different one."""
+
+from datetime import datetime, timedelta
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import api
+import perf
+from models import Game, User
+from tests.base import TestCase
+
+PAGE_SIZE = 100
+MAX_RPCS = 4
+
+
+class GetGamesRpcsTest(TestCase):
+    """Datastore RPCs of a page of get_games."""
+
+    def _store_games(self, users):
+        """Replaces all games with PAGE_SIZE games spread over the given
+        number of users, every other one a player-vs-player game."""
+        ndb.delete_multi(Game.query().fetch(keys_only=True))
+        user_keys = ndb.put_multi([User(id='user{}'.format(number),
+                                        username='user{}'.format(number),
+                                        display_name='User{}'.format(number),
+                                        email='user{}@example.com'.format(number))
+                                   for number in range(users)])
+        now = datetime.today()
+        ndb.put_multi([Game(user=user_keys[number % users],
+                            opponent=user_keys[(number + 1) % users] if number % 2 else None,
+                            date=now - timedelta(seconds=number), last_move_at=now)
+                       for number in range(PAGE_SIZE)])
+
+    def _page_rpcs(self, users):
+        """Returns the datastore RPCs of an uncached page of PAGE_SIZE games
+        spread over the given number of users, by call."""
+        self._store_games(users)
+        ndb.get_context().clear_cache()
+        memcache.flush_all()
+        with perf.recording() as record:
+            forms = self.service.get_games(self.request(api.PAGE_REQUEST, limit=PAGE_SIZE))
+        self.assertEqual(len(forms.games), PAGE_SIZE)
+        self.assertTrue(all(form.username for form in forms.games))
+        return dict(record.datastore)
+
+    def test_rpcs_do_not_depend_on_distinct_users(self):
+        few = self._page_rpcs(2)
+        many = self._page_rpcs(PAGE_SIZE)
+        self.assertEqual(many, few)
+        self.assertLessEqual(sum(many.values()), MAX_RPCS)
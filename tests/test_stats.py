@@ -0,0 +1,63 @@
+"""test_stats.py - Folding finished games into the global Stats."""
+
+from datetime import datetime, timedelta
+
+import webapp2
+from google.appengine.ext import ndb
+
+import main
+from models import Game, Stats, User
+from tests.base import TestCase
+
+
+class UpdateStatsTest(TestCase):
+    """The stats task counts every finished game exactly once."""
+
+    def setUp(self):
+        super(UpdateStatsTest, self).setUp()
+        self.now = datetime.today()
+        self.batch_size = main.UpdateStats.BATCH_SIZE
+        self.fold_lag = Stats.FOLD_LAG
+
+    def tearDown(self):
+        main.UpdateStats.BATCH_SIZE = self.batch_size
+        Stats.FOLD_LAG = self.fold_lag
+        super(UpdateStatsTest, self).tearDown()
+
+    def _ended_game(self, seconds_ago, cancelled=False):
+        """Stores a game that ended the given number of seconds ago."""
+        game = Game(user=ndb.Key(User, 'alice'), game_over=True, won=True,
+                    cancelled=cancelled, date=self.now - timedelta(seconds=seconds_ago))
+        game.put()
+        return game
+
+    def _fold(self):
+        """Runs the stats task, and the tasks it enqueues. Returns the
+        stored Stats."""
+        webapp2.Request.blank('/tasks/cache_average_attempts', POST={}).get_response(main.app)
+        self.stubs.run_tasks(main.app)
+        return Stats.get_by_id(Stats.ID)
+
+    def test_games_with_the_same_date_across_batches(self):
+        main.UpdateStats.BATCH_SIZE = 2
+        games = [self._ended_game(120) for _ in range(5)]
+        for game in games[1:]:
+            game.date = games[0].date
+        ndb.put_multi(games)
+        self.assertEqual(self._fold().games, 5)
+        self.assertEqual(self._fold().games, 5)
+
+    def test_recent_games_are_folded_once_older_than_the_lag(self):
+        self._ended_game(300)
+        self._ended_game(10)
+        self.assertEqual(self._fold().games, 1)
+        Stats.FOLD_LAG = 0
+        self.assertEqual(self._fold().games, 2)
+
+    def test_cancelled_games_move_the_watermark(self):
+        self._ended_game(300, cancelled=True)
+        last = self._ended_game(200)
+        stats = self._fold()
+        self.assertEqual(stats.games, 1)
+        self.assertEqual(stats.last_game_date, last.date)
+        self.assertEqual(stats.last_game_keys, [last.key])
@@ -0,0 +1,62 @@
+"""test_sweeper.py - Cancelling abandoned games."""
+
+from datetime import datetime, timedelta
+
+from google.appengine.ext import ndb
+
+from models import Game, OpenGames, User
+from tests.base import TestCase
+
+
+class CancelAbandonedTest(TestCase):
+    """Game.cancel_abandoned cancels only abandoned games, and keeps the
+    players' open games consistent."""
+
+    def setUp(self):
+        super(CancelAbandonedTest, self).setUp()
+        self.create_user('alice')
+        self.create_user('bob')
+        self.alice, self.bob = ndb.Key(User, 'alice'), ndb.Key(User, 'bob')
+
+    def _abandon(self, game):
+        """Makes the given game's last move older than the TTL."""
+        game.last_move_at = datetime.today() - Game.INACTIVITY_TTL - timedelta(days=1)
+        game.put()
+
+    def _open_game_keys(self, user_key):
+        """Returns the keys of the User's open games."""
+        return OpenGames.key_for(user_key).get(use_cache=False).game_keys
+
+    def test_abandoned_games_are_cancelled(self):
+        abandoned = [Game.new_game(self.alice) for _ in range(5)]
+        active = Game.new_game(self.alice)
+        pvp = Game.new_game(self.alice, opponent=self.bob)
+        for game in abandoned + [pvp]:
+            self._abandon(game)
+        keys = Game.query_abandoned().fetch(keys_only=True)
+        self.assertEqual(len(keys), 6)
+        self.assertEqual(Game.cancel_abandoned(keys), 6)
+        for game in ndb.get_multi([game.key for game in abandoned + [pvp]], use_cache=False):
+            self.assertTrue(game.cancelled)
+            self.assertTrue(game.game_over)
+        self.assertEqual(self._open_game_keys(self.alice), [active.key])
+        self.assertEqual(self._open_game_keys(self.bob), [])
+        self.assertEqual(Game.cancel_abandoned(keys), 0)
+
+    def test_game_played_since_it_was_found_is_skipped(self):
+        game = Game.new_game(self.alice)
+        self._abandon(game)
+        keys = Game.query_abandoned().fetch(keys_only=True)
+        played = game.key.get(use_cache=False)
+        self.assertTrue(played.save_moves([played.apply_play(0, 0)]))
+        self.assertEqual(Game.cancel_abandoned(keys), 0)
+        self.assertFalse(game.key.get(use_cache=False).game_over)
+        self.assertEqual(self._open_game_keys(self.alice), [game.key])
+
+    def test_new_game_after_sweep_is_kept(self):
+        game = Game.new_game(self.alice)
+        self._abandon(game)
+        keys = Game.query_abandoned().fetch(keys_only=True)
+        new = Game.new_game(self.alice)
+        self.assertEqual(Game.cancel_abandoned(keys), 1)
+        self.assertEqual(self._open_game_keys(self.alice), [new.key])
@@ -0,0 +1,88 @@
+"""test_user_stats.py - Incrementally maintained User stats match those
+recomputed from the game history."""
+
+import random
+
+from google.appengine.ext import ndb
+
+from models import Game, User
+from tests.base import TestCase
+
+USERS = 6
+GAMES = 300
+ROCK, PAPER = 0, 1
+
+
+class UserStatsTest(TestCase):
+    """Randomized game histories, against the AI and between players, some
+    cancelled and some left open."""
+
+    def setUp(self):
+        super(UserStatsTest, self).setUp()
+        self.random = random.Random(1)
+        self.user_keys = []
+        for number in range(USERS):
+            self.create_user('user{}'.format(number))
+            self.user_keys.append(ndb.Key(User, 'user{}'.format(number)))
+
+    def _play_games(self):
+        """Plays GAMES random games through save_moves, as make_play and
+        cancel_game do."""
+        for _ in range(GAMES):
+            user_key, opponent_key = self.random.sample(self.user_keys, 2)
+            pvp = self.random.random() < 0.4
+            game = Game.new_game(user_key, opponent=opponent_key if pvp else None)
+            for _ in range(self.random.randint(0, 3)):
+                self.assertTrue(game.save_moves([game.apply_play(ROCK, ROCK)]))
+            end = self.random.random()
+            if end < 0.1:
+                continue
+            if end < 0.2:
+                game.cancelled = True
+                self.assertTrue(game.end_game(True))
+                continue
+            won = self.random.random() < 0.5
+            move = game.apply_play(PAPER, ROCK) if won else game.apply_play(ROCK, PAPER)
+            self.assertTrue(game.save_moves([move]))
+
+    def _stats(self, user):
+        """Returns the aggregate stats of the given User."""
+        return dict((name, getattr(user, name)) for name in User.STATS)
+
+    def test_incremental_stats_match_recomputed_stats(self):
+        self._play_games()
+        for user in ndb.get_multi(self.user_keys, use_cache=False):
+            incremental = self._stats(user)
+            user.recompute_stats()
+            self.assertEqual(self._stats(user), incremental, user.username)
+            self.assertGreater(user.total_games, 0)
+
+    def test_backfill_job_restores_the_stats(self):
+        self._play_games()
+        users = ndb.get_multi(self.user_keys, use_cache=False)
+        expected = [self._stats(user) for user in users]
+        for user in users:
+            for name in User.STATS:
+                setattr(user, name, None)
+        ndb.put_multi(users)
+        self.run_handler('/tasks/backfill_user_stats')
+        self.assertEqual([self._stats(user) for user in
+                          ndb.get_multi(self.user_keys, use_cache=False)], expected)
+
+    def test_backfill_retries_when_a_game_ends(self):
+        user_key = self.user_keys[0]
+        game = Game.new_game(user_key)
+        recompute_stats = User.recompute_stats
+
+        def _recompute_stats(user):
+            """Recompute the stats while a game of the User ends."""
+            recompute_stats(user)
+            if not game.game_over:
+                self.assertTrue(game.save_moves([game.apply_play(PAPER, ROCK)]))
+        User.recompute_stats = _recompute_stats
+        try:
+            self.assertTrue(User.backfill_stats(user_key))
+        finally:
+            User.recompute_stats = recompute_stats
+        user = user_key.get(use_cache=False)
+        self.assertEqual((user.total_games, user.wins), (1, 1))
@@ -0,0 +1,58 @@
+"""test_users.py - Migrating Users to username keys."""
+
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+import api
+from models import AIState, Game, LeaderboardBucket, MatchRequest, OpenGames, Reminder, User
+from tests.base import TestCase
+
+
+class RekeyByUsernameTest(TestCase):
+    """User.rekey_by_username repoints every reference to the User."""
+
+    def setUp(self):
+        super(RekeyByUsernameTest, self).setUp()
+        self.create_user('alice')
+        self.alice = ndb.Key(User, 'alice')
+        # A User stored under an auto-generated ID, as before username keys.
+        self.legacy = User(username='bob', display_name='Bob', email='bob@example.com')
+        self.legacy.put()
+
+    def test_games_and_match_request_are_repointed(self):
+        as_user = Game.new_game(self.legacy.key, opponent=self.alice)
+        as_opponent = Game.new_game(self.alice, opponent=self.legacy.key)
+        entry = MatchRequest.join(self.legacy, as_user.variant)
+        self.legacy.rekey_by_username()
+
+        bob = ndb.Key(User, 'bob')
+        self.assertIsNone(self.legacy.key.get())
+        self.assertEqual(as_user.key.get(use_cache=False).user, bob)
+        self.assertEqual(as_opponent.key.get(use_cache=False).opponent, bob)
+        self.assertEqual(entry.key.get(use_cache=False).user, bob)
+        for game in (as_user, as_opponent):
+            form = self.service.get_game(self.request(api.GET_GAME_REQUEST,
+                                                      urlsafe_game_key=game.key.urlsafe()))
+            self.assertEqual(set([form.username, form.opponent]), set(['alice', 'bob']))
+
+    def test_keyed_entities_are_moved(self):
+        open_game = Game.new_game(self.legacy.key, strategy='frequency')
+        won_game = Game.new_game(self.legacy.key, strategy='frequency')
+        self.assertTrue(won_game.save_moves([won_game.apply_play(1, 0)]))
+        Reminder(key=Reminder.key_for(self.legacy.key), last_sent=datetime.today()).put()
+        AIState(key=AIState.key_for(open_game), plays=7).put()
+        self.legacy.rekey_by_username()
+
+        bob = ndb.Key(User, 'bob')
+        self.assertEqual(ndb.Query(ancestor=self.legacy.key).fetch(keys_only=True), [])
+        self.assertEqual(OpenGames.key_for(bob).get().game_keys, [open_game.key])
+        buckets = LeaderboardBucket.query(ancestor=bob).fetch()
+        self.assertEqual(sorted(bucket.period for bucket in buckets),
+                         sorted(LeaderboardBucket.PERIODS))
+        self.assertTrue(all(bucket.wins == 1 for bucket in buckets))
+        self.assertIsNone(Reminder.key_for(self.legacy.key).get())
+        self.assertIsNotNone(Reminder.key_for(bob).get())
+        self.assertIsNone(AIState.key_for(open_game).get())
+        open_game.user = bob
+        self.assertEqual(AIState.key_for(open_game).get().plays, 7)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""tournament.py - Offline tournament between the AI strategies.
+
+Plays every pair of strategies against each other, without App Engine, and
+reports the rounds played per second and the win rates of each pair.
+
+Usage: python tournament.py [--rounds N] [--variant VARIANT] [--seed SEED]"""
+
+import argparse
+import random
+import time
+
+from rules import get_rules, WIN, LOSE
+from strategies import STRATEGIES, get_strategy
+
+
+def play_match(rules, first, second, rounds):
+    """Plays the given number of rounds between two strategies, each
+    learning from the other's plays. Returns the number of rounds won by
+    the first and by the second strategy."""
+    first_state = first.new_state()
+    second_state = second.new_state()
+    outcomes = rules.outcomes
+    size = rules.size
+    first_wins = second_wins = 0
+    for _ in xrange(rounds):
+        first_play = first.choose(first_state)
+        second_play = second.choose(second_state)
+        outcome = outcomes[first_play * size + second_play]
+        if outcome == WIN:
+            first_wins += 1
+        elif outcome == LOSE:
+            second_wins += 1
+        first.update(first_state, second_play)
+        second.update(second_state, first_play)
+    return first_wins, second_wins
+
+
+def main():
+    """Run the tournament and print its results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=1000000,
+                        help='rounds played between each pair of strategies')
+    parser.add_argument('--variant', default=None, help='game variant to play')
+    parser.add_argument('--seed', type=int, default=None, help='random seed')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    rules = get_rules(args.variant)
+    if not rules:
+        parser.error('Unknown game variant!')
+    names = sorted(name for name in STRATEGIES if get_strategy(name, rules.size))
+
+    print '{:<10} {:<10} {:>12} {:>8} {:>8} {:>8}'.format(
+        'first', 'second', 'rounds/sec', 'first', 'second', 'ties')
+    for index, first in enumerate(names):
+        for second in names[index:]:
+            start = time.time()
+            first_wins, second_wins = play_match(rules,
+                                                 get_strategy(first, rules.size),
+                                                 get_strategy(second, rules.size),
+                                                 args.rounds)
+            elapsed = time.time() - start
+            ties = args.rounds - first_wins - second_wins
+            print '{:<10} {:<10} {:>12.0f} {:>8.2%} {:>8.2%} {:>8.2%}'.format(
+                first, second, args.rounds / elapsed,
+                float(first_wins) / args.rounds,
+                float(second_wins) / args.rounds,
+                float(ties) / args.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,29 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from protorpc import protobuf
+from google.appengine.api import datastore_errors, memcache, oauth
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def _key_from_urlsafe(urlsafe):
+    """Returns the ndb.Key that the urlsafe key string encodes. Raises
+    endpoints.BadRequestException if the key string is malformed."""
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+
+
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
@@ -17,19 +37,136 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception, e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
 
-    entity = key.get()
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
+    """Asynchronous version of get_by_urlsafe: returns a Future for the
+        entity, so the get can run concurrently with other RPCs. Errors are
+        raised when the result of the Future is got.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        A Future for the entity that the urlsafe Key string points to or
+        None if no entity exists."""
+    entity = yield _key_from_urlsafe(urlsafe).get_async()
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity
+    raise ndb.Return(entity)
+
+
+def get_multi_by_urlsafe(urlsafes, model):
+    """Returns the ndb.Model entities that the urlsafe keys point to, fetched
+        in a single batch get. Checks and raises errors as get_by_urlsafe.
+    Args:
+        urlsafes: A list of urlsafe key strings
+        model: The expected entity kind
+    Returns:
+        A dictionary mapping each urlsafe key string to the entity it points
+        to, or to None if no entity exists.
+    Raises:
+        ValueError:"""
+    urlsafes = list(set(urlsafes))
+    entities = ndb.get_multi([_key_from_urlsafe(urlsafe) for urlsafe in urlsafes])
+    for entity in entities:
+        if entity and not isinstance(entity, model):
+            raise ValueError('Incorrect Kind')
+    return dict(zip(urlsafes, entities))
+
+
+def fetch_page(query, limit=None, page_token=None):
+    """Fetches a single page of results from an ndb.Query using a cursor.
+    Args:
+        query: The ndb.Query to fetch results from
+        limit: Maximum number of results to return. Defaults to
+            DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE
+        page_token: A urlsafe cursor string returned with a previous page,
+            or None to fetch the first page
+    Returns:
+        A tuple of the list of results and the urlsafe page token for the
+        next page, or None if there are no more results.
+    Raises:
+        endpoints.BadRequestException: If the limit or page token is invalid"""
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise endpoints.BadRequestException('Invalid limit')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    try:
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid page token')
+
+    results, next_cursor, more = query.fetch_page(limit, start_cursor=cursor)
+    next_page_token = next_cursor.urlsafe() if more and next_cursor else None
+    return results, next_page_token
+
+
+def require_admin():
+    """Checks that the current endpoints request is made by an admin of the
+    application, authenticated with OAuth.
+    Raises:
+        endpoints.UnauthorizedException: If the request is not authenticated
+        endpoints.ForbiddenException: If the user is not an admin"""
+    try:
+        is_admin = oauth.is_current_user_admin(endpoints.EMAIL_SCOPE)
+    except oauth.Error:
+        raise endpoints.UnauthorizedException('Authorization required')
+    if not is_admin:
+        raise endpoints.ForbiddenException('Admin access required')
+
+
+def slice_page(items, limit=None, page_token=None):
+    """Returns a single page of a list, such as a list of keys, like
+    fetch_page does for queries. Page tokens are offsets into the list.
+    Args:
+        items: The list to return a page of
+        limit: Maximum number of items to return. Defaults to
+            DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE
+        page_token: A page token returned with a previous page, or None to
+            return the first page
+    Returns:
+        A tuple of the list of items and the page token for the next page,
+        or None if there are no more items.
+    Raises:
+        endpoints.BadRequestException: If the limit or page token is invalid"""
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise endpoints.BadRequestException('Invalid limit')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    try:
+        offset = int(page_token) if page_token else 0
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        raise endpoints.BadRequestException('Invalid page token')
+
+    next_offset = offset + limit
+    next_page_token = str(next_offset) if next_offset < len(items) else None
+    return items[offset:next_offset], next_page_token
+
+
+def get_cached_message(cache_key, message_type, build, time=0):
+    """Returns a response message cached in memcache, or builds, caches and
+    returns it. Cache keys must identify the version of the data the message
+    is built from, as cached messages are never invalidated.
+    Args:
+        cache_key: The memcache key of the message
+        message_type: The protorpc message class of the message
+        build: A function returning the message, called on a cache miss
+        time: Optional expiration time of the cached message, in seconds
+    Returns:
+        The message."""
+    data = memcache.get(cache_key)
+    if data is not None:
+        return protobuf.decode_message(message_type, data)
+    message = build()
+    memcache.set(cache_key, protobuf.encode_message(message), time=time)
+    return message